@@ -0,0 +1,344 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import sys, os, subprocess, pipes, errno, json, hashlib, threading, copy
+
+from ram import progress, cache
+
+DEFAULT_BACKEND = 'imagemagick'
+
+class BackendNotFoundException(Exception):
+    pass
+
+class BackendUnavailableException(Exception):
+    pass
+
+def resize_geometry(slave):
+    return '%sx%s' % (str(slave.width), str(slave.height))
+
+def fit_size(size, slave):
+    '''
+    scale size to fit inside the slave's width and height while keeping its
+    aspect ratio, the same way ImageMagick treats a WxH -resize geometry
+    '''
+    scale = min(float(slave.width) / size[0], float(slave.height) / size[1])
+    return (max(1, int(round(size[0] * scale))),
+            max(1, int(round(size[1] * scale))))
+
+def output_options(slave):
+    return getattr(slave, 'output', None) or {}
+
+def rule_fingerprint(slave, backend):
+    '''
+    identify the rule a slave is generated by: its resolved path, size and
+    output options and the backend writing it
+    '''
+    rule = json.dumps([slave.path, slave.width, slave.height,
+                       backend.name, backend.options()] +
+                      # appended only when set, so existing outputs stay
+                      # current
+                      ([output_options(slave)] if output_options(slave) else []),
+                      sort_keys=True)
+    return hashlib.sha1(rule.encode('utf-8')).hexdigest()
+
+def output_fingerprint(slave, backend):
+    '''
+    identify what a slave's contents depend on besides its master: its size,
+    format, output options and the backend and version writing it, but not
+    its path
+    '''
+    extension = os.path.splitext(slave.path)[1].lower()
+    output = json.dumps([slave.width, slave.height, extension, backend.name,
+                         backend.version(), backend.options()] +
+                        ([output_options(slave)] if output_options(slave) else []),
+                        sort_keys=True)
+    return hashlib.sha1(output.encode('utf-8')).hexdigest()
+
+def encoding_arguments(slave):
+    '''
+    the convert settings encoding a slave with its output options, and the
+    path to write it to, prefixed with the format if one is set
+    '''
+    output = output_options(slave)
+    arguments = []
+    if 'colors' in output:
+        arguments.extend(['-colors', str(output['colors'])])
+    if 'quality' in output:
+        arguments.extend(['-quality', str(output['quality'])])
+    if 'compression' in output:
+        arguments.extend(['-define',
+                          'png:compression-level=%d' % output['compression']])
+    path = str(slave.path)
+    if 'format' in output:
+        path = '%s:%s' % (output['format'].upper(), path)
+    return arguments, path
+
+def memory_limit(size):
+    '''
+    format a number of bytes as an ImageMagick resource limit, rounded up to
+    whole mebibytes
+    '''
+    return '%dMiB' % max(1, -(-int(size) // (1024 * 1024)))
+
+class Backend:
+    '''
+    converts a master into one or more slaves
+
+    convert returns 0 when every slave was written and non-zero otherwise.
+    memory is the number of bytes the conversion is expected to need, which
+    backends able to bound their memory use should stay within.
+
+    backends implement write, which convert calls with temporary files in
+    place of the slaves. These are renamed over the slaves only once all of
+    them were written, so a killed conversion never leaves half an output.
+    '''
+
+    name = None
+
+    def options(self):
+        '''
+        settings which change the output of this backend
+        '''
+        return {}
+
+    def version(self):
+        '''
+        the version of the library or program doing the conversion
+        '''
+        return None
+
+    def convert(self, master, slaves, dry_run, memory=None):
+        if dry_run or not slaves:
+            return self.write(master, slaves, dry_run, memory)
+        temporary = []
+        try:
+            try:
+                for slave in slaves:
+                    temp_slave = copy.copy(slave)
+                    temp_slave.path = cache.temporary_file(str(slave.path))
+                    temporary.append(temp_slave)
+            except (IOError, OSError) as e:
+                progress.write('%s: %s' % (master, e))
+                return 1
+            result = self.write(master, temporary, dry_run, memory)
+            if result != 0:
+                return result
+            try:
+                for slave, temp_slave in zip(slaves, temporary):
+                    cache.rename_into_place(temp_slave.path, str(slave.path))
+            except OSError as e:
+                progress.write('%s: %s' % (master, e))
+                return 1
+            return 0
+        finally:
+            for temp_slave in temporary:
+                if os.path.exists(temp_slave.path):
+                    os.remove(temp_slave.path)
+
+    def write(self, master, slaves, dry_run, memory=None):
+        raise NotImplementedError()
+
+    def cancel(self):
+        '''
+        stop the running conversions as soon as possible, which then fail,
+        and fail any started afterwards
+        '''
+        pass
+
+class ImageMagickBackend(Backend):
+
+    name = 'imagemagick'
+
+    def __init__(self):
+        self._version = None
+        self.lock = threading.Lock()
+        self.processes = set()
+        self.cancelled = False
+
+    def version(self):
+        if self._version == None:
+            try:
+                output = subprocess.Popen(['convert', '-version'],
+                                          stdout=subprocess.PIPE).communicate()[0]
+                self._version = output.splitlines()[0].strip()
+            except (OSError, IndexError):
+                self._version = 'unknown'
+        return self._version
+
+    def command(self, master, slaves, memory=None):
+        '''
+        build a single convert invocation which decodes master once and
+        writes every slave from a clone of the decoded image
+
+        with memory ImageMagick keeps at most that many bytes of pixels in
+        memory and memory maps up to twice as many, spilling the rest to disk
+        '''
+        command = ['convert']
+        if memory != None:
+            command.extend(['-limit', 'memory', memory_limit(memory),
+                            '-limit', 'map', memory_limit(memory * 2)])
+        if [slave for slave in slaves if output_options(slave)]:
+            # keeps one slave's output options from applying to the next
+            command.append('-respect-parentheses')
+        command.append(str(master) + '[0]')
+        for slave in slaves[:-1]:
+            arguments, path = encoding_arguments(slave)
+            command.extend(['(', '+clone',
+                            '-resize', resize_geometry(slave)] + arguments +
+                           ['-write', path,
+                            '+delete', ')'])
+        arguments, path = encoding_arguments(slaves[-1])
+        command.extend(['-resize', resize_geometry(slaves[-1])] + arguments +
+                       [path])
+        return command
+
+    def write(self, master, slaves, dry_run, memory=None):
+        if not slaves:
+            return 0
+        command = self.command(master, slaves, memory)
+        if dry_run:
+            # a single write keeps lines from interleaving between workers
+            sys.stdout.write(' '.join([pipes.quote(arg) for arg in command]) + '\n')
+            return 0
+        with self.lock:
+            if self.cancelled:
+                return 1
+            try:
+                process = subprocess.Popen(command, stderr=subprocess.PIPE)
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    raise BackendUnavailableException(
+                            'the imagemagick backend requires ImageMagick\'s ' +
+                            'convert on the PATH')
+                raise
+            self.processes.add(process)
+        try:
+            # pass warnings on as they come rather than once convert exits
+            for line in iter(process.stderr.readline, b''):
+                progress.write('%s: %s' % (master, line.rstrip()))
+            return process.wait()
+        finally:
+            with self.lock:
+                self.processes.discard(process)
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for process in self.processes:
+                try:
+                    process.terminate()
+                except OSError:
+                    # already exited
+                    pass
+
+class PillowBackend(Backend):
+    '''
+    resizes in-process with Pillow, handing masters Pillow cannot read to the
+    fallback backend
+    '''
+
+    name = 'pillow'
+
+    def __init__(self, fallback=None):
+        try:
+            from PIL import Image
+        except ImportError:
+            raise BackendUnavailableException(
+                    'the pillow backend requires Pillow to be installed')
+        self.image_module = Image
+        import PIL
+        self._version = (getattr(PIL, '__version__', None) or
+                         getattr(PIL, 'PILLOW_VERSION', 'unknown'))
+        self.resample = getattr(Image, 'LANCZOS', None) or Image.ANTIALIAS
+        if fallback == None:
+            fallback = ImageMagickBackend()
+        self.fallback = fallback
+
+    def version(self):
+        return 'Pillow ' + self._version
+
+    def can_write(self, slave):
+        format = output_options(slave).get('format')
+        if format == None:
+            return True
+        self.image_module.init()
+        return format.upper() in self.image_module.SAVE
+
+    def encode(self, image, slave):
+        '''
+        write an image to slave.path with the slave's output options
+        '''
+        output = output_options(slave)
+        if 'colors' in output:
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            image = image.quantize(output['colors'])
+        settings = {}
+        if 'format' in output:
+            settings['format'] = output['format'].upper()
+        if 'quality' in output:
+            settings['quality'] = output['quality']
+        if 'compression' in output:
+            settings['compress_level'] = output['compression']
+        try:
+            image.save(str(slave.path), **settings)
+        except IOError:
+            # formats such as JPEG cannot hold an alpha channel
+            image.convert('RGB').save(str(slave.path), **settings)
+
+    def write(self, master, slaves, dry_run, memory=None):
+        if not slaves:
+            return 0
+        if not all([self.can_write(slave) for slave in slaves]):
+            return self.fallback.write(master, slaves, dry_run, memory)
+        try:
+            image = self.image_module.open(master)
+            image.load()
+        except IOError:
+            return self.fallback.write(master, slaves, dry_run, memory)
+
+        for slave in slaves:
+            size = fit_size(image.size, slave)
+            if dry_run:
+                sys.stdout.write('pillow %s -> %s %dx%d\n' % (
+                        master, slave.path, size[0], size[1]))
+                continue
+            try:
+                self.encode(image.resize(size, self.resample), slave)
+            except (IOError, ValueError):
+                return 1
+        return 0
+
+    def cancel(self):
+        self.fallback.cancel()
+
+BACKENDS = {
+    ImageMagickBackend.name: ImageMagickBackend,
+    PillowBackend.name: PillowBackend,
+}
+
+def get_backend(name=None):
+    '''
+    create the backend registered under name, or the default backend
+
+    raises a BackendNotFoundException for unknown names and a
+    BackendUnavailableException if the backend's library is not installed
+    '''
+    if name == None:
+        name = DEFAULT_BACKEND
+    if name not in BACKENDS:
+        raise BackendNotFoundException('no such backend: %s' % name)
+    return BACKENDS[name]()
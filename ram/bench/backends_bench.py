@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+'''
+compare the conversion backends on a directory of small png masters
+
+    python -m ram.bench.backends_bench -n 300 -j 4
+'''
+
+import argparse, os, shutil, tempfile, time, multiprocessing
+
+from ram import backends, commands
+from ram.bench import synthetic
+
+DENSITIES = [0.75, 1, 1.5, 2]
+
+def make_conversions(masters, output_dir, size):
+    conversions = []
+    for master in masters:
+        name = os.path.basename(master)
+        slaves = []
+        for density in DENSITIES:
+            slaves.append(commands.SlaveConversion(
+                    path=os.path.join(output_dir, '%s-%s' % (density, name)),
+                    width=size * density,
+                    height=size * density))
+        conversions.append(commands.Conversion(master=master, slaves=slaves))
+    return conversions
+
+def run(backend_name, conversions, jobs):
+    try:
+        backend = backends.get_backend(backend_name)
+        start = time.time()
+        succeeded, failed = commands.run_conversions(
+                conversions, jobs, False, False, backend=backend)
+        elapsed = time.time() - start
+    except backends.BackendUnavailableException as e:
+        return None, str(e)
+    if failed:
+        return None, '%d conversions failed' % len(failed)
+    return elapsed, None
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark ram backends')
+    parser.add_argument('-n', '--masters', type=int, default=300)
+    parser.add_argument('-s', '--size', type=int, default=48,
+                        help='base slave size in pixels')
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=multiprocessing.cpu_count())
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='ram-bench-')
+    try:
+        masters = synthetic.make_masters(
+                os.path.join(tmp, 'masters'), args.masters,
+                args.size * 4, args.size * 4)
+        print '%d masters, %d slaves each, %d jobs' % (
+                len(masters), len(DENSITIES), args.jobs)
+        for name in sorted(backends.BACKENDS.keys()):
+            output_dir = os.path.join(tmp, name)
+            os.makedirs(output_dir)
+            conversions = make_conversions(masters, output_dir, args.size)
+            elapsed, error = run(name, conversions, args.jobs)
+            if error:
+                print '%-12s skipped: %s' % (name, error)
+            else:
+                print '%-12s %8.3fs %10.1f masters/s' % (
+                        name, elapsed, len(masters) / elapsed)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+'''
+measure index writes committed one row at a time against batched writes
+
+    python -m ram.bench.index_bench -n 10000 100000
+'''
+
+import argparse, os, shutil, tempfile, time
+
+from ram import index
+
+# committing every row is far too slow to run over the whole index
+AUTOCOMMIT_SAMPLE = 2000
+
+def make_index(db_path, count):
+    file_index = index.FileIndex(db_path)
+    file_index.init()
+    with file_index:
+        file_index.add([('masters/master%07d.png' % i, 0) for i in range(count)])
+    return file_index
+
+def rows(count, modified):
+    return [('masters/master%07d.png' % i, modified, 1024, 'sha1:%040d' % i)
+            for i in range(count)]
+
+def bench(count, tmp):
+    db_path = os.path.join(tmp, '%d.ramindex' % count)
+    file_index = make_index(db_path, count)
+
+    sample = rows(min(count, AUTOCOMMIT_SAMPLE), 1)
+    start = time.time()
+    for row in sample:
+        file_index.update(*row)
+    autocommit = len(sample) / (time.time() - start)
+
+    start = time.time()
+    with file_index:
+        file_index.update_many(rows(count, 2))
+    batched = count / (time.time() - start)
+
+    start = time.time()
+    with file_index:
+        all_rows = file_index.all()
+    read = len(all_rows) / (time.time() - start)
+    file_index.close()
+
+    print '%8d rows  %10.0f rows/s per-row commit  %10.0f rows/s batched  %10.0f rows/s read' % (
+            count, autocommit, batched, read)
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the ram index')
+    parser.add_argument('-n', '--rows', type=int, nargs='+',
+                        default=[10000, 100000])
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='ram-bench-')
+    try:
+        for count in args.rows:
+            bench(count, tmp)
+    finally:
+        shutil.rmtree(tmp)
+
+if __name__ == '__main__':
+    main()
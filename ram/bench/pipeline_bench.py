@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+'''
+time each stage of the convert pipeline on a synthetic repo
+
+    python -m ram.bench.pipeline_bench -n 1000 --slaves 4 -o before.json
+    python -m ram.bench.pipeline_bench -n 1000 --slaves 4 --compare before.json
+
+results are written as JSON so runs before and after a change, or on
+different machines, can be compared
+'''
+
+import argparse, json, multiprocessing, os, platform, shutil, sys, tempfile, time
+
+from ram import backends, commands, index
+from ram.bench import synthetic
+
+class Quiet:
+    '''
+    swallow what ram prints while a stage is timed
+    '''
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+        return False
+
+def convert_args(options, dry_run):
+    return argparse.Namespace(dry_run=dry_run, explain=False, profile=None,
+                              verbose=False, jobs=options.jobs,
+                              per_slave=False, backend=None,
+                              cache_dir=None, max_memory=None,
+                              shard=None, index=None, workers=None)
+
+def timed(function):
+    start = time.time()
+    with Quiet():
+        function()
+    return time.time() - start
+
+class BenchmarkException(Exception):
+    pass
+
+def bench(options):
+    '''
+    run each stage once on a fresh repo, returning stage -> seconds
+    '''
+    results = {}
+    results['ramfile parse'] = timed(commands.load_ramfile)
+    results['ramfile cached'] = timed(commands.load_ramfile)
+    settings, conversions = commands.load_ramfile()
+    backend = backends.get_backend(settings.get('backend'))
+
+    def status():
+        with index.FileIndex(commands.INDEX_PATH) as file_index:
+            return len([path for state, path in commands.scan_status(file_index)
+                        if state != index.CURRENT])
+
+    def plan():
+        with index.FileIndex(commands.INDEX_PATH) as file_index:
+            commands.plan_conversions(file_index, file_index.all(), conversions,
+                                      backend)
+
+    def convert(dry_run):
+        with index.FileIndex(commands.INDEX_PATH,
+                             commit_every=commands.INDEX_COMMIT_EVERY) as file_index:
+            commands.convert_index(convert_args(options, dry_run), file_index)
+
+    results['status modified'] = timed(status)
+    results['plan'] = timed(plan)
+    results['convert dry run'] = timed(lambda: convert(True))
+    if not options.skip_convert:
+        results['convert'] = timed(lambda: convert(False))
+        results['status current'] = timed(status)
+        if status():
+            raise BenchmarkException('the convert did not bring every output ' +
+                                     'up to date')
+        results['convert up to date'] = timed(lambda: convert(False))
+    return results
+
+def compare(results, previous):
+    print '%-20s %10s %10s %8s' % ('stage', 'before', 'after', 'change')
+    for stage in sorted(results):
+        if stage not in previous:
+            continue
+        before, after = previous[stage], results[stage]
+        print '%-20s %9.3fs %9.3fs %+7.0f%%' % (
+                stage, before, after, (after - before) / max(before, 1e-9) * 100)
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the convert pipeline')
+    parser.add_argument('-n', '--masters', type=int, default=1000)
+    parser.add_argument('--rows', type=int, default=None,
+                        help='index rows, the masters plus up to date ' +
+                            'masters without conversions (default: masters)')
+    parser.add_argument('--size', type=int, default=64,
+                        help='master width and height in pixels')
+    parser.add_argument('--formats', default='png',
+                        help='comma separated master formats, such as png,jpg')
+    parser.add_argument('--slaves', type=int, default=4,
+                        help='slaves in the template every master uses')
+    parser.add_argument('-b', '--backend', default='pillow',
+                        choices=sorted(backends.BACKENDS.keys()))
+    parser.add_argument('-j', '--jobs', type=int,
+                        default=multiprocessing.cpu_count())
+    parser.add_argument('--skip-convert', action='store_true',
+                        help='only time the stages which convert nothing')
+    parser.add_argument('-o', '--output', metavar='results.json',
+                        help='write the results to this file')
+    parser.add_argument('--compare', metavar='results.json',
+                        help='compare with the results of an earlier run')
+    options = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix='ram-bench-')
+    cwd = os.getcwd()
+    try:
+        synthetic.make_repo(tmp, options.masters, options.size, options.size,
+                            options.formats.split(','), options.slaves,
+                            options.rows, {'backend': options.backend})
+        os.chdir(tmp)
+        results = bench(options)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(tmp)
+
+    params = dict([(name, getattr(options, name)) for name in
+                   ['masters', 'rows', 'size', 'formats', 'slaves', 'backend',
+                    'jobs']])
+    print ', '.join(['%s=%s' % (name, params[name]) for name in sorted(params)])
+    for stage in sorted(results):
+        print '%-20s %9.3fs %10.0f masters/s' % (
+                stage, results[stage], options.masters / max(results[stage], 1e-9))
+
+    if options.compare:
+        with open(options.compare) as previous:
+            compare(results, json.load(previous)['results'])
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump({'params': params, 'python': platform.python_version(),
+                       'platform': platform.platform(), 'time': time.time(),
+                       'results': results}, output, indent=1, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+import os, json, struct, zlib
+
+from ram import index
+
+def _png_chunk(chunk_type, data):
+    chunk = chunk_type + data
+    return (struct.pack('>I', len(data)) + chunk +
+            struct.pack('>I', zlib.crc32(chunk) & 0xffffffff))
+
+def write_png(path, width, height, seed=0):
+    '''
+    write an RGBA png of width x height filled with a gradient derived from
+    seed, without needing an imaging library
+    '''
+    rows = []
+    for y in range(height):
+        row = [b'\x00']
+        for x in range(width):
+            row.append(struct.pack('BBBB',
+                                   (x + seed) % 256,
+                                   (y + seed) % 256,
+                                   (x + y) % 256,
+                                   255))
+        rows.append(b''.join(row))
+    with open(path, 'wb') as f:
+        f.write(b'\x89PNG\r\n\x1a\n')
+        f.write(_png_chunk(b'IHDR',
+                           struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)))
+        f.write(_png_chunk(b'IDAT', zlib.compress(b''.join(rows))))
+        f.write(_png_chunk(b'IEND', b''))
+
+def make_masters(directory, count, width, height):
+    '''
+    write count png masters into directory and return their paths
+    '''
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, 'master%05d.png' % i)
+        write_png(path, width, height, seed=i)
+        paths.append(path)
+    return paths
+
+def write_master(path, width, height, seed=0):
+    '''
+    write a master in the format of path's extension. Formats other than png
+    need Pillow.
+    '''
+    if path.endswith('.png'):
+        write_png(path, width, height, seed)
+        return
+    from PIL import Image
+    png_path = path + '.tmp.png'
+    write_png(png_path, width, height, seed)
+    try:
+        image = Image.open(png_path)
+        if path.endswith('.jpg') or path.endswith('.jpeg'):
+            image = image.convert('RGB')
+        image.save(path)
+    finally:
+        os.remove(png_path)
+
+DENSITIES = [0.75, 1, 1.5, 2, 3, 4]
+
+def make_repo(directory, masters, width, height, formats=['png'], slaves=4,
+              rows=None, settings={}):
+    '''
+    write a ram managed repo into directory: masters masters of width x
+    height cycling through formats, a ramfile converting each of them
+    through a template of slaves slaves and an index of rows rows
+
+    rows beyond the masters are up to date masters with no conversion, which
+    ram has to look at but never converts. settings are added to the top
+    level of the ramfile.
+    '''
+    if rows == None:
+        rows = masters
+    master_dir = os.path.join(directory, 'masters')
+    if not os.path.isdir(master_dir):
+        os.makedirs(master_dir)
+
+    template = []
+    for i in range(slaves):
+        density = DENSITIES[i % len(DENSITIES)]
+        # backends expect the output directories to exist
+        os.makedirs(os.path.join(directory, 'res', 'drawable-%d-%s' % (i, density)))
+        template.append({
+            'path': 'res/drawable-%d-%s/{name}' % (i, density),
+            'width': '{basewidth} * %s' % density,
+            'height': '{baseheight} * %s' % density,
+        })
+    conversions = []
+    paths = []
+    for i in range(rows):
+        extension = formats[i % len(formats)]
+        path = 'masters/master%06d.%s' % (i, extension)
+        write_master(os.path.join(directory, path), width, height, seed=i)
+        paths.append(path)
+        if i < masters:
+            conversions.append({
+                'master': path,
+                'template': 'density',
+                'name': 'image%06d.%s' % (i, extension),
+                'basewidth': max(1, width / 4),
+                'baseheight': max(1, height / 4),
+            })
+    ramfile_data = dict(settings)
+    ramfile_data['templates'] = {'density': {'slaves': template}}
+    ramfile_data['conversions'] = conversions
+    with open(os.path.join(directory, 'ramfile.json'), 'w') as ramfile:
+        json.dump(ramfile_data, ramfile, indent=1)
+
+    file_index = index.FileIndex(os.path.join(directory, '.ramindex'))
+    file_index.init()
+    with file_index:
+        file_index.add([(path, 0) for path in paths[:masters]])
+        extra = []
+        for path in paths[masters:]:
+            stat = os.stat(os.path.join(directory, path))
+            extra.append((path, stat.st_mtime, stat.st_size,
+                          index.file_digest(os.path.join(directory, path))))
+        file_index.add([(row[0], 0) for row in extra])
+        file_index.update_many(extra)
+    file_index.close()
+    return paths
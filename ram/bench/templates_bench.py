@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+
+'''
+time resolving template slaves for many conversions, compiled against the
+old substitute-and-eval approach
+
+    python -m ram.bench.templates_bench -n 50000
+'''
+
+import argparse, time
+
+from ram import commands
+
+DENSITIES = ['0.75', '1', '1.5', '2']
+
+def make_template():
+    slaves = []
+    for density in DENSITIES:
+        slaves.append(commands.SlaveConversion(
+                path='res/drawable-%s/{name}' % density,
+                width='{basewidth} * %s' % density,
+                height='{baseheight} * %s' % density))
+    return commands.ConversionTemplate('android', slaves)
+
+def make_args(count):
+    return [{'name': 'image%d.png' % i, 'basewidth': 48 + i % 100,
+             'baseheight': 32 + i % 50} for i in range(count)]
+
+def resolve_with_eval(template, args):
+    slaves = []
+    for slave in template.slave_conversions:
+        slaves.append(commands.SlaveConversion(
+                path=commands.replace_args(slave.path, args),
+                width=eval(commands.replace_args(slave.width, args)),
+                height=eval(commands.replace_args(slave.height, args))))
+    return slaves
+
+def timed(resolve, template, all_args):
+    start = time.time()
+    for args in all_args:
+        resolve(template, args)
+    return time.time() - start
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark template resolution')
+    parser.add_argument('-n', '--conversions', type=int, default=50000)
+    args = parser.parse_args()
+
+    all_args = make_args(args.conversions)
+    template = make_template()
+    print '%d conversions, %d slaves each' % (len(all_args), len(DENSITIES))
+    for name, resolve in [('eval', resolve_with_eval),
+                          ('compiled', commands.populate_template)]:
+        elapsed = timed(resolve, template, all_args)
+        print '%-10s %8.3fs %10.0f conversions/s' % (
+                name, elapsed, len(all_args) / elapsed)
+
+if __name__ == '__main__':
+    main()
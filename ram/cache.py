@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os, stat, shutil, hashlib, errno, tempfile
+
+# marks the temporary files outputs are written to before being renamed
+TEMPORARY_MARKER = '.ram-'
+
+def _read_umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+# the process's umask, read once because reading it means changing it
+UMASK = _read_umask()
+
+# the permissions new files get, as when created with open
+NEW_FILE_MODE = 0o666 & ~UMASK
+
+def temporary_file(path):
+    '''
+    create an empty hidden file next to path with the same extension, to
+    write path's contents to before renaming it into place
+
+    returns the temporary file's path
+    '''
+    directory, name = os.path.split(path)
+    handle, temp_path = tempfile.mkstemp(
+            dir=directory or '.', prefix='.' + name + TEMPORARY_MARKER,
+            suffix=os.path.splitext(name)[1])
+    os.close(handle)
+    return os.path.join(directory, os.path.basename(temp_path))
+
+def rename_into_place(temp_path, path):
+    '''
+    rename temp_path over path, giving it path's permissions, or those of a
+    new file if there is no path yet. Temporary files are created readable
+    only by their owner, which outputs should not be.
+    '''
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except OSError:
+        mode = NEW_FILE_MODE
+    os.chmod(temp_path, mode)
+    os.rename(temp_path, path)
+
+def remove_temporary_files(path):
+    '''
+    remove the temporary files for path left behind by a run which was killed
+
+    returns the number of files removed
+    '''
+    directory, name = os.path.split(path)
+    prefix = '.' + name + TEMPORARY_MARKER
+    try:
+        names = os.listdir(directory or '.')
+    except OSError:
+        return 0
+    removed = 0
+    for temp_name in names:
+        if temp_name.startswith(prefix):
+            try:
+                os.remove(os.path.join(directory, temp_name))
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+def place(source, destination, link=False):
+    '''
+    copy source to destination, creating its directory. With link a hard
+    link is made instead where possible. destination is replaced atomically,
+    so it never holds half a copy.
+    '''
+    directory = os.path.dirname(destination)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    temp_path = temporary_file(destination)
+    try:
+        linked = False
+        if link:
+            try:
+                os.remove(temp_path)
+                os.link(source, temp_path)
+                linked = True
+            except OSError:
+                # e.g. source is on another file system
+                shutil.copyfile(source, temp_path)
+        else:
+            shutil.copyfile(source, temp_path)
+        if linked:
+            # a link shares source's permissions, which must not be changed
+            os.rename(temp_path, destination)
+        else:
+            rename_into_place(temp_path, destination)
+    except (IOError, OSError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+class OutputCache:
+    '''
+    a directory of generated outputs addressed by what they were generated
+    from, shared between working copies, branches and CI runners
+
+    entries are keyed by the master's content hash and a fingerprint of the
+    output's size, format and backend (see backends.output_fingerprint), so
+    the same master converted the same way anywhere hits the same entry.
+    Entries are restored by copying, or by hard linking when link is set.
+    Fetching an entry marks it as recently used and prune evicts the least
+    recently used entries first.
+    '''
+
+    def __init__(self, directory, max_size=None, link=False):
+        self.directory = directory
+        self.max_size = max_size
+        self.link = link
+
+    def key(self, master_hash, fingerprint):
+        return hashlib.sha1((master_hash + ':' + fingerprint).encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, 'objects', key[:2], key[2:])
+
+    def contains(self, key):
+        return os.path.isfile(self._path(key))
+
+    def fetch(self, key, file_path):
+        '''
+        write the entry for key to file_path, returning False on a miss
+        '''
+        entry = self._path(key)
+        try:
+            place(entry, file_path, self.link)
+        except (IOError, OSError):
+            return False
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+        return True
+
+    def store(self, key, file_path):
+        '''
+        add file_path to the cache as the entry for key
+        '''
+        entry = self._path(key)
+        directory = os.path.dirname(entry)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # entries appear atomically so concurrent runs never see half of one
+        handle, temp_path = tempfile.mkstemp(dir=directory)
+        os.close(handle)
+        try:
+            shutil.copyfile(file_path, temp_path)
+            # readable by whoever else shares the cache, as far as the umask
+            # allows
+            os.chmod(temp_path, NEW_FILE_MODE)
+            os.rename(temp_path, entry)
+        except (IOError, OSError):
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def entries(self):
+        '''
+        return the (last used, size, path) of every entry
+        '''
+        entries = []
+        for root, directories, files in os.walk(os.path.join(self.directory, 'objects')):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def stats(self):
+        '''
+        return the number of entries and their total size in bytes
+        '''
+        entries = self.entries()
+        return len(entries), sum([entry[1] for entry in entries])
+
+    def prune(self, max_size=None):
+        '''
+        evict the least recently used entries until the cache is no larger
+        than max_size (or the cache's own max_size) bytes
+
+        returns the number of entries removed and the bytes freed
+        '''
+        if max_size == None:
+            max_size = self.max_size
+        if max_size == None:
+            return 0, 0
+        entries = sorted(self.entries())
+        total = sum([entry[1] for entry in entries])
+        removed = 0
+        freed = 0
+        for last_used, size, path in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+            freed += size
+        return removed, freed
@@ -14,12 +14,32 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import sys, argparse, os, json, subprocess, re
+import sys, argparse, os, json, re, multiprocessing, hashlib, marshal, gc, time
+import glob, Queue, signal, threading
+from multiprocessing.pool import ThreadPool
 
-from ram import index
+from ram import index, backends, compiler, cache, timing, patterns, imageinfo
+from ram import progress
+from ram import watch as ram_watch
+from ram import worker as ram_worker
+from ram.compiler import UnboundArgException
 
 INDEX_PATH = '.ramindex'
 RAMFILE_PATH = 'ramfile.json'
+RAMFILE_CACHE_PATH = '.ramcache'
+
+# bump when the parsed ramfile classes change to invalidate old caches
+RAMFILE_CACHE_VERSION = 2
+
+# bounds the work lost if a long convert is interrupted
+INDEX_COMMIT_EVERY = 1000
+
+# seconds between commits of the masters a convert has finished, which is
+# the most work a killed convert has to redo
+JOURNAL_COMMIT_INTERVAL = 1.0
+
+# how often a running convert checks whether Ctrl-C was pressed
+INTERRUPT_POLL_INTERVAL = 0.1
 
 DEBUG = True
 
@@ -39,11 +59,16 @@ class RamArgParser(argparse.ArgumentParser):
         sys.exit(2)
 
 class SlaveConversion:
+    '''
+    an output of a master. output holds the options it is encoded with, see
+    parse_output.
+    '''
 
-    def __init__(self, path=None, width=None, height=None):
+    def __init__(self, path=None, width=None, height=None, output=None):
         self.path = path
         self.width = width
         self.height = height
+        self.output = output
 
     def __str__(self):
         return str(self.path) + ' ' + str(self.width) + 'x' + str(self.height)
@@ -53,9 +78,17 @@ class ConversionTemplate:
     def __init__(self, name=None, slave_conversions=[]):
         self.name = name
         self.slave_conversions = slave_conversions
+        self.compiled_slaves = None
 
-class UnboundArgException(Exception):
-    pass
+    def compile(self):
+        '''
+        compile the slaves' paths and sizes so populate_template does not
+        have to parse them for every conversion using this template
+
+        populate_template compiles a template the first time it is used
+        '''
+        self.compiled_slaves = [compiler.CompiledSlave(slave)
+                                for slave in self.slave_conversions]
 
 class InvalidConversionException(Exception):
     pass
@@ -74,11 +107,50 @@ class Conversion:
         self.slaves = slaves
         self.args = args
 
+# output options: the types of their values and the ranges of numbers
+OUTPUT_OPTIONS = {
+    'format': (basestring, None),
+    'quality': (int, (1, 100)),
+    'colors': (int, (2, 256)),
+    'compression': (int, (0, 9)),
+}
+
+def parse_output(json_data, defaults=None):
+    '''
+    validate the "output" options of a template or slave, added on top of
+    defaults:
+
+    format: the format to encode in, such as "webp", whatever the extension
+    quality: 1 to 100 for lossy formats such as JPEG and WebP
+    colors: quantize to a palette of at most this many colors
+    compression: the zlib level PNGs are compressed with, 0 to 9
+
+    returns the combined options, or None if there are none
+    '''
+    output = dict(defaults or {})
+    if json_data == None:
+        return output or None
+    if type(json_data) != dict:
+        raise InvalidConversionException()
+    for name, value in json_data.items():
+        if name not in OUTPUT_OPTIONS:
+            raise InvalidConversionException()
+        value_type, limits = OUTPUT_OPTIONS[name]
+        if not isinstance(value, value_type) or type(value) == bool:
+            raise InvalidConversionException()
+        if limits != None and not limits[0] <= value <= limits[1]:
+            raise InvalidConversionException()
+        if name == 'format' and not re.match('^[A-Za-z0-9]+$', value):
+            raise InvalidConversionException()
+        output[str(name)] = value
+    return output or None
+
 def parse_templates(json_data):
     templates = {}
     for template_name in json_data:
         template_data = json_data[template_name]
-        slave_conversions = parse_slaves(template_data['slaves'])
+        slave_conversions = parse_slaves(template_data['slaves'],
+                                         parse_output(template_data.get('output')))
         templates[template_name] = ConversionTemplate(
             template_name, slave_conversions)
     return templates
@@ -124,27 +196,117 @@ def parse_conversions(json_data, templates):
 
     return conversions
 
-def parse_slaves(json_data):
+def parse_slaves(json_data, output=None):
+    '''
+    parse a list of slaves. output holds the template's output options, which
+    a slave's own options add to.
+    '''
     slave_conversions = []
     for slave in json_data:
         slave_conversions.append(SlaveConversion(
                 path=slave['path'],
                 width=slave['width'],
-                height=slave['height']
+                height=slave['height'],
+                output=parse_output(slave.get('output'), output)
         ))
     return slave_conversions
 
-def add(args):
-    rows = []
-    for f in args.files:
-        relpath = os.path.relpath(f.name)
-        if relpath.startswith('..'):
-            print '%s is outside of ram managed folder' % relpath
+# rows inserted per executemany while adding
+ADD_BATCH_SIZE = 10000
+
+class PathspecException(Exception):
+    pass
+
+def match_pattern(pattern):
+    '''
+    expand a glob pattern. ** matches any number of directories, including
+    none.
+    '''
+    if '**' not in pattern:
+        return sorted(glob.glob(pattern))
+    return sorted(patterns.Pattern(pattern).files())
+
+def expand_paths(paths, recursive=False, jobs=1):
+    '''
+    expand the files, directories and patterns given to add into the files
+    to add
+
+    directories are walked if recursive is set. Explicitly named files are
+    stat'ed, on jobs threads if jobs is more than one.
+
+    raises a PathspecException if a path does not exist, is a directory
+    without recursive or a pattern matching nothing
+    '''
+    found = []
+    named = []
+    for path in paths:
+        if glob.has_magic(path) and not os.path.exists(path):
+            matches = match_pattern(path)
+            if not matches:
+                raise PathspecException('pattern %s did not match any files' %
+                                        path)
+            for match in matches:
+                if os.path.isdir(match):
+                    if recursive:
+                        found.extend(index.walk_files(match))
+                else:
+                    found.append(match)
+        else:
+            named.append(path)
+
+    def kind(path):
+        if os.path.isdir(path):
+            return 'directory'
+        if os.path.isfile(path):
+            return 'file'
+        return None
+
+    if jobs > 1 and len(named) > 1:
+        pool = ThreadPool(jobs)
+        try:
+            kinds = pool.map(kind, named)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        kinds = [kind(path) for path in named]
+
+    for path, path_kind in zip(named, kinds):
+        if path_kind == None:
+            raise PathspecException('No such file or directory: %s' % path)
+        if path_kind == 'directory':
+            if not recursive:
+                raise PathspecException('%s is a directory, use -r to add ' %
+                                        path + 'the files in it')
+            found.extend(index.walk_files(path))
         else:
-            rows.append((relpath, 0))
-        f.close()
-    file_index = index.FileIndex(INDEX_PATH)
-    file_index.add(rows)
+            found.append(path)
+    return found
+
+def add(args):
+    try:
+        paths = expand_paths(args.files, args.recursive, args.jobs)
+    except PathspecException as e:
+        sys.stderr.write('%s\n' % e)
+        sys.exit(1)
+
+    with index.FileIndex(INDEX_PATH) as file_index:
+        indexed = file_index.paths()
+        rows = []
+        seen = set()
+        skipped = 0
+        for path in paths:
+            relpath = os.path.relpath(path)
+            if relpath.startswith('..'):
+                print '%s is outside of ram managed folder' % relpath
+            elif relpath in indexed or relpath in seen:
+                skipped += 1
+            elif relpath not in (INDEX_PATH, RAMFILE_PATH, RAMFILE_CACHE_PATH):
+                seen.add(relpath)
+                rows.append((relpath, 0))
+        for start in range(0, len(rows), ADD_BATCH_SIZE):
+            file_index.add(rows[start:start + ADD_BATCH_SIZE])
+    print 'added %d files, %d already in the index' % (len(rows), skipped)
 
 def replace_args(val, args):
     matches = re.findall('\{(.+?)\}', val)
@@ -156,96 +318,1289 @@ def replace_args(val, args):
     return val
 
 def populate_template(template, args):
-    slaves = []
-    for slave in template.slave_conversions:
-        slave.path = replace_args(slave.path, args)
-        if type(slave.width) != int:
-            slave.width = replace_args(slave.width, args)
-            slave.width = eval(slave.width)
-        if type(slave.height) != int:
-            slave.height = replace_args(slave.height, args)
-            slave.height = eval(slave.height)
-        slaves.append(slave)
+    with timing.total('templates'):
+        if template.compiled_slaves == None:
+            template.compile()
+        slaves = []
+        for compiled_slave in template.compiled_slaves:
+            path, width, height = compiled_slave.resolve(args)
+            slaves.append(SlaveConversion(path=path, width=width, height=height,
+                                          output=compiled_slave.output))
     return slaves
 
-def do_conversions(conversion, verbose, dry_run):
-    if verbose:
-        print 'converting %s' % conversion.master
+def resolve_slaves(conversion, master_info=None):
+    '''
+    the slaves of a conversion with its template filled in
 
-    slaves = conversion.slaves
-    if not slaves:
-        slaves = []
+    master_info is the master's MasterInfo, which lets templates use
+    {masterwidth} and {masterheight}
+    '''
+    slaves = []
+    if conversion.slaves:
+        slaves.extend(conversion.slaves)
     if conversion.template:
-        slaves.extend(populate_template(conversion.template, conversion.args))
+        args = conversion.args
+        if master_info != None:
+            args = MasterArgs(args, master_info)
+        slaves.extend(populate_template(conversion.template, args))
+    return slaves
+
+class MasterInfo:
+    '''
+    the ImageInfo of a master, looked up the first time it is needed: from
+    the index by the master's content hash, or else from the master's
+    header, which is then recorded in the index
+    '''
+
+    def __init__(self, file_index, path, file_hash):
+        self.file_index = file_index
+        self.path = path
+        self.file_hash = file_hash
+        self.loaded = False
+        self.info = None
+
+    def get(self):
+        if not self.loaded:
+            self.loaded = True
+            self.info = self._load()
+        return self.info
+
+    def _load(self):
+        if self.file_hash != None:
+            row = self.file_index.image_info(self.file_hash)
+            if row != None:
+                return imageinfo.ImageInfo(*row)
+        with timing.total('header'):
+            info = imageinfo.read_info(self.path)
+        if info != None and self.file_hash != None:
+            self.file_index.update_image_info(self.file_hash, info.to_tuple())
+        return info
+
+class MasterArgs:
+    '''
+    a conversion's args plus {masterwidth} and {masterheight}, so the master
+    is only looked at if a template uses them. The conversion's own args
+    take precedence.
+    '''
+
+    def __init__(self, args, master_info):
+        self.args = args
+        self.master_info = master_info
+
+    def _master_arg(self, name):
+        info = self.master_info.get()
+        if info == None:
+            return None
+        if name == 'masterwidth':
+            return info.width
+        if name == 'masterheight':
+            return info.height
+        return None
+
+    def __contains__(self, name):
+        return name in self.args or self._master_arg(name) != None
+
+    def __getitem__(self, name):
+        if name in self.args:
+            return self.args[name]
+        value = self._master_arg(name)
+        if value == None:
+            raise KeyError(name)
+        return value
+
+class InterruptedConversionException(KeyboardInterrupt):
+    '''
+    raised by run_conversions on Ctrl-C once the running jobs have stopped,
+    with the masters which finished before then
+    '''
+
+    def __init__(self, succeeded, failed):
+        KeyboardInterrupt.__init__(self)
+        self.succeeded = succeeded
+        self.failed = failed
+
+class ConversionJob:
+
+    def __init__(self, master=None, slaves=None, memory=None):
+        self.master = master
+        self.slaves = slaves
+        self.memory = memory
+        self.result = None
+        self.error = None
+
+    def __str__(self):
+        return '%s --> %s' % (self.master,
+                              ', '.join([str(slave.path) for slave in self.slaves]))
+
+# bytes ImageMagick keeps per pixel at its default quantum depth of 16 bits
+# for each of four channels
+BYTES_PER_PIXEL = 8
+
+# what even a tiny conversion needs, so ImageMagick never spills it to disk
+MIN_JOB_MEMORY = 64 * 1024 * 1024
 
+def slave_pixels(slaves):
+    '''
+    the pixels of the slaves once resized, leaving out slaves whose size is
+    not a number
+    '''
+    pixels = 0
     for slave in slaves:
-        if verbose:
-            print '\t %s' % slave
+        try:
+            pixels += int(float(slave.width) * float(slave.height))
+        except (TypeError, ValueError):
+            pass
+    return pixels
+
+def estimate_memory(master_pixels, slaves):
+    '''
+    estimate the bytes converting a master of master_pixels pixels into
+    slaves needs: the decoded master plus every resized clone of it, but at
+    least MIN_JOB_MEMORY
+    '''
+    pixels = master_pixels + slave_pixels(slaves)
+    return max(MIN_JOB_MEMORY, pixels * BYTES_PER_PIXEL)
+
+def next_job(waiting, in_use, running, max_memory):
+    '''
+    pick the first waiting job which fits in the memory left, or None
+
+    a job needing more than max_memory on its own still runs once nothing
+    else is running
+    '''
+    for position, job in enumerate(waiting):
+        if (max_memory == None or running == 0 or
+            in_use + (job.memory or 0) <= max_memory):
+            return waiting.pop(position)
+    return None
+
+def run_conversions(conversions, jobs, verbose, dry_run, single_pass=True,
+                    backend=None, max_memory=None, memory=None,
+                    show_progress=False, on_success=None):
+    '''
+    convert every slave of every conversion on a pool of jobs workers
+
+    with single_pass each master is decoded once and all of its slaves are
+    written by one job, otherwise every slave is a job of its own
+
+    jobs are started in the order of conversions. With max_memory, memory
+    should be a function estimating the bytes the job converting a master
+    into some slaves needs. Jobs are then only started while the estimates
+    of the running jobs fit in max_memory, smaller jobs going ahead of ones
+    which have to wait, and the backend is asked to keep each job within
+    its estimate.
 
-        if (dry_run):
-            print 'convert -resize %sx%s %s[0] %s' % (
-                    str(slave.width),
-                    str(slave.height),
-                    str(conversion.master),
-                    str(slave.path))
-            result = 0
+    on_success is called with each master once all of its slaves converted,
+    from the thread which called run_conversions.
+
+    with show_progress a progress line counts the jobs done. On Ctrl-C no
+    more jobs are started, the backend cancels the running ones and an
+    InterruptedConversionException is raised.
+
+    returns a 2-tuple of the masters whose slaves all converted and the list
+    of failed ConversionJobs
+    '''
+    if backend == None:
+        backend = backends.get_backend()
+    pending = {}
+    waiting = []
+    for conversion in conversions:
+        slaves = resolve_slaves(conversion)
+        if single_pass and slaves:
+            groups = [slaves]
         else:
-            result = subprocess.call(
-                ['convert',
-                 '-resize',
-                 '%sx%s' % (str(slave.width), str(slave.height)),
-                 str(conversion.master) + '[0]',
-                 str(slave.path)])
-        if result != 0:
+            groups = [[slave] for slave in slaves]
+        pending[conversion.master] = len(groups)
+        for group in groups:
+            job = ConversionJob(conversion.master, group)
+            if max_memory != None and memory != None:
+                job.memory = memory(conversion.master, group)
+            waiting.append(job)
+
+    def convert_job(job):
+        job.result = backend.convert(job.master, job.slaves, dry_run,
+                                     job.memory)
+
+    def run_job(job):
+        try:
+            if not timing.enabled():
+                convert_job(job)
+                return job
+            with timing.span('convert', job.master, slaves=len(job.slaves),
+                             pixels=slave_pixels(job.slaves), memory=job.memory or 0,
+                             bytes_in=file_size(job.master)) as span:
+                convert_job(job)
+                span.args['bytes_out'] = sum([file_size(slave.path)
+                                              for slave in job.slaves])
+        except Exception as e:
+            # raised again by the dispatching thread
+            job.error = e
+        return job
+
+    succeeded = [master for master in pending if pending[master] == 0]
+    failed = []
+    failed_masters = set()
+
+    def finish(job):
+        if job.result != 0:
+            failed.append(job)
+            failed_masters.add(job.master)
             if verbose:
-                print '\t failed'
+                progress.write('failed: %s' % job, sys.stdout)
+        elif verbose:
+            progress.write('converted: %s' % job, sys.stdout)
+        pending[job.master] -= 1
+        if pending[job.master] == 0 and job.master not in failed_masters:
+            succeeded.append(job.master)
+            if on_success != None:
+                on_success(job.master)
+        progress.advance()
+
+    jobs = max(1, jobs)
+    finished = Queue.Queue()
+    running = 0
+    in_use = 0
+    # a KeyboardInterrupt raised inside Queue.get can leave the queue locked,
+    # so Ctrl-C only sets a flag which the dispatcher checks between waits
+    interrupted = []
+    previous_handler = None
+    if isinstance(threading.current_thread(), threading._MainThread):
+        previous_handler = signal.signal(signal.SIGINT,
+                lambda signum, frame: interrupted.append(signum))
+    if show_progress:
+        progress.start(len(waiting))
+    pool = ThreadPool(jobs)
+    # set when Ctrl-C is pressed again, to leave the running jobs behind
+    abandoned = False
+    try:
+        while (waiting or running) and not interrupted:
+            while running < jobs:
+                job = next_job(waiting, in_use, running, max_memory)
+                if job == None:
+                    break
+                running += 1
+                in_use += job.memory or 0
+                pool.apply_async(run_job, (job,), callback=finished.put)
+
+            try:
+                job = finished.get(True, INTERRUPT_POLL_INTERVAL)
+            except Queue.Empty:
+                continue
+            running -= 1
+            in_use -= job.memory or 0
+            if job.error != None:
+                raise job.error
+            finish(job)
+
+        if interrupted:
+            backend.cancel()
+            # jobs which finished in spite of the cancel still count, unless
+            # Ctrl-C is pressed again
+            while running:
+                if len(interrupted) > 1:
+                    abandoned = True
+                    raise KeyboardInterrupt()
+                try:
+                    job = finished.get(True, INTERRUPT_POLL_INTERVAL)
+                except Queue.Empty:
+                    continue
+                running -= 1
+                if job.error == None and job.result == 0:
+                    finish(job)
+    finally:
+        if previous_handler != None:
+            signal.signal(signal.SIGINT, previous_handler)
+        pool.close()
+        # the pool's threads are daemons, so abandoned jobs do not keep the
+        # process from exiting
+        if not abandoned:
+            pool.join()
+        if show_progress:
+            progress.stop()
+
+    if interrupted:
+        raise InterruptedConversionException(succeeded, failed)
+    return succeeded, failed
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+def refresh_row(file_index, row, current):
+    '''
+    record the new modified time of a file whose contents did not change so
+    its hash is not recomputed next time
+    '''
+    if tuple(row[1:4]) != current:
+        file_index.update(row[0], *current)
+
+def load_ramfile():
+    '''
+    parse the ramfile, returning a 2-tuple of its top level settings (such
+    as "backend") and the conversions it defines keyed by master
+
+    the parsed ramfile is cached in RAMFILE_CACHE_PATH and loaded from there
+    for as long as the ramfile's contents do not change
+    '''
+    with open(RAMFILE_PATH, 'rb') as ramfile:
+        data = ramfile.read()
+    key = hashlib.sha1('%d:' % RAMFILE_CACHE_VERSION + data).hexdigest()
+
+    # loading creates many small objects which never become garbage, so
+    # the collector only slows it down
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        with timing.span('ramfile', 'read cache'):
+            cached = read_ramfile_cache(key)
+        if cached != None:
+            return cached
+
+        with timing.span('ramfile', 'parse'):
+            json_data = json.loads(data)
+            templates = {}
+            conversions = {}
+            if 'templates' in json_data:
+                templates = parse_templates(json_data['templates'])
+            if 'conversions' in json_data:
+                conversions = parse_conversions(json_data['conversions'],
+                                                templates)
+            settings = dict([(name, json_data[name]) for name in json_data
+                             if name not in ('templates', 'conversions')])
+    finally:
+        if gc_enabled:
+            gc.enable()
+    write_ramfile_cache(key, settings, templates, conversions)
+    return settings, conversions
+
+def pattern_conversion(conversion):
+    '''
+    the conversion of a pattern master with its own slaves moved into its
+    template, ahead of the template's slaves as resolve_slaves orders them
+    '''
+    if not conversion.slaves:
+        return conversion
+    slaves = list(conversion.slaves)
+    if conversion.template != None:
+        slaves.extend(conversion.template.slave_conversions)
+    return Conversion(master=conversion.master,
+                      template=ConversionTemplate(conversion.master, slaves),
+                      args=conversion.args)
+
+class ConversionSet:
+    '''
+    the conversions of the ramfile keyed by master, where the conversions
+    whose master is a glob pattern apply to every file the pattern matches
+
+    a pattern's conversion for a file is only made when that file is looked
+    up, and iterating lists the matching files as it goes, so a pattern
+    matching thousands of files costs no memory up front. A master named
+    explicitly keeps its own conversion, and a file matching several
+    patterns gets the first one's.
+
+    the conversion for a match gets {stem} and {ext} arguments, such as
+    "home" and "svg" for icons/home.svg, and {name}, its file name, unless
+    the conversion sets them itself. A pattern's own slaves are filled in
+    with them like its template's, since every match needs its own outputs.
+    '''
+
+    def __init__(self, conversions):
+        self.explicit = {}
+        self.patterns = []
+        for master in sorted(conversions):
+            if patterns.is_pattern(master):
+                self.patterns.append((patterns.Pattern(master),
+                                      pattern_conversion(conversions[master])))
             else:
-                print 'failed: %s --> %s' % (conversion.master, slave.path)
-            return False
+                self.explicit[master] = conversions[master]
+
+    def _pattern_for(self, master):
+        for pattern, conversion in self.patterns:
+            if pattern.match(master):
+                return conversion
+        return None
+
+    def _expand(self, master, conversion):
+        stem, ext = os.path.splitext(os.path.basename(master))
+        args = {'name': os.path.basename(master), 'stem': stem,
+                'ext': ext[1:]}
+        args.update(conversion.args)
+        args['master'] = master
+        return Conversion(master=master, template=conversion.template,
+                          slaves=conversion.slaves, args=args)
+
+    def get(self, master, default=None):
+        if master in self.explicit:
+            return self.explicit[master]
+        conversion = self._pattern_for(master)
+        if conversion == None:
+            return default
+        return self._expand(master, conversion)
+
+    def __getitem__(self, master):
+        conversion = self.get(master)
+        if conversion == None:
+            raise KeyError(master)
+        return conversion
+
+    def __contains__(self, master):
+        return master in self.explicit or self._pattern_for(master) != None
+
+    def __iter__(self):
+        '''
+        yield every master, listing the files matching the patterns lazily
+        '''
+        for master in sorted(self.explicit):
+            yield master
+        for position, (pattern, conversion) in enumerate(self.patterns):
+            for master in pattern.files():
+                if master in self.explicit:
+                    continue
+                # a file matching an earlier pattern was already listed
+                if any([earlier.match(master)
+                        for earlier, _ in self.patterns[:position]]):
+                    continue
+                yield master
+
+def sync_index(file_index, conversions):
+    '''
+    make the masters in the index the masters of the ramfile's conversions,
+    adding new masters and removing masters the ramfile no longer converts
+
+    rows of masters in both are left alone
+    '''
+    indexed = file_index.paths()
+    added = [(master, 0) for master in conversions if master not in indexed]
+    removed = [path for path in indexed if path not in conversions]
+    for start in range(0, len(added), ADD_BATCH_SIZE):
+        file_index.add(added[start:start + ADD_BATCH_SIZE])
+    for path in removed:
+        file_index.remove(path)
+    return len(added), len(removed)
+
+def slave_tuples(slaves):
+    return [(slave.path, slave.width, slave.height, slave.output)
+            for slave in slaves]
+
+def read_ramfile_cache(key):
+    '''
+    return the cached (settings, conversions) of the ramfile whose cache key
+    is key, or None if there is no such cache
+    '''
+    try:
+        with open(RAMFILE_CACHE_PATH, 'rb') as cache:
+            # the key is stored on its own so a stale cache is rejected
+            # without loading the conversions
+            if marshal.load(cache) != key:
+                return None
+            settings, template_rows, conversion_rows = marshal.load(cache)
+    except Exception:
+        return None
+
+    templates = {}
+    for name in template_rows:
+        templates[name] = ConversionTemplate(name, [
+                SlaveConversion(*slave) for slave in template_rows[name]])
+    conversions = {}
+    for master, template_name, slaves, args in conversion_rows:
+        if slaves != None:
+            slaves = [SlaveConversion(*slave) for slave in slaves]
+        conversions[master] = Conversion(master, templates.get(template_name),
+                                         slaves, args)
+    return settings, conversions
+
+def write_ramfile_cache(key, settings, templates, conversions):
+    '''
+    store the parsed ramfile as plain tuples, which marshal loads far faster
+    than the ramfile's json can be parsed and validated
+    '''
+    template_rows = dict([(name, slave_tuples(templates[name].slave_conversions))
+                          for name in templates])
+    conversion_rows = []
+    for conversion in conversions.itervalues():
+        template_name = None
+        if conversion.template:
+            template_name = conversion.template.name
+        slaves = None
+        if conversion.slaves != None:
+            slaves = slave_tuples(conversion.slaves)
+        conversion_rows.append((conversion.master, template_name, slaves,
+                                conversion.args))
+
+    temp_path = RAMFILE_CACHE_PATH + '.tmp'
+    try:
+        with open(temp_path, 'wb') as cache:
+            marshal.dump(key, cache)
+            marshal.dump((settings, template_rows, conversion_rows), cache)
+        os.rename(temp_path, RAMFILE_CACHE_PATH)
+    except (IOError, OSError, ValueError):
+        # the cache only saves time, ram works the same without it
+        pass
+
+def output_state(output, master, rule, stat_cache=None):
+    '''
+    compare an outputs row with the master and rule fingerprint which should
+    generate it
+
+    returns CURRENT if the output was generated by that rule and is unchanged
+    on disk, MODIFIED if it has to be generated again
+    '''
+    if output == None or output[1] != master or output[2] != rule:
+        return index.MODIFIED
+    state, current = index.check((output[0],) + tuple(output[3:6]), stat_cache)
+    if state == index.CURRENT:
+        return index.CURRENT
+    return index.MODIFIED
+
+def output_row(slave, master, rule):
+    '''
+    describe a freshly written slave as an outputs row, or None if the
+    backend did not write it
+    '''
+    try:
+        stat = os.stat(slave.path)
+    except OSError:
+        return None
+    with timing.total('hash'):
+        file_hash = index.file_digest(slave.path)
+    return (slave.path, master, rule, stat.st_mtime, stat.st_size, file_hash)
+
+class Plan:
+    '''
+    everything a convert will do, worked out from the index and the ramfile
+    before anything is converted
+    '''
+
+    def __init__(self):
+        # Conversions of the masters to convert, holding only the slaves
+        # which have to be converted
+        self.conversions = []
+        # (master, slave, cache key) of slaves restored from the output cache
+        self.restores = []
+        # (master, slave, original path) of slaves copied from an identical
+        # output converted in the same run
+        self.duplicates = []
+        # masters whose outputs are all up to date
+        self.current = []
+        # masters deleted from disk
+        self.missing = []
+        # modified masters which no conversion in the ramfile applies to
+        self.unconfigured = []
+        # (master, error) of masters whose outputs could not be worked out,
+        # such as a template using {masterwidth} on an unreadable master
+        self.unresolved = []
+        # master -> (modified, size, hash) of modified masters
+        self.file_states = {}
+        # master -> content hash of every master with conversions
+        self.master_hashes = {}
+        # master -> size in bytes
+        self.sizes = {}
+        # master -> pixels of the masters to convert, read from their headers
+        self.pixels = {}
+        # slave path -> (master, rule fingerprint) of every slave in the ramfile
+        self.rules = {}
+        # slave path -> output cache key of slaves to store once converted
+        self.cache_keys = {}
+        # recorded outputs which no conversion in the ramfile generates
+        self.orphans = []
+
+    def is_empty(self):
+        return not self.conversions and not self.restores
 
-    return True
+    def cost(self, conversion):
+        return estimate_cost(self.sizes.get(conversion.master, 0),
+                             conversion.slaves)
+
+    def memory(self, master, slaves):
+        '''
+        estimate the bytes converting master into slaves needs. Masters whose
+        header could not be read are assumed to have a pixel per byte.
+        '''
+        return estimate_memory(self.pixels.get(master, self.sizes.get(master, 0)),
+                               slaves)
+
+    def total_cost(self):
+        return sum([self.cost(conversion) for conversion in self.conversions])
+
+    def ordered(self):
+        '''
+        the conversions largest first, so the longest jobs do not start last
+        and leave the other workers idle
+        '''
+        return sorted(self.conversions, key=self.cost, reverse=True)
+
+def estimate_cost(master_size, slaves):
+    '''
+    roughly how much work a conversion is, as the bytes of the master read
+    plus the bytes of the RGBA pixels written to its slaves
+    '''
+    return master_size + slave_pixels(slaves) * 4
+
+def plan_conversions(file_index, rows, conversions, backend, output_cache=None,
+                     masters=None):
+    '''
+    compare the index rows of masters and the recorded outputs with the files
+    on disk and the ramfile's conversions, returning the Plan which brings
+    every output up to date
+
+    masters should name the masters of rows if they are not the whole index
+    '''
+    with timing.span('index', 'outputs'):
+        if masters == None:
+            outputs = file_index.outputs()
+        else:
+            outputs = file_index.outputs(masters)
+        outputs = dict([(output[0], output) for output in outputs])
+
+    plan = Plan()
+    for row in rows:
+        master = row[0]
+        with timing.total('stat'):
+            state, current = index.check(row)
+        if state == index.MISSING:
+            plan.missing.append(master)
+            continue
+        if state == index.CURRENT:
+            refresh_row(file_index, row, current)
+        if master not in conversions:
+            if state == index.MODIFIED:
+                plan.unconfigured.append(master)
+            continue
+
+        if state == index.MODIFIED:
+            if current[2] == None:
+                # the master's hash identifies its outputs in the cache and
+                # among duplicates, and its image info in the index
+                with timing.total('hash'):
+                    current = current[:2] + (index.file_digest(master),)
+            plan.file_states[master] = current
+        master_info = MasterInfo(file_index, master, current[2])
+        try:
+            slaves = resolve_slaves(conversions[master], master_info)
+        except UnboundArgException as e:
+            # left out of the plan and the index, so it is tried again
+            plan.file_states.pop(master, None)
+            plan.unresolved.append((master, e))
+            continue
+
+        stale = []
+        for slave in slaves:
+            rule = backends.rule_fingerprint(slave, backend)
+            plan.rules[slave.path] = (master, rule)
+            if (state == index.MODIFIED or
+                output_state(outputs.get(slave.path), master, rule) != index.CURRENT):
+                stale.append(slave)
+        plan.master_hashes[master] = current[2]
+        plan.sizes[master] = current[1]
+        if output_cache != None and stale:
+            missed = []
+            for slave in stale:
+                key = output_cache.key(
+                        current[2], backends.output_fingerprint(slave, backend))
+                if output_cache.contains(key):
+                    plan.restores.append((master, slave, key))
+                else:
+                    plan.cache_keys[slave.path] = key
+                    missed.append(slave)
+            stale = missed
+        if stale:
+            info = master_info.get()
+            if info != None:
+                plan.pixels[master] = info.pixels()
+        if stale or state == index.MODIFIED:
+            plan.conversions.append(Conversion(master=master, slaves=stale))
+        else:
+            plan.current.append(master)
+
+    plan.duplicates = remove_duplicates(plan.conversions, plan.master_hashes,
+                                        backend)
+    for master, slave, original in plan.duplicates:
+        plan.cache_keys.pop(slave.path, None)
+    if masters == None:
+        # the outputs of unresolved masters are still generated by them
+        unresolved = set([master for master, error in plan.unresolved])
+        plan.orphans = [path for path in outputs if path not in plan.rules and
+                        outputs[path][1] not in unresolved]
+    return plan
+
+def print_plan(plan, show_cost=False):
+    for conversion in plan.ordered():
+        if not conversion.slaves:
+            continue
+        if show_cost:
+            print 'convert %s (~%s)' % (conversion.master,
+                                       format_size(plan.cost(conversion)))
+        else:
+            print 'convert %s' % conversion.master
+        for slave in conversion.slaves:
+            print '\t %s' % slave
+    for master, slave, key in plan.restores:
+        print 'restore %s from the cache' % slave.path
+    for master, slave, original in plan.duplicates:
+        print 'copy %s to %s' % (original, slave.path)
+    for master in plan.missing:
+        print 'skip %s: file deleted' % master
+
+    converted = sum([len(conversion.slaves) for conversion in plan.conversions])
+    summary = '%d outputs to convert, %d to restore, %d to copy, ' \
+              '%d masters up to date' % (converted, len(plan.restores),
+                                         len(plan.duplicates), len(plan.current))
+    print summary
+    if show_cost:
+        print 'estimated cost: %s' % format_size(plan.total_cost())
+
+def shard_plan(plan, number, count):
+    '''
+    keep only the share of the plan's work which shard number of count does
+
+    a master's conversion, restores and copies stay together, along with
+    the masters whose outputs are copies of its outputs. These groups are
+    handed out largest first, each to the shard with the least work so far,
+    so every shard computes the same split from the same plan.
+
+    returns the masters kept
+    '''
+    # union the masters whose outputs depend on each other
+    parents = {}
+    def find(master):
+        parents.setdefault(master, master)
+        while parents[master] != master:
+            parents[master] = parents[parents[master]]
+            master = parents[master]
+        return master
+
+    weights = {}
+    for conversion in plan.conversions:
+        find(conversion.master)
+        weights[conversion.master] = plan.cost(conversion)
+    for master, slave, key in plan.restores:
+        find(master)
+        weights[master] = weights.get(master, 0) + estimate_cost(0, [slave])
+    for master, slave, original in plan.duplicates:
+        parents[find(master)] = find(plan.rules[original][0])
+        weights[master] = weights.get(master, 0) + estimate_cost(0, [slave])
+
+    groups = {}
+    for master in parents:
+        groups.setdefault(find(master), []).append(master)
+    groups = groups.values()
+    for group in groups:
+        group.sort()
+    groups.sort(key=lambda group: (-sum([weights.get(master, 0)
+                                         for master in group]),
+                                   hashlib.sha1(group[0].encode('utf-8')).hexdigest()))
+
+    loads = [0] * count
+    kept = set()
+    for group in groups:
+        shard = loads.index(min(loads))
+        loads[shard] += sum([weights.get(master, 0) for master in group])
+        if shard == number - 1:
+            kept.update(group)
+
+    plan.conversions = [conversion for conversion in plan.conversions
+                        if conversion.master in kept]
+    plan.restores = [restore for restore in plan.restores
+                     if restore[0] in kept]
+    plan.duplicates = [duplicate for duplicate in plan.duplicates
+                       if duplicate[0] in kept]
+    return kept
+
+def parse_shard(value):
+    '''
+    parse a shard such as 2/4 into (2, 4)
+    '''
+    match = re.match('^(\d+)/(\d+)$', value)
+    if not match or not 1 <= int(match.group(1)) <= int(match.group(2)):
+        raise argparse.ArgumentTypeError('invalid shard: %s' % value)
+    return int(match.group(1)), int(match.group(2))
+
+def master_row(plan, master):
+    '''
+    the files row recording that master was converted, or None if the plan
+    did not find it modified
+    '''
+    if master not in plan.file_states:
+        return None
+    modified, size, file_hash = plan.file_states[master]
+    if file_hash == None:
+        with timing.total('hash'):
+            file_hash = index.file_digest(master)
+    return (master, modified, size, file_hash)
+
+def execute_plan(args, file_index, plan, backend, output_cache=None,
+                 jobs=None):
+    '''
+    carry out a plan and record the outputs written and masters converted in
+    file_index, running jobs conversions at once or args.jobs
+
+    each master is recorded as soon as it is converted and the journal in
+    the index keeps the masters which are not, so a convert which is killed
+    resumes with what is left
+    '''
+    restored = []
+    for master, slave, key in plan.restores:
+        if output_cache.fetch(key, slave.path):
+            restored.append(slave)
+            continue
+        # the entry was pruned since the plan was made
+        plan.cache_keys[slave.path] = key
+        for conversion in plan.conversions:
+            if conversion.master == master:
+                conversion.slaves.append(slave)
+                break
+        else:
+            plan.conversions.append(Conversion(master=master, slaves=[slave]))
+
+    left = set(file_index.journal())
+    if left:
+        print 'resuming a convert which stopped with %d masters left' % len(left)
+        for conversion in plan.conversions:
+            if conversion.master in left:
+                for slave in conversion.slaves:
+                    cache.remove_temporary_files(str(slave.path))
+    masters = set([conversion.master for conversion in plan.conversions])
+    masters.update([restore[0] for restore in plan.restores])
+    masters.update([duplicate[0] for duplicate in plan.duplicates])
+    file_index.start_journal(masters)
+
+    slaves_of = {}
+    for conversion in plan.conversions:
+        slaves_of[conversion.master] = list(conversion.slaves)
+    for slave in restored:
+        slaves_of.setdefault(plan.rules[slave.path][0], []).append(slave)
+    # masters with copies are recorded once the copies are made
+    copying = set([duplicate[0] for duplicate in plan.duplicates])
+    recorded = set()
+    # masters whose backend reported success without writing every output,
+    # which are left for the next run to convert again
+    incomplete = set()
+    last_commit = [time.time()]
+
+    def record(master):
+        if master in copying:
+            return
+        rows = [output_row(slave, *plan.rules[slave.path])
+                for slave in slaves_of.get(master, [])]
+        if None in rows:
+            incomplete.add(master)
+            return
+        with timing.total('index'):
+            file_index.update_outputs(rows)
+            row = master_row(plan, master)
+            if row != None:
+                file_index.update_many([row])
+            file_index.finish_journal([master])
+            recorded.add(master)
+            if time.time() - last_commit[0] >= JOURNAL_COMMIT_INTERVAL:
+                file_index.commit()
+                last_commit[0] = time.time()
+
+    interrupted = None
+    failed_paths = set()
+    try:
+        succeeded, failed = run_conversions(
+                plan.ordered(), jobs or args.jobs, args.verbose, False,
+                single_pass=not args.per_slave, backend=backend,
+                max_memory=args.max_memory, memory=plan.memory,
+                show_progress=True, on_success=record)
+    except InterruptedConversionException as e:
+        interrupted = e
+        succeeded, failed = e.succeeded, e.failed
+        # what the unfinished masters wrote is never recorded, so the next
+        # run converts them again
+        for conversion in plan.conversions:
+            if conversion.master not in succeeded:
+                failed_paths.update([slave.path for slave in conversion.slaves])
+    for job in failed:
+        failed_paths.update([slave.path for slave in job.slaves])
+    failed_paths.update(copy_duplicates(plan.duplicates, failed_paths))
+    for master, slave, original in plan.duplicates:
+        if slave.path in failed_paths and master in succeeded:
+            succeeded.remove(master)
+
+    written = list(restored)
+    for conversion in plan.conversions:
+        for slave in conversion.slaves:
+            if slave.path not in failed_paths:
+                written.append(slave)
+    for master, slave, original in plan.duplicates:
+        if slave.path not in failed_paths:
+            written.append(slave)
+    output_rows = []
+    for slave in written:
+        master, rule = plan.rules[slave.path]
+        if master in recorded:
+            continue
+        row = output_row(slave, master, rule)
+        if row != None:
+            output_rows.append(row)
+        else:
+            incomplete.add(master)
+    with timing.span('index', 'update outputs', rows=len(output_rows)):
+        file_index.update_outputs(output_rows)
+    if plan.cache_keys:
+        with timing.span('cache', 'store'):
+            store_outputs(output_cache, written, plan.cache_keys)
+
+    master_rows = []
+    for master in succeeded:
+        if master not in recorded and master not in incomplete:
+            row = master_row(plan, master)
+            if row != None:
+                master_rows.append(row)
+    with timing.span('index', 'update masters', rows=len(master_rows)):
+        file_index.update_many(master_rows)
+        file_index.remove_outputs(plan.orphans)
+        if interrupted != None:
+            file_index.finish_journal(succeeded +
+                                      [job.master for job in failed])
+        else:
+            file_index.finish_journal()
+
+    for job in failed:
+        print 'failed: %s' % job
+    for master in sorted(incomplete):
+        print 'warning: %s converted without writing every output' % master
+    if restored:
+        print 'restored %d outputs from the cache' % len(restored)
+    if plan.duplicates:
+        print 'saved %d conversions by copying identical outputs' % \
+              len(plan.duplicates)
+    print 'successfully converted %d master files' % len(succeeded)
+    if failed:
+        print '%d conversions failed' % len(failed)
+    if interrupted != None:
+        raise interrupted
 
 def convert(args):
-    # 2-tuple of filename and modified time
-    files_to_convert = []
+    timer = None
+    if args.profile:
+        timer = timing.start()
+    try:
+        with index.FileIndex(args.index or INDEX_PATH,
+                             commit_every=INDEX_COMMIT_EVERY) as file_index:
+            convert_index(args, file_index)
+            with timing.span('index', 'commit'):
+                file_index.commit()
+    finally:
+        if timer != None:
+            timing.stop()
+            print_profile(timer)
+            if args.profile != True:
+                timer.write_trace(args.profile)
+                print 'wrote trace to %s' % args.profile
+
+PROFILE_CATEGORIES = ['ramfile', 'index', 'plan', 'stat', 'hash', 'header',
+                      'templates', 'convert', 'cache']
+
+def print_profile(timer, slowest=10):
+    '''
+    summarize where the time of a profiled convert went
+    '''
+    print 'profile:'
+    for category in PROFILE_CATEGORIES:
+        if category not in timer.totals:
+            continue
+        seconds, calls = timer.totals[category]
+        line = '  %-10s %9.3fs %8d calls' % (category, seconds, calls)
+        if category == 'convert':
+            line += ', %s in, %s out, %.1f Mpx' % (
+                    format_size(timer.sum_arg('convert', 'bytes_in')),
+                    format_size(timer.sum_arg('convert', 'bytes_out')),
+                    timer.sum_arg('convert', 'pixels') / 1000000.0)
+        print line
+    print '  %-10s %9.3fs' % ('wall', time.time() - timer.started)
+    if 'convert' in timer.totals:
+        # jobs run in parallel so their sum can exceed the wall time
+        print 'slowest masters:'
+        for event in timer.slowest('convert', slowest):
+            print '  %9.3fs %s' % (event[3], event[1])
+
+def convert_index(args, file_index, ramfile=None, masters=None):
+    '''
+    convert the masters in file_index whose outputs are out of date
 
-    file_index = index.FileIndex(INDEX_PATH)
-    for row in file_index.all():
-        filename = row[0]
-        timestamp = row[1]
-        if os.path.exists(filename) and timestamp < os.path.getmtime(filename):
-            files_to_convert.append((filename, os.path.getmtime(filename)))
+    ramfile is the (settings, conversions) tuple from load_ramfile, which is
+    loaded if it is not given. If masters is given only those masters are
+    looked at, otherwise the whole index is.
+    '''
+    if ramfile == None:
+        ramfile = load_ramfile()
+    settings, conversions = ramfile
+    conversions = ConversionSet(conversions)
+    if masters == None and settings.get('discover'):
+        with timing.span('index', 'sync'):
+            sync_index(file_index, conversions)
 
-    if not files_to_convert:
+    with timing.span('index', 'read masters'):
+        if masters == None:
+            rows = file_index.all()
+        else:
+            rows = file_index.get(masters)
+    if not rows:
         print 'Nothing to convert.'
-        print 'Maybe you need to add files with "ram add <file> ..."?'
+        if masters == None:
+            print 'Maybe you need to add files with "ram add <file> ..."?'
+        return
+
+    backend = backends.get_backend(args.backend or settings.get('backend'))
+    output_cache = open_output_cache(args, settings)
+    with timing.span('plan', 'plan', masters=len(rows)):
+        plan = plan_conversions(file_index, rows, conversions, backend,
+                                output_cache, masters)
+    for master in plan.unconfigured:
+        print 'warning: no conversion stragegy found for %s' % master
+    for master, error in plan.unresolved:
+        print 'warning: skipping %s: %s' % (master, error)
+    if args.shard != None:
+        kept = shard_plan(plan, *args.shard)
+        print 'shard %d/%d: %d masters' % (args.shard + (len(kept),))
+
+    if plan.is_empty():
+        print 'Nothing to convert.'
+    elif args.dry_run:
+        print_plan(plan, args.explain)
     else:
-        with open(RAMFILE_PATH, 'r') as ramfile:
-            json_data = json.loads(ramfile.read())
-
-        templates = {}
-        conversions = {}
-        if 'templates' in json_data:
-            templates = parse_templates(json_data['templates'])
-        if 'conversions' in json_data:
-            conversions = parse_conversions(json_data['conversions'], templates)
-
-        success_count = 0
-        for f in files_to_convert:
-            if f[0] not in conversions:
-                print 'warning: no conversion stragegy found for %s' % f[0]
+        if args.explain:
+            print_plan(plan, True)
+        if not args.workers:
+            execute_plan(args, file_index, plan, backend, output_cache)
+            return
+        pool = ram_worker.WorkerPool(args.workers, backend,
+                                     os.environ.get('RAM_WORKER_TOKEN'))
+        try:
+            execute_plan(args, file_index, plan, pool, output_cache,
+                         pool.jobs())
+        finally:
+            pool.close()
+
+def parse_workers(value):
+    '''
+    parse a comma separated list of host:port addresses and unix socket paths
+    '''
+    return [ram_worker.parse_address(address)
+            for address in value.split(',') if address]
+
+def worker(args):
+    settings = {}
+    if os.path.isfile(RAMFILE_PATH):
+        settings = load_ramfile()[0]
+    backend = backends.get_backend(args.backend or settings.get('backend'))
+    server = ram_worker.create_server(args.address, backend, args.jobs,
+                                      os.environ.get('RAM_WORKER_TOKEN'))
+    print 'converting with %s, %d jobs at once, on %s' % (
+            backend.name, args.jobs, ram_worker.describe(args.address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print 'stopped'
+    finally:
+        server.server_close()
+
+def merge_index(args):
+    with index.FileIndex(INDEX_PATH) as file_index:
+        changed, removed = file_index.merge(args.shards)
+    print 'merged %d shard indexes: %d rows changed, %d removed' % (
+            len(args.shards), changed, removed)
+
+def plan_cmd(args):
+    with index.FileIndex(INDEX_PATH) as file_index:
+        settings, conversions = load_ramfile()
+        conversions = ConversionSet(conversions)
+        if settings.get('discover'):
+            sync_index(file_index, conversions)
+        rows = file_index.all()
+        backend = backends.get_backend(args.backend or settings.get('backend'))
+        output_cache = open_output_cache(args, settings)
+        plan = plan_conversions(file_index, rows, conversions, backend,
+                                output_cache)
+    for master in plan.unconfigured:
+        print 'warning: no conversion stragegy found for %s' % master
+    for master, error in plan.unresolved:
+        print 'warning: skipping %s: %s' % (master, error)
+    print_plan(plan, True)
+
+def remove_duplicates(conversions, master_hashes, backend):
+    '''
+    drop slaves which would come out identical to another slave in the run,
+    because their masters have the same contents and they are converted to
+    the same size and format
+
+    returns (master, slave, original path) tuples for the slaves dropped,
+    which should be copied from the original's output once it is written
+    '''
+    originals = {}
+    duplicates = []
+    for conversion in conversions:
+        master_hash = master_hashes.get(conversion.master)
+        if master_hash == None:
+            continue
+        unique = []
+        for slave in conversion.slaves:
+            key = (master_hash, backends.output_fingerprint(slave, backend))
+            if key in originals:
+                duplicates.append((conversion.master, slave, originals[key]))
             else:
-                success = do_conversions(conversions[f[0]], args.verbose, args.dry_run)
-                if success:
-                    if not args.dry_run:
-                        file_index.update(f[0], f[1])
-                    success_count += 1
+                originals[key] = slave.path
+                unique.append(slave)
+        conversion.slaves = unique
+    return duplicates
+
+def copy_duplicates(duplicates, failed_paths):
+    '''
+    copy each original's output to its duplicates
+
+    returns the paths of the duplicates which could not be written
+    '''
+    failed = set()
+    for master, slave, original in duplicates:
+        if original in failed_paths:
+            failed.add(slave.path)
+            continue
+        try:
+            cache.place(original, slave.path)
+        except (IOError, OSError) as e:
+            print 'failed: copying %s to %s: %s' % (original, slave.path, e)
+            failed.add(slave.path)
+    return failed
 
-        print 'successfully converted %d master files' % success_count
+def store_outputs(output_cache, slaves, cache_keys):
+    for slave in slaves:
+        if slave.path in cache_keys:
+            try:
+                output_cache.store(cache_keys[slave.path], slave.path)
+            except (IOError, OSError) as e:
+                print 'warning: could not cache %s: %s' % (slave.path, e)
+    output_cache.prune()
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+def parse_size(value):
+    '''
+    parse a size in bytes such as 512M or 8G
+    '''
+    if isinstance(value, (int, long, float)):
+        return int(value)
+    match = re.match('^\s*([0-9.]+)\s*([KMGT]?)B?\s*$', value.upper())
+    if not match:
+        raise ValueError('invalid size: %s' % value)
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2)])
+
+def format_size(size):
+    for unit in ['', 'K', 'M', 'G']:
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'T'
+    if unit == '':
+        return '%d bytes' % size
+    return '%.1f%sB' % (size, unit)
+
+def open_output_cache(args, settings):
+    '''
+    return the output cache set by --cache-dir, $RAM_CACHE_DIR or the
+    ramfile's "cache" setting, or None if no cache is configured
+
+    the ramfile setting is either the cache directory or an object with a
+    "path" and optionally a "max_size" such as "2G" and "link": true to hard
+    link outputs instead of copying them
+    '''
+    config = settings.get('cache') or {}
+    if not isinstance(config, dict):
+        config = {'path': config}
+    directory = (getattr(args, 'cache_dir', None) or
+                 os.environ.get('RAM_CACHE_DIR') or
+                 config.get('path'))
+    if not directory:
+        return None
+    max_size = config.get('max_size')
+    if max_size != None:
+        max_size = parse_size(max_size)
+    return cache.OutputCache(os.path.expanduser(directory), max_size,
+                             config.get('link', False))
+
+def cache_cmd(args):
+    settings = {}
+    if os.path.exists(RAMFILE_PATH):
+        settings = load_ramfile()[0]
+    output_cache = open_output_cache(args, settings)
+    if output_cache == None:
+        sys.stderr.write('no output cache configured. Use --cache-dir, ' +
+                         'RAM_CACHE_DIR or "cache" in the ramfile.\n')
+        sys.exit(1)
+
+    if args.action == 'stats':
+        entries, size = output_cache.stats()
+        print 'cache: %s' % os.path.abspath(output_cache.directory)
+        print 'entries: %d' % entries
+        print 'size: %s' % format_size(size)
+        if output_cache.max_size != None:
+            print 'max size: %s' % format_size(output_cache.max_size)
+    elif args.action == 'prune':
+        max_size = args.max_size
+        if max_size == None:
+            max_size = output_cache.max_size
+        if max_size == None:
+            sys.stderr.write('no max size configured. Use --max-size or ' +
+                             '"max_size" in the ramfile cache setting.\n')
+            sys.exit(1)
+        removed, freed = output_cache.prune(max_size)
+        print 'removed %d entries, freed %s' % (removed, format_size(freed))
+
+def watch(args):
+    with index.FileIndex(INDEX_PATH,
+                         commit_every=INDEX_COMMIT_EVERY) as file_index:
+        ramfile = watch_convert(args, file_index)
+
+        watcher = ram_watch.create_watcher(watched_paths(file_index),
+                                           args.interval)
+        print 'watching for changes, press Ctrl-C to stop'
+        try:
+            while True:
+                changed = watcher.changes(args.delay)
+                if os.path.normpath(RAMFILE_PATH) in changed:
+                    # any rule may have changed, so every master is checked
+                    ramfile = watch_convert(args, file_index)
+                else:
+                    ramfile = watch_convert(args, file_index, ramfile, changed)
+                # masters may have been added or removed by other commands
+                watcher.watch(watched_paths(file_index))
+        except KeyboardInterrupt:
+            print 'stopped watching'
+        finally:
+            watcher.close()
+
+def watch_convert(args, file_index, ramfile=None, masters=None):
+    '''
+    convert_index for watch, loading the ramfile if it is None and then
+    looking at every master. Errors, such as a ramfile saved half written or
+    a master which cannot be read, are printed instead of raised so watch
+    carries on with the next change.
+
+    returns the ramfile, or None if it could not be loaded
+    '''
+    try:
+        if ramfile == None:
+            ramfile = load_ramfile()
+            masters = None
+        convert_index(args, file_index, ramfile, masters=masters)
+        file_index.commit()
+    except Exception as e:
+        print 'error: %s' % (str(e) or type(e).__name__)
+    return ramfile
+
+def watched_paths(file_index):
+    return [row[0] for row in file_index.iter_all()] + [RAMFILE_PATH]
 
 def help_cmd(args):
     if (args.command == 'add'):
         add_parser.print_help()
+    elif (args.command == 'cache'):
+        cache_parser.print_help()
     elif (args.command == 'convert'):
         convert_parser.print_help()
     elif (args.command == 'help'):
@@ -254,10 +1609,18 @@ def help_cmd(args):
         init_parser.print_help()
     elif (args.command == 'ls'):
         ls_parser.print_help()
+    elif (args.command == 'merge-index'):
+        merge_index_parser.print_help()
+    elif (args.command == 'plan'):
+        plan_parser.print_help()
     elif (args.command == 'rm'):
         rm_parser.print_help()
     elif (args.command == 'status'):
         status_parser.print_help()
+    elif (args.command == 'watch'):
+        watch_parser.print_help()
+    elif (args.command == 'worker'):
+        worker_parser.print_help()
     else:
         print 'no such command: ' + args.command
 
@@ -268,35 +1631,87 @@ def init(args):
     else:
         file_index = index.FileIndex(INDEX_PATH)
         file_index.init()
+        file_index.close()
         print 'created ram index: %s' % os.path.abspath(INDEX_PATH)
 
 def ls(args):
-    file_index = index.FileIndex(INDEX_PATH)
-    for row in file_index.all():
-        print row
+    with index.FileIndex(INDEX_PATH) as file_index:
+        for row in file_index.iter_all():
+            print row
 
 def status(args):
-    file_index = index.FileIndex(INDEX_PATH)
-    modified = []
-    missing = []
-    current = []
-    for row in file_index.all():
-        filename = row[0]
-        mtime = row[1]
-        if os.path.exists(filename):
-            if os.path.getmtime(filename) == mtime:
-                current.append(filename)
-            else:
-                modified.append(filename)
-        else:
-            missing.append(filename)
-    print_status(current, modified, missing, args.all)
+    with index.FileIndex(INDEX_PATH) as file_index:
+        if args.porcelain:
+            for state, filename in scan_status(file_index):
+                if state != index.CURRENT or args.all:
+                    print '%s %s' % (PORCELAIN_CODES[state], filename)
+            return
+
+        files = {
+            index.CURRENT: [],
+            index.MODIFIED: [],
+            index.MISSING: [],
+            index.STALE: [],
+        }
+        for state, filename in scan_status(file_index):
+            files[state].append(filename)
+        print_status(files[index.CURRENT], files[index.MODIFIED],
+                     files[index.MISSING], args.all, files[index.STALE])
+
+PORCELAIN_CODES = {
+    index.CURRENT: 'C',
+    index.MODIFIED: 'M',
+    index.MISSING: 'D',
+    index.STALE: 'S',
+}
 
-def print_status(current, modified, missing, show_current):
+def scan_status(file_index):
+    '''
+    compare the masters in the index, and the outputs of unchanged masters,
+    with the files on disk
+
+    yields (state, path) pairs while the index is read, where state is
+    CURRENT, MODIFIED or MISSING for a master and STALE for an output which
+    was deleted, edited or is now generated by a different rule
+    '''
+    conversions = {}
+    if os.path.exists(RAMFILE_PATH):
+        settings, conversions = load_ramfile()
+        conversions = ConversionSet(conversions)
+        if settings.get('discover'):
+            sync_index(file_index, conversions)
+        backend = backends.get_backend(settings.get('backend'))
+
+    stat_cache = index.StatCache()
+    for row in file_index.iter_all():
+        master = row[0]
+        state, current = index.check(row, stat_cache)
+        yield state, master
+        if state != index.CURRENT:
+            continue
+        refresh_row(file_index, row, current)
+        if master in conversions:
+            master_info = MasterInfo(file_index, master, current[2])
+            try:
+                slaves = resolve_slaves(conversions[master], master_info)
+            except UnboundArgException:
+                # convert reports these
+                continue
+            # looked up per master, since the outputs table is many times
+            # the size of the files table
+            outputs = dict([(output[0], output)
+                            for output in file_index.outputs([master])])
+            for slave in slaves:
+                rule = backends.rule_fingerprint(slave, backend)
+                output = outputs.get(slave.path)
+                if output_state(output, master, rule, stat_cache) != index.CURRENT:
+                    yield index.STALE, slave.path
+
+def print_status(current, modified, missing, show_current, stale=[]):
     if not current and not modified and not missing:
         print 'No files have been added.'
         print 'Maybe you need to add files with "ram add <file> ..."?'
-    elif not modified and not missing and not show_current:
+    elif not modified and not missing and not stale and not show_current:
         print 'All files up to date'
     else:
         if current and show_current:
@@ -312,6 +1727,13 @@ def print_status(current, modified, missing, show_current):
                 print '#       %s%s%s' % (TerminalColors.YELLOW,
                                           filename,
                                           TerminalColors.END)
+        if stale:
+            print '# Stale outputs:'
+            print '#    (use "ram convert" to regenerate outputs)'
+            for filename in stale:
+                print '#       %s%s%s' % (TerminalColors.YELLOW,
+                                          filename,
+                                          TerminalColors.END)
         if missing:
             print '# Deleted files:'
             print '#    (use "ram rm <file> ..." to remove files)'
@@ -321,9 +1743,67 @@ def print_status(current, modified, missing, show_current):
                                           TerminalColors.END)
 
 def rm(args):
-    file_index = index.FileIndex(INDEX_PATH)
-    for filename in args.files:
-        file_index.remove(filename)
+    with index.FileIndex(INDEX_PATH) as file_index:
+        for filename in args.files:
+            file_index.remove(filename)
+
+def add_conversion_arguments(command_parser):
+    '''
+    options shared by the commands which convert masters
+    '''
+    command_parser.add_argument('-v', '--verbose',
+            action='store_const',
+            const=True,
+            dest='verbose',
+            metavar='verbose',
+            help='print extra information',
+            default=False)
+    command_parser.add_argument('-j', '--jobs',
+            type=int,
+            dest='jobs',
+            metavar='N',
+            help='number of conversions to run at once (default: CPU count)',
+            default=multiprocessing.cpu_count())
+    command_parser.add_argument('--per-slave',
+            action='store_const',
+            const=True,
+            dest='per_slave',
+            help='decode the master again for every slave instead of once per ' +
+                'master, spreading a single master across several jobs',
+            default=False)
+    command_parser.add_argument('--max-memory',
+            type=parse_size,
+            dest='max_memory',
+            metavar='size',
+            help='only run as many conversions at once as are estimated to ' +
+                'fit in size, such as 8G, and limit ImageMagick to each ' +
+                'conversion\'s estimate',
+            default=None)
+    command_parser.add_argument('--workers',
+            type=parse_workers,
+            dest='workers',
+            metavar='host:port,...',
+            help='convert on the ram workers at these addresses or unix ' +
+                'socket paths instead of locally, ignoring -j',
+            default=None)
+    add_backend_arguments(command_parser)
+
+def add_backend_arguments(command_parser):
+    '''
+    options which change how masters would be converted
+    '''
+    command_parser.add_argument('-b', '--backend',
+            dest='backend',
+            metavar='backend',
+            choices=sorted(backends.BACKENDS.keys()),
+            help='image backend to convert with, overriding the ramfile ' +
+                '(%s)' % ', '.join(sorted(backends.BACKENDS.keys())),
+            default=None)
+    command_parser.add_argument('--cache-dir',
+            dest='cache_dir',
+            metavar='dir',
+            help='restore outputs from and add them to the output cache in dir',
+            default=None)
 
 parser = RamArgParser(
         prog='ram',
@@ -340,29 +1820,86 @@ add_parser = subparsers.add_parser('add',
         add_help=False)
 add_parser.add_argument('files',
         metavar='file',
-        type=file,
+        type=str,
         nargs='+',
-        help='file to add',)
+        help='file, directory or quoted glob pattern such as ' +
+            '\'masters/**/*.png\' to add')
+add_parser.add_argument('-r', '--recursive',
+        action='store_const',
+        const=True,
+        dest='recursive',
+        help='add every file under the directories given',
+        default=False)
+add_parser.add_argument('-j', '--jobs',
+        type=int,
+        dest='jobs',
+        metavar='N',
+        help='stat the files given on N threads, which helps on network ' +
+            'file systems (default: 1)',
+        default=1)
 add_parser.set_defaults(func=add)
 
+cache_parser = subparsers.add_parser('cache',
+        description='show the size of the output cache or evict the least ' +
+            'recently used outputs from it',
+        help='manage the output cache',
+        add_help=False)
+cache_parser.add_argument('action',
+        choices=['stats', 'prune'],
+        metavar='stats|prune',
+        help='show cache statistics or prune the cache to its max size')
+cache_parser.add_argument('--cache-dir',
+        dest='cache_dir',
+        metavar='dir',
+        help='the output cache directory',
+        default=None)
+cache_parser.add_argument('--max-size',
+        type=parse_size,
+        dest='max_size',
+        metavar='size',
+        help='size to prune the cache to, such as 2G',
+        default=None)
+cache_parser.set_defaults(func=cache_cmd)
+
 convert_parser = subparsers.add_parser('convert',
         description='convert assets',
         help='convert assets',
         add_help=False)
-convert_parser.add_argument('-v', '--verbose',
-        action='store_const',
-        const=True,
-        dest='verbose',
-        metavar='verbose',
-        help='print extra information',
-        default=False)
 convert_parser.add_argument('-d', '--dry-run',
         action='store_const',
         const=True,
         dest='dry_run',
         metavar='dry run',
-        help='print out conversions, but do not actually execute them',
+        help='print the conversions to run, but do not run them',
+        default=False)
+convert_parser.add_argument('--explain',
+        action='store_const',
+        const=True,
+        dest='explain',
+        help='print the plan with estimated costs before converting',
         default=False)
+convert_parser.add_argument('--shard',
+        type=parse_shard,
+        dest='shard',
+        metavar='i/N',
+        help='only do the i-th of N equal shares of the work, so N machines ' +
+            'starting from the same index can convert in parallel',
+        default=None)
+convert_parser.add_argument('--index',
+        dest='index',
+        metavar='path',
+        help='use the index at path instead of %s, e.g. a copy for a shard' %
+            INDEX_PATH,
+        default=None)
+convert_parser.add_argument('--profile',
+        nargs='?',
+        const=True,
+        dest='profile',
+        metavar='trace.json',
+        help='print how long each stage took and the slowest masters, and ' +
+            'write a Chrome trace of the run to trace.json if it is given',
+        default=None)
+add_conversion_arguments(convert_parser)
 convert_parser.set_defaults(func=convert)
 
 help_parser = subparsers.add_parser('help',
@@ -387,6 +1924,25 @@ ls_parser = subparsers.add_parser('ls',
         add_help=False)
 ls_parser.set_defaults(func=ls)
 
+merge_index_parser = subparsers.add_parser('merge-index',
+        description='fold the indexes written by the shards of a sharded ' +
+            'convert into the index they were copied from',
+        help='merge the indexes of sharded converts',
+        add_help=False)
+merge_index_parser.add_argument('shards',
+        metavar='index',
+        nargs='+',
+        help='index written by a shard')
+merge_index_parser.set_defaults(func=merge_index)
+
+plan_parser = subparsers.add_parser('plan',
+        description='print what convert would do and estimate how much work ' +
+            'each conversion is, without converting anything',
+        help='print what convert would do',
+        add_help=False)
+add_backend_arguments(plan_parser)
+plan_parser.set_defaults(func=plan_cmd)
+
 rm_parser = subparsers.add_parser('rm',
         description='remove a file from the ram index',
         help='remove a file from the ram index',
@@ -409,8 +1965,65 @@ status_parser.add_argument('-a',
         metavar='all',
         help='show all files',
         default=False)
+status_parser.add_argument('--porcelain',
+        action='store_const',
+        const=True,
+        dest='porcelain',
+        help='print one "<code> <file>" line per file as soon as it is ' +
+            'checked, where code is M (changed), D (deleted), S (stale ' +
+            'output) or, with -a, C (up to date)',
+        default=False)
 status_parser.set_defaults(func=status)
 
+watch_parser = subparsers.add_parser('watch',
+        description='convert masters as soon as they or the ramfile change',
+        help='convert masters as soon as they change',
+        add_help=False)
+add_conversion_arguments(watch_parser)
+watch_parser.add_argument('--delay',
+        type=float,
+        dest='delay',
+        metavar='seconds',
+        help='wait until files have not changed for this long before ' +
+            'converting (default: 0.5)',
+        default=0.5)
+watch_parser.add_argument('--interval',
+        type=float,
+        dest='interval',
+        metavar='seconds',
+        help='how often to check for changes when inotify is not ' +
+            'available (default: 1)',
+        default=1.0)
+watch_parser.set_defaults(func=watch, dry_run=False, explain=False,
+                          profile=None, shard=None, index=None)
+
+worker_parser = subparsers.add_parser('worker',
+        description='serve conversions to convert --workers, keeping the ' +
+            'backend loaded between jobs. Run it in a checkout of the same ' +
+            'project, since masters are read from it. When RAM_WORKER_TOKEN ' +
+            'is set, only coordinators with the same RAM_WORKER_TOKEN are ' +
+            'served.',
+        help='serve conversions to other machines',
+        add_help=False)
+worker_parser.add_argument('address',
+        type=ram_worker.parse_address,
+        metavar='address',
+        help='host:port to listen on, or the path of a unix socket')
+worker_parser.add_argument('-j', '--jobs',
+        type=int,
+        dest='jobs',
+        metavar='N',
+        help='number of conversions to run at once (default: CPU count)',
+        default=multiprocessing.cpu_count())
+worker_parser.add_argument('-b', '--backend',
+        dest='backend',
+        metavar='backend',
+        choices=sorted(backends.BACKENDS.keys()),
+        help='image backend to convert with, overriding the ramfile ' +
+            '(%s)' % ', '.join(sorted(backends.BACKENDS.keys())),
+        default=None)
+worker_parser.set_defaults(func=worker)
+
 def main():
     try:
         args = parser.parse_args()
@@ -420,5 +2033,8 @@ def main():
 
     try:
         args.func(args)
+    except KeyboardInterrupt:
+        print 'interrupted'
+        exit(130)
     except Exception as e:
         print 'fatal: %s' % e
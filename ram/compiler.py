@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import ast, operator, re
+
+PLACEHOLDER = re.compile('\{(.+?)\}')
+
+OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    # keep the semantics of the python expressions templates used to be
+    # evaluated as
+    ast.Div: getattr(operator, 'div', operator.truediv),
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+}
+
+UNARY_OPERATORS = {
+    ast.USub: operator.neg,
+    ast.UAdd: operator.pos,
+}
+
+NUMBER_TYPES = (int, long, float)
+
+class UnboundArgException(Exception):
+    pass
+
+class InvalidExpressionException(Exception):
+    pass
+
+def lookup(args, name):
+    if name in args:
+        return args[name]
+    raise UnboundArgException('no value for {%s}' % name)
+
+class PathFormatter:
+    '''
+    a template path split into literal text and {placeholder} names once, so
+    formatting it is a join
+    '''
+
+    def __init__(self, pattern):
+        self.parts = []
+        position = 0
+        for match in PLACEHOLDER.finditer(pattern):
+            if match.start() > position:
+                self.parts.append((False, pattern[position:match.start()]))
+            self.parts.append((True, match.group(1)))
+            position = match.end()
+        if position < len(pattern):
+            self.parts.append((False, pattern[position:]))
+
+    def format(self, args):
+        values = []
+        for is_arg, value in self.parts:
+            if is_arg:
+                values.append(unicode(lookup(args, value)))
+            else:
+                values.append(value)
+        return u''.join(values)
+
+class Expression:
+    '''
+    an arithmetic expression over {placeholder} values, parsed once and
+    evaluated without eval
+
+    numbers, + - * / // % **, unary minus and parentheses are allowed
+    '''
+
+    def __init__(self, source):
+        self.source = source
+        names = {}
+
+        def rename(match):
+            name = '_arg%d' % len(names)
+            names[name] = match.group(1)
+            return name
+
+        try:
+            tree = ast.parse(PLACEHOLDER.sub(rename, source).strip(),
+                             mode='eval')
+        except SyntaxError:
+            raise InvalidExpressionException('invalid expression: %s' % source)
+        self.evaluate = self._compile(tree.body, names)
+
+    def _compile(self, node, names):
+        if isinstance(node, ast.Num):
+            value = node.n
+            return lambda args: value
+        if isinstance(node, ast.Name) and node.id in names:
+            name = names[node.id]
+            return lambda args: number(lookup(args, name))
+        if isinstance(node, ast.BinOp) and type(node.op) in OPERATORS:
+            op = OPERATORS[type(node.op)]
+            left = self._compile(node.left, names)
+            right = self._compile(node.right, names)
+            return lambda args: op(left(args), right(args))
+        if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            op = UNARY_OPERATORS[type(node.op)]
+            operand = self._compile(node.operand, names)
+            return lambda args: op(operand(args))
+        raise InvalidExpressionException('invalid expression: %s' % self.source)
+
+    def __call__(self, args):
+        return self.evaluate(args)
+
+def number(value):
+    '''
+    conversion args may hold numbers or expressions such as "48 * 2"
+    '''
+    if isinstance(value, NUMBER_TYPES):
+        return value
+    return Expression(unicode(value))({})
+
+def compile_size(value):
+    '''
+    compile a slave width or height, which is either a number or an
+    expression
+    '''
+    if isinstance(value, NUMBER_TYPES):
+        return lambda args: value
+    return Expression(unicode(value))
+
+class CompiledSlave:
+    '''
+    a template slave with its path and size compiled for cheap resolution
+    '''
+
+    def __init__(self, slave):
+        self.path = PathFormatter(slave.path)
+        self.width = compile_size(slave.width)
+        self.height = compile_size(slave.height)
+        self.output = slave.output
+
+    def resolve(self, args):
+        '''
+        return a (path, width, height) tuple for a conversion's args
+        '''
+        return self.path.format(args), self.width(args), self.height(args)
@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import struct
+
+class ImageInfo:
+    '''
+    what an image's header says about it. depth is the bits per channel, or
+    per pixel for palette images, and layers the number of layers of a
+    layered format such as PSD.
+    '''
+
+    def __init__(self, format=None, width=None, height=None, layers=1,
+                 depth=8):
+        self.format = format
+        self.width = width
+        self.height = height
+        self.layers = layers
+        self.depth = depth
+
+    def pixels(self):
+        return self.width * self.height
+
+    def to_tuple(self):
+        return (self.format, self.width, self.height, self.layers, self.depth)
+
+def _png(image_file, head):
+    if head[12:16] != b'IHDR':
+        return None
+    width, height, depth = struct.unpack('>IIB', head[16:25])
+    return ImageInfo('png', width, height, depth=depth)
+
+def _gif(image_file, head):
+    width, height, flags = struct.unpack('<HHB', head[6:11])
+    return ImageInfo('gif', width, height, depth=(flags & 0x07) + 1)
+
+# start of frame markers, which hold the image size
+JPEG_SOF_MARKERS = set([0xc0, 0xc1, 0xc2, 0xc3, 0xc5, 0xc6, 0xc7,
+                        0xc9, 0xca, 0xcb, 0xcd, 0xce, 0xcf])
+
+def _jpeg(image_file, head):
+    # skip from segment to segment, so a large EXIF block is never read
+    image_file.seek(2)
+    while True:
+        marker = image_file.read(2)
+        if len(marker) < 2 or marker[0:1] != b'\xff':
+            return None
+        code = ord(marker[1:2])
+        if code == 0xff:
+            # fill byte before the marker
+            image_file.seek(-1, 1)
+            continue
+        if code == 0xd8 or 0xd0 <= code <= 0xd7:
+            continue
+        if code == 0xd9 or code == 0xda:
+            return None
+        length = image_file.read(2)
+        if len(length) < 2:
+            return None
+        length = struct.unpack('>H', length)[0]
+        if code in JPEG_SOF_MARKERS:
+            frame = image_file.read(5)
+            if len(frame) < 5:
+                return None
+            depth, height, width = struct.unpack('>BHH', frame)
+            return ImageInfo('jpeg', width, height, depth=depth)
+        image_file.seek(length - 2, 1)
+
+def _psd(image_file, head):
+    version, channels, height, width, depth = struct.unpack(
+            '>H6xHIIH', head[4:24])
+    info = ImageInfo('psd', width, height, depth=depth)
+    # skip the color mode data and image resources to the layer count. Large
+    # documents (PSB, version 2) use 8 byte section lengths.
+    image_file.seek(26)
+    for section in range(2):
+        length = struct.unpack('>I', image_file.read(4))[0]
+        image_file.seek(length, 1)
+    length_format = '>Q' if version == 2 else '>I'
+    length_size = struct.calcsize(length_format)
+    if struct.unpack(length_format, image_file.read(length_size))[0] == 0:
+        return info
+    if struct.unpack(length_format, image_file.read(length_size))[0] == 0:
+        return info
+    # negative when the first alpha channel holds the merged transparency
+    info.layers = abs(struct.unpack('>h', image_file.read(2))[0])
+    return info
+
+def _webp(image_file, head):
+    if head[8:12] != b'WEBP':
+        return None
+    chunk, data = head[12:16], head[20:]
+    if chunk == b'VP8 ':
+        # lossy: a 3 byte frame tag and start code before the size
+        width, height = struct.unpack('<HH', data[6:10])
+        return ImageInfo('webp', width & 0x3fff, height & 0x3fff)
+    if chunk == b'VP8L':
+        bits = struct.unpack('<I', data[1:5])[0]
+        return ImageInfo('webp', (bits & 0x3fff) + 1,
+                         ((bits >> 14) & 0x3fff) + 1)
+    if chunk == b'VP8X':
+        width = struct.unpack('<I', data[4:7] + b'\x00')[0] + 1
+        height = struct.unpack('<I', data[7:10] + b'\x00')[0] + 1
+        return ImageInfo('webp', width, height)
+    return None
+
+# (signature, reader) pairs tried in order against the start of the file
+READERS = [
+    (b'\x89PNG\r\n\x1a\n', _png),
+    (b'GIF87a', _gif),
+    (b'GIF89a', _gif),
+    (b'\xff\xd8', _jpeg),
+    (b'8BPS', _psd),
+    (b'RIFF', _webp),
+]
+
+HEAD_SIZE = 64
+
+def read_info(path):
+    '''
+    read an image's ImageInfo from its header without decoding it, which
+    takes a few small reads whatever the size of the image
+
+    returns None for files which are unreadable or in a format not known
+    here: PNG, JPEG, GIF, PSD and WebP
+    '''
+    try:
+        with open(path, 'rb') as image_file:
+            head = image_file.read(HEAD_SIZE)
+            for signature, reader in READERS:
+                if head.startswith(signature):
+                    return reader(image_file, head)
+    except (IOError, OSError, struct.error):
+        pass
+    return None
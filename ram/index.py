@@ -14,29 +14,301 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import sqlite3, os
+import sqlite3, os, hashlib, collections
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+SCHEMA_VERSION = 4
+
+CHUNK_SIZE = 1024 * 1024
+
+# stays below sqlite's default limit of 999 parameters per statement
+SELECT_CHUNK_SIZE = 500
+
+# the tables a shard's changes are merged from, with their columns
+MERGED_TABLES = {
+    'files': 'path, modified, size, hash',
+    'outputs': 'path, master, rule, modified, size, hash',
+}
+
+CURRENT = 'current'
+MODIFIED = 'modified'
+MISSING = 'missing'
+STALE = 'stale'
 
 class NotInitializedException(Exception):
     pass
 
+def file_digest(file_path):
+    '''
+    hash the contents of a file, reading it in chunks so large masters are
+    never held in memory
+
+    the digest is prefixed with the name of the hash so digests made with a
+    different hash never compare equal
+    '''
+    if xxhash:
+        name, digest = 'xxh64', xxhash.xxh64()
+    elif hasattr(hashlib, 'blake2b'):
+        name, digest = 'blake2b', hashlib.blake2b()
+    else:
+        name, digest = 'sha1', hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        chunk = f.read(CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(CHUNK_SIZE)
+    return name + ':' + digest.hexdigest()
+
+class StatCache():
+    '''
+    stats files by listing their directory once, so finding out a file is
+    missing costs no system call and a directory is not searched again for
+    every file in it
+
+    only the most recently listed max_directories directories are kept
+    '''
+
+    def __init__(self, max_directories=64):
+        self.directories = collections.OrderedDict()
+        self.max_directories = max_directories
+
+    def _entries(self, directory):
+        if directory in self.directories:
+            entries = self.directories.pop(directory)
+        else:
+            entries = self._list(directory)
+            if len(self.directories) >= self.max_directories:
+                self.directories.popitem(last=False)
+        self.directories[directory] = entries
+        return entries
+
+    def _list(self, directory):
+        try:
+            if scandir:
+                return dict([(entry.name, entry)
+                             for entry in scandir(directory or '.')])
+            return dict.fromkeys(os.listdir(directory or '.'))
+        except OSError:
+            return {}
+
+    def stat(self, file_path):
+        '''
+        return os.stat(file_path), or None if the file does not exist
+        '''
+        directory, name = os.path.split(file_path)
+        entries = self._entries(directory)
+        if name not in entries:
+            return None
+        try:
+            if entries[name] != None:
+                return entries[name].stat()
+            return os.stat(file_path)
+        except OSError:
+            return None
+
+def walk_files(directory):
+    '''
+    yield the path of every file under directory, skipping hidden files and
+    directories such as .git
+
+    with scandir the type of each entry is known from the directory listing
+    so no file has to be stat'ed
+    '''
+    if scandir == None:
+        for root, directories, files in os.walk(directory):
+            directories[:] = sorted([name for name in directories
+                                     if not name.startswith('.')])
+            for name in sorted(files):
+                if not name.startswith('.'):
+                    yield os.path.join(root, name)
+        return
+
+    pending = [directory]
+    while pending:
+        current = pending.pop()
+        try:
+            entries = sorted(scandir(current), key=lambda entry: entry.name)
+        except OSError:
+            continue
+        subdirectories = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir():
+                subdirectories.append(entry.path)
+            elif entry.is_file():
+                yield entry.path
+        pending.extend(reversed(subdirectories))
+
+def check(row, stat_cache=None):
+    '''
+    compare an index row against the file on disk
+
+    the contents are only hashed when the modified time or size differs from
+    the index, so a file which was merely touched (e.g. by a fresh checkout)
+    is still current
+
+    returns a 2-tuple of the file's state (CURRENT, MODIFIED or MISSING) and
+    a (modified, size, hash) tuple describing the file now. The hash is None
+    if it did not need to be computed.
+    '''
+    file_path, modified, size, file_hash = row[:4]
+    if stat_cache != None:
+        stat = stat_cache.stat(file_path)
+    else:
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            stat = None
+    if stat == None:
+        return MISSING, None
+
+    if stat.st_mtime == modified and (size == None or stat.st_size == size):
+        if file_hash == None:
+            # rows from before hashes were tracked
+            file_hash = file_digest(file_path)
+        return CURRENT, (stat.st_mtime, stat.st_size, file_hash)
+
+    if file_hash != None and stat.st_size == size:
+        current_hash = file_digest(file_path)
+        if current_hash == file_hash:
+            return CURRENT, (stat.st_mtime, stat.st_size, current_hash)
+        return MODIFIED, (stat.st_mtime, stat.st_size, current_hash)
+
+    return MODIFIED, (stat.st_mtime, stat.st_size, None)
+
 class FileIndex():
+    '''
+    the sqlite database tracking masters and the outputs generated from them
+
+    the index keeps one connection open. Used as a context manager writes are
+    batched into a single transaction which is committed when the block
+    exits (or every commit_every rows); outside of a with block every write
+    is committed immediately.
+    '''
     
-    def __init__(self, db_path):
+    def __init__(self, db_path, commit_every=None):
         self.db_path = db_path
+        self.commit_every = commit_every
+        self.conn = None
+        self.depth = 0
+        self.pending = 0
+
+    def __enter__(self):
+        self._connect_if_exists()
+        self.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.depth -= 1
+        if self.depth == 0:
+            # rows written so far describe work which finished, so they are
+            # kept even if the block raised
+            self.close()
+        return False
         
     def _connect_if_exists(self):
+        if self.conn != None:
+            return self.conn
         if os.path.isfile(self.db_path):
-            return sqlite3.connect(self.db_path)
+            self._open()
+            self._migrate(self.conn)
+            return self.conn
         else:
             raise NotInitializedException('ram index does not exists. Have you called init?')
+
+    def _open(self):
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # with a write-ahead log a crash can lose the last transaction but
+        # never corrupt the index
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+
+    def _wrote(self, rows=1):
+        '''
+        commit now unless writes are being batched by a with block
+        '''
+        self.pending += rows
+        if self.depth == 0 or (self.commit_every and
+                               self.pending >= self.commit_every):
+            self.commit()
+
+    def commit(self):
+        if self.conn != None:
+            self.conn.commit()
+        self.pending = 0
+
+    def close(self):
+        '''
+        commit any batched writes and close the connection
+        '''
+        if self.conn != None:
+            self.commit()
+            self.conn.close()
+            self.conn = None
+
+    def _migrate(self, conn):
+        '''
+        bring an index created by an older version of ram up to date
+        '''
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+        if version < 1:
+            conn.execute('ALTER TABLE files ADD COLUMN size integer')
+            conn.execute('ALTER TABLE files ADD COLUMN hash text')
+        if version < 2:
+            self._create_outputs(conn)
+        if version < 3:
+            self._create_images(conn)
+        if version < 4:
+            self._create_journal(conn)
+        conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        conn.commit()
     
-    def init(self):
-        conn = sqlite3.connect(self.db_path)
+    def _create_outputs(self, conn):
         conn.execute('''
-            CREATE TABLE files (path text PRIMARY KEY, modified integer)
+            CREATE TABLE outputs (path text PRIMARY KEY, master text,
+                                  rule text, modified integer, size integer,
+                                  hash text)
             ''')
-        conn.commit()
-        conn.close()
+        conn.execute('CREATE INDEX outputs_master ON outputs (master)')
+
+    def _create_images(self, conn):
+        conn.execute('''
+            CREATE TABLE images (hash text PRIMARY KEY, format text,
+                                 width integer, height integer,
+                                 layers integer, depth integer)
+            ''')
+
+    def _create_journal(self, conn):
+        # the masters a convert set out to convert and has not recorded yet
+        conn.execute('CREATE TABLE journal (master text PRIMARY KEY)')
+
+    def init(self):
+        self.close()
+        self._open()
+        self.conn.execute('''
+            CREATE TABLE files (path text PRIMARY KEY, modified integer,
+                                size integer, hash text)
+            ''')
+        self._create_outputs(self.conn)
+        self._create_images(self.conn)
+        self._create_journal(self.conn)
+        self.conn.execute('PRAGMA user_version = %d' % SCHEMA_VERSION)
+        self.commit()
     
     def add(self, files):
         '''
@@ -47,43 +319,261 @@ class FileIndex():
         raises a NotInitializedException if the index has not been created
         '''
         conn = self._connect_if_exists()
-        conn.executemany('INSERT OR IGNORE INTO files VALUES (?,?)', files)
-        conn.commit()
-        conn.close()
+        conn.executemany(
+                'INSERT OR IGNORE INTO files (path, modified) VALUES (?,?)',
+                files)
+        self._wrote(len(files))
         
     def remove(self, file_path):
         '''
-        remove a file from the index
+        remove a file and the outputs generated from it from the index
         
         raises a NotInitializedException if the index has not been created
         '''
         conn = self._connect_if_exists()
         conn.execute('DELETE FROM files WHERE path=?', (file_path,))
-        conn.commit()
-        conn.close()
+        conn.execute('DELETE FROM outputs WHERE master=?', (file_path,))
+        self._wrote()
         
     def all(self):
         '''
-        retrieve all files in the index
+        retrieve all files in the index as (path, modified, size, hash) rows
         
         raises a NotInitializedException if the index has not been created
         '''
         conn = self._connect_if_exists()
-        cur = conn.cursor()
-        cur.execute('SELECT * FROM files')
-        rows = cur.fetchall()
-        conn.close()
+        return conn.execute('SELECT path, modified, size, hash FROM files').fetchall()
+    
+    def paths(self):
+        '''
+        the set of paths of every file in the index
+
+        raises a NotInitializedException if the index has not been created
+        '''
+        conn = self._connect_if_exists()
+        return set([row[0] for row in conn.execute('SELECT path FROM files')])
+
+    def get(self, file_paths):
+        '''
+        retrieve the (path, modified, size, hash) rows of the given files
+        which are in the index
+        
+        raises a NotInitializedException if the index has not been created
+        '''
+        return self._select_in(
+                'SELECT path, modified, size, hash FROM files WHERE path IN (%s)',
+                file_paths)
+
+    def _select_in(self, query, values):
+        # sqlite limits the number of parameters in a single statement
+        conn = self._connect_if_exists()
+        values = list(values)
+        rows = []
+        for start in range(0, len(values), SELECT_CHUNK_SIZE):
+            chunk = values[start:start + SELECT_CHUNK_SIZE]
+            rows.extend(conn.execute(query % ','.join('?' * len(chunk)),
+                                     chunk).fetchall())
         return rows
+
+    def iter_all(self):
+        '''
+        iterate over the files in the index in path order without reading
+        the whole table into memory
+
+        the rows may be updated while iterating, but the index must not be
+        committed until the iteration is finished
+        
+        raises a NotInitializedException if the index has not been created
+        '''
+        conn = self._connect_if_exists()
+        cur = conn.execute(
+                'SELECT path, modified, size, hash FROM files ORDER BY path')
+        for row in cur:
+            yield row
     
-    def update(self, file_path, modified_time):
+    def update(self, file_path, modified_time, size=None, file_hash=None):
         '''
-        update the modified time on a file in the index
+        update the modified time, size and content hash of a file in the index
+        
+        raises a NotInitializedException if the index has not been created
+        '''
+        self.update_many([(file_path, modified_time, size, file_hash)])
+
+    def update_many(self, rows):
+        '''
+        update several files at once
+        rows should be a list of (path, modified, size, hash) tuples
         
         raises a NotInitializedException if the index has not been created
         '''
         conn = self._connect_if_exists()
-        conn.execute('UPDATE files SET modified=? WHERE path=?',
-                     (modified_time, file_path))
-        conn.commit()
-        conn.close()
-    
\ No newline at end of file
+        conn.executemany('UPDATE files SET modified=?, size=?, hash=? WHERE path=?',
+                         [(row[1], row[2], row[3], row[0]) for row in rows])
+        self._wrote(len(rows))
+
+    def outputs(self, masters=None):
+        '''
+        retrieve the generated outputs in the index, or only those generated
+        from masters, as (path, master, rule, modified, size, hash) rows
+        
+        raises a NotInitializedException if the index has not been created
+        '''
+        if masters != None:
+            return self._select_in(
+                    'SELECT path, master, rule, modified, size, hash ' +
+                    'FROM outputs WHERE master IN (%s)', masters)
+        conn = self._connect_if_exists()
+        return conn.execute(
+                'SELECT path, master, rule, modified, size, hash FROM outputs').fetchall()
+
+    def update_output(self, file_path, master, rule, modified_time, size,
+                      file_hash):
+        '''
+        record an output generated from master by the rule fingerprint rule
+        
+        raises a NotInitializedException if the index has not been created
+        '''
+        self.update_outputs([(file_path, master, rule, modified_time, size,
+                              file_hash)])
+
+    def update_outputs(self, rows):
+        '''
+        record several outputs at once
+        rows should be a list of (path, master, rule, modified, size, hash)
+        tuples
+        
+        raises a NotInitializedException if the index has not been created
+        '''
+        conn = self._connect_if_exists()
+        conn.executemany('INSERT OR REPLACE INTO outputs VALUES (?,?,?,?,?,?)',
+                         rows)
+        self._wrote(len(rows))
+
+    def remove_outputs(self, file_paths):
+        '''
+        forget outputs which are no longer generated by any rule
+        
+        raises a NotInitializedException if the index has not been created
+        '''
+        conn = self._connect_if_exists()
+        conn.executemany('DELETE FROM outputs WHERE path=?',
+                         [(file_path,) for file_path in file_paths])
+        self._wrote(len(file_paths))
+
+    def image_info(self, file_hash):
+        '''
+        retrieve the (format, width, height, layers, depth) recorded for the
+        image with the given content hash, or None
+
+        raises a NotInitializedException if the index has not been created
+        '''
+        conn = self._connect_if_exists()
+        return conn.execute(
+                'SELECT format, width, height, layers, depth FROM images ' +
+                'WHERE hash=?', (file_hash,)).fetchone()
+
+    def update_image_info(self, file_hash, info):
+        '''
+        record the (format, width, height, layers, depth) of the image with
+        the given content hash
+
+        raises a NotInitializedException if the index has not been created
+        '''
+        conn = self._connect_if_exists()
+        conn.execute('INSERT OR REPLACE INTO images VALUES (?,?,?,?,?,?)',
+                     (file_hash,) + tuple(info))
+        self._wrote()
+
+    def merge(self, shard_paths):
+        '''
+        fold in the changes shards made to copies of this index: rows a shard
+        added or changed are written here and rows it removed are removed
+
+        every shard is compared with this index as it was before any of them
+        is merged, so rows one shard left alone never undo another shard's
+        changes
+
+        returns a 2-tuple of the number of rows changed and removed
+
+        raises a NotInitializedException if the index has not been created
+        '''
+        conn = self._connect_if_exists()
+        # sqlite cannot attach a database inside a transaction
+        self.commit()
+        changed = dict([(table, {}) for table in MERGED_TABLES])
+        removed = dict([(table, set()) for table in MERGED_TABLES])
+        images = []
+        for shard_path in shard_paths:
+            # brings the shard up to date with this version of ram
+            with FileIndex(shard_path):
+                pass
+            conn.execute('ATTACH DATABASE ? AS shard', (shard_path,))
+            try:
+                for table, columns in MERGED_TABLES.items():
+                    for row in conn.execute(
+                            'SELECT %s FROM shard.%s EXCEPT SELECT %s FROM main.%s' %
+                            (columns, table, columns, table)):
+                        changed[table][row[0]] = row
+                    removed[table].update([row[0] for row in conn.execute(
+                            'SELECT path FROM main.%s WHERE path NOT IN ' % table +
+                            '(SELECT path FROM shard.%s)' % table)])
+                images.extend(conn.execute(
+                        'SELECT hash, format, width, height, layers, depth ' +
+                        'FROM shard.images').fetchall())
+            finally:
+                conn.execute('DETACH DATABASE shard')
+
+        changes = 0
+        removals = 0
+        for table, columns in MERGED_TABLES.items():
+            rows = changed[table].values()
+            places = ','.join('?' * len(columns.split(',')))
+            conn.executemany('INSERT OR REPLACE INTO %s (%s) VALUES (%s)' %
+                             (table, columns, places), rows)
+            paths = [(path,) for path in removed[table]
+                     if path not in changed[table]]
+            conn.executemany('DELETE FROM %s WHERE path=?' % table, paths)
+            changes += len(rows)
+            removals += len(paths)
+        conn.executemany('INSERT OR IGNORE INTO images VALUES (?,?,?,?,?,?)',
+                         images)
+        self._wrote(changes + removals)
+        return changes, removals
+
+    def journal(self):
+        '''
+        the masters left unconverted by a convert which did not finish
+
+        raises a NotInitializedException if the index has not been created
+        '''
+        conn = self._connect_if_exists()
+        return [row[0] for row in conn.execute('SELECT master FROM journal')]
+
+    def start_journal(self, masters):
+        '''
+        record the masters a convert is about to convert, replacing those of
+        any earlier convert, and commit at once so they survive a crash
+
+        raises a NotInitializedException if the index has not been created
+        '''
+        conn = self._connect_if_exists()
+        conn.execute('DELETE FROM journal')
+        conn.executemany('INSERT OR IGNORE INTO journal VALUES (?)',
+                         [(master,) for master in masters])
+        self.commit()
+
+    def finish_journal(self, masters=None):
+        '''
+        remove masters which were converted, or which failed, from the
+        journal, or every master if masters is None
+
+        raises a NotInitializedException if the index has not been created
+        '''
+        conn = self._connect_if_exists()
+        if masters == None:
+            conn.execute('DELETE FROM journal')
+            self._wrote()
+            return
+        conn.executemany('DELETE FROM journal WHERE master=?',
+                         [(master,) for master in masters])
+        self._wrote(len(masters))
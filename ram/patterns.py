@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os, re, glob
+
+from ram import index
+
+def is_pattern(path):
+    return glob.has_magic(path)
+
+def translate(pattern):
+    '''
+    translate a glob pattern into a regular expression matching the same
+    paths. * and ? do not match /, while ** matches any number of
+    directories, including none.
+    '''
+    result = []
+    position = 0
+    while position < len(pattern):
+        char = pattern[position]
+        if pattern.startswith('**/', position):
+            result.append('(?:.*/)?')
+            position += 3
+            continue
+        if pattern.startswith('**', position):
+            result.append('.*')
+            position += 2
+            continue
+        if char == '*':
+            result.append('[^/]*')
+        elif char == '?':
+            result.append('[^/]')
+        elif char == '[':
+            end = pattern.find(']', position + 2)
+            if end == -1:
+                result.append(re.escape(char))
+            else:
+                chars = pattern[position + 1:end]
+                if chars.startswith('!'):
+                    chars = '^' + chars[1:]
+                result.append('[%s]' % chars.replace('\\', '\\\\'))
+                position = end
+        else:
+            result.append(re.escape(char))
+        position += 1
+    return re.compile(''.join(result) + r'\Z')
+
+class Pattern:
+    '''
+    a glob pattern which can both test a single path and list every file it
+    matches
+    '''
+
+    def __init__(self, pattern):
+        self.pattern = os.path.normpath(pattern)
+        self.regex = translate(self.pattern)
+
+    def match(self, path):
+        return self.regex.match(os.path.normpath(path)) != None
+
+    def files(self):
+        '''
+        yield the files matching the pattern, one at a time
+        '''
+        if '**' not in self.pattern:
+            for path in glob.iglob(self.pattern):
+                if not os.path.isdir(path):
+                    yield os.path.normpath(path)
+            return
+        # only the directories below the pattern's literal prefix can match
+        prefix = self.pattern[:self.pattern.index('**')]
+        directory = os.path.dirname(prefix)
+        while is_pattern(directory):
+            directory = os.path.dirname(directory)
+        for path in index.walk_files(directory or '.'):
+            path = os.path.normpath(path)
+            if self.match(path):
+                yield path
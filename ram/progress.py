@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import sys, time, threading
+
+# how often progress is printed when it cannot be redrawn in place, such as
+# in a CI log
+PLAIN_INTERVAL = 10.0
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return '%ds' % seconds
+    if seconds < 60 * 60:
+        return '%dm%02ds' % (seconds // 60, seconds % 60)
+    return '%dh%02dm' % (seconds // (60 * 60), seconds // 60 % 60)
+
+class Progress:
+    '''
+    a progress line showing the jobs done, throughput and time left
+
+    on a terminal the line is redrawn in place after every job and messages
+    are printed above it. Otherwise it is printed every PLAIN_INTERVAL
+    seconds.
+    '''
+
+    def __init__(self, total, stream=None):
+        if stream == None:
+            stream = sys.stderr
+        self.total = total
+        self.done = 0
+        self.stream = stream
+        self.in_place = hasattr(stream, 'isatty') and stream.isatty()
+        self.started = time.time()
+        self.printed = self.started
+        self.lock = threading.Lock()
+
+    def line(self, now=None):
+        if now == None:
+            now = time.time()
+        elapsed = now - self.started
+        line = '%d/%d jobs' % (self.done, self.total)
+        if self.done and elapsed > 0:
+            rate = self.done / elapsed
+            line += ', %.1f jobs/s' % rate
+            if self.done < self.total:
+                line += ', %s left' % format_duration(
+                        (self.total - self.done) / rate)
+        return line
+
+    def _draw(self):
+        if self.in_place:
+            self.stream.write('\r' + self.line() + '\x1b[K')
+            self.stream.flush()
+            return
+        now = time.time()
+        if now - self.printed >= PLAIN_INTERVAL:
+            self.printed = now
+            self.stream.write(self.line(now) + '\n')
+
+    def _clear(self):
+        if self.in_place:
+            self.stream.write('\r\x1b[K')
+
+    def advance(self, count=1):
+        with self.lock:
+            self.done += count
+            self._draw()
+
+    def write(self, message, stream=None):
+        with self.lock:
+            self._clear()
+            (stream or self.stream).write(message + '\n')
+            (stream or self.stream).flush()
+            self._draw()
+
+    def finish(self):
+        with self.lock:
+            self._clear()
+            self.stream.flush()
+
+_progress = None
+
+def start(total, stream=None):
+    '''
+    show the progress of total jobs until stop is called
+    '''
+    global _progress
+    _progress = Progress(total, stream)
+    return _progress
+
+def stop():
+    global _progress
+    if _progress != None:
+        _progress.finish()
+    _progress = None
+
+def advance(count=1):
+    if _progress != None:
+        _progress.advance(count)
+
+def write(message, stream=None):
+    '''
+    print a message to stream, stderr by default, without garbling the
+    progress line
+    '''
+    if _progress != None:
+        _progress.write(message, stream)
+    else:
+        (stream or sys.stderr).write(message + '\n')
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest, os, stat, shutil, tempfile
+from ram import backends, cache, commands
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+class TestImageMagickBackend(unittest.TestCase):
+
+    def test_single_pass_command(self):
+        slaves = [commands.SlaveConversion('small.png', 10, 20),
+                  commands.SlaveConversion('large.png', 30, 40)]
+        self.assertEqual(
+            ['convert', 'master.psd[0]',
+             '(', '+clone', '-resize', '10x20', '-write', 'small.png', '+delete', ')',
+             '-resize', '30x40', 'large.png'],
+            backends.ImageMagickBackend().command('master.psd', slaves))
+
+    def test_memory_limits(self):
+        slaves = [commands.SlaveConversion('small.png', 10, 20)]
+        self.assertEqual(
+            ['convert', '-limit', 'memory', '3MiB', '-limit', 'map', '5MiB',
+             'master.psd[0]', '-resize', '10x20', 'small.png'],
+            backends.ImageMagickBackend().command('master.psd', slaves,
+                                                  int(2.5 * 1024 * 1024)))
+    def test_output_options(self):
+        slaves = [commands.SlaveConversion('small.webp', 10, 20,
+                                           {'format': 'webp', 'quality': 80}),
+                  commands.SlaveConversion('large.png', 30, 40,
+                                           {'colors': 64, 'compression': 9})]
+        self.assertEqual(
+            ['convert', '-respect-parentheses', 'master.psd[0]',
+             '(', '+clone', '-resize', '10x20', '-quality', '80',
+             '-write', 'WEBP:small.webp', '+delete', ')',
+             '-resize', '30x40', '-colors', '64',
+             '-define', 'png:compression-level=9', 'large.png'],
+            backends.ImageMagickBackend().command('master.psd', slaves))
+
+    def test_fingerprints(self):
+        backend = backends.ImageMagickBackend()
+        backend._version = 'ImageMagick 6'
+        plain = commands.SlaveConversion('a.png', 10, 20)
+        encoded = commands.SlaveConversion('a.png', 10, 20, {'colors': 64})
+        self.assertNotEqual(backends.rule_fingerprint(plain, backend),
+                            backends.rule_fingerprint(encoded, backend))
+        self.assertNotEqual(backends.output_fingerprint(plain, backend),
+                            backends.output_fingerprint(encoded, backend))
+        # outputs recorded before output options existed stay current
+        self.assertEqual(backends.rule_fingerprint(plain, backend),
+                         backends.rule_fingerprint(
+                                 commands.SlaveConversion('a.png', 10, 20, {}),
+                                 backend))
+
+class WritingBackend(backends.Backend):
+
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+        self.paths = []
+
+    def write(self, master, slaves, dry_run, memory=None):
+        for slave in slaves:
+            if len(self.paths) == self.fail_after:
+                return 1
+            self.paths.append(slave.path)
+            with open(slave.path, 'w') as f:
+                f.write('new')
+        return 0
+
+class TestAtomicWrites(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.slaves = [commands.SlaveConversion(os.path.join(self.tmp, name), 1, 1)
+                       for name in ['a.png', 'b.png']]
+        for slave in self.slaves:
+            with open(slave.path, 'w') as f:
+                f.write('old')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def contents(self):
+        result = []
+        for slave in self.slaves:
+            with open(slave.path) as f:
+                result.append(f.read())
+        return result
+
+    def test_renamed_into_place(self):
+        backend = WritingBackend()
+        self.assertEqual(0, backend.convert('master.png', self.slaves, False))
+        self.assertEqual(['new', 'new'], self.contents())
+        # the backend wrote hidden temporary files next to the slaves
+        self.assertEqual(['.a.png', '.b.png'],
+                         [os.path.basename(path)[:6] for path in backend.paths])
+        self.assertEqual(['a.png', 'b.png'], sorted(os.listdir(self.tmp)))
+
+    def test_failure_keeps_old_outputs(self):
+        self.assertEqual(1, WritingBackend(1).convert('master.png', self.slaves,
+                                                      False))
+        self.assertEqual(['old', 'old'], self.contents())
+        self.assertEqual(['a.png', 'b.png'], sorted(os.listdir(self.tmp)))
+
+    def test_permissions(self):
+        os.chmod(self.slaves[0].path, 0o640)
+        os.remove(self.slaves[1].path)
+        self.assertEqual(0, WritingBackend().convert('master.png', self.slaves,
+                                                     False))
+        # a replaced output keeps its mode and a new one gets the umask's
+        self.assertEqual(0o640, stat.S_IMODE(os.stat(self.slaves[0].path).st_mode))
+        self.assertEqual(cache.NEW_FILE_MODE,
+                         stat.S_IMODE(os.stat(self.slaves[1].path).st_mode))
+
+    def test_missing_directory(self):
+        slave = commands.SlaveConversion(os.path.join(self.tmp, 'gone', 'a.png'),
+                                         1, 1)
+        self.assertEqual(1, WritingBackend().convert('master.png', [slave], False))
+
+class TestGetBackend(unittest.TestCase):
+
+    def test_default(self):
+        self.assertEqual('imagemagick', backends.get_backend().name)
+
+    def test_unknown(self):
+        self.assertRaises(backends.BackendNotFoundException,
+                          backends.get_backend, 'GARBAGE')
+
+    def test_fit_size(self):
+        slave = commands.SlaveConversion('out.png', 50, 50)
+        self.assertEqual((50, 25), backends.fit_size((200, 100), slave))
+        slave = commands.SlaveConversion('out.png', 75.0, 400)
+        self.assertEqual((75, 38), backends.fit_size((200, 100), slave))
+
+@unittest.skipIf(Image == None, 'Pillow is not installed')
+class TestPillowBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_convert(self):
+        master = os.path.join(self.tmp, 'master.png')
+        Image.new('RGBA', (200, 100)).save(master)
+        slaves = [commands.SlaveConversion(os.path.join(self.tmp, 'a.png'), 100, 100),
+                  commands.SlaveConversion(os.path.join(self.tmp, 'b.jpg'), 40, 40)]
+        self.assertEqual(0, backends.PillowBackend().convert(master, slaves, False))
+        self.assertEqual((100, 50), Image.open(slaves[0].path).size)
+        self.assertEqual((40, 20), Image.open(slaves[1].path).size)
+    def test_output_options(self):
+        master = os.path.join(self.tmp, 'master.png')
+        Image.new('RGBA', (200, 100), (255, 0, 0, 128)).save(master)
+        slaves = [commands.SlaveConversion(os.path.join(self.tmp, 'a.png'),
+                                           100, 100, {'colors': 16}),
+                  commands.SlaveConversion(os.path.join(self.tmp, 'b.img'),
+                                           40, 40, {'format': 'webp',
+                                                    'quality': 50})]
+        self.assertEqual(0, backends.PillowBackend().convert(master, slaves, False))
+        self.assertEqual('P', Image.open(slaves[0].path).mode)
+        self.assertEqual('WEBP', Image.open(slaves[1].path).format)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest, os, stat, shutil, tempfile
+from ram import cache
+
+class TestOutputCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache = cache.OutputCache(os.path.join(self.tmp, 'cache'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_store_fetch(self):
+        key = self.cache.key('sha1:master', 'rule')
+        restored = os.path.join(self.tmp, 'res', 'restored.png')
+        self.assertFalse(self.cache.fetch(key, restored))
+        self.cache.store(key, self.write('output.png', 'output'))
+        self.assertTrue(self.cache.fetch(key, restored))
+        self.assertEqual('output', self.read(restored))
+        self.assertEqual((1, 6), self.cache.stats())
+
+    def test_place_permissions(self):
+        source = self.write('output.png', 'output')
+        os.chmod(source, 0o600)
+        placed = os.path.join(self.tmp, 'res', 'placed.png')
+        cache.place(source, placed)
+        self.assertEqual(cache.NEW_FILE_MODE, stat.S_IMODE(os.stat(placed).st_mode))
+        os.chmod(placed, 0o640)
+        cache.place(source, placed)
+        self.assertEqual(0o640, stat.S_IMODE(os.stat(placed).st_mode))
+
+    def test_entries_shared(self):
+        key = self.cache.key('sha1:master', 'rule')
+        self.cache.store(key, self.write('output.png', 'output'))
+        # not 0600 as mkstemp creates them, so other users sharing the cache
+        # can fetch the entry as far as the umask allows
+        mode = stat.S_IMODE(os.stat(self.cache._path(key)).st_mode)
+        self.assertEqual(cache.NEW_FILE_MODE, mode)
+        self.assertEqual(0o444 & ~cache.UMASK, mode & 0o444)
+
+    def test_key(self):
+        self.assertNotEqual(self.cache.key('sha1:a', 'rule'),
+                            self.cache.key('sha1:b', 'rule'))
+        self.assertNotEqual(self.cache.key('sha1:a', 'rule'),
+                            self.cache.key('sha1:a', 'other'))
+
+    def test_prune_least_recently_used(self):
+        keys = ['%040d' % i for i in range(3)]
+        for i, key in enumerate(keys):
+            self.cache.store(key, self.write('output.png', 'x' * 10))
+            os.utime(self.cache._path(key), (1000 + i, 1000 + i))
+        # using the oldest entry keeps it in the cache
+        self.assertTrue(self.cache.fetch(keys[0], os.path.join(self.tmp, 'a.png')))
+
+        self.assertEqual((1, 10), self.cache.prune(20))
+        self.assertEqual((2, 20), self.cache.stats())
+        self.assertFalse(os.path.exists(self.cache._path(keys[1])))
+        self.assertEqual((0, 0), self.cache.prune())
+
+    def test_link(self):
+        linked = cache.OutputCache(os.path.join(self.tmp, 'cache'), link=True)
+        linked.store('%040d' % 1, self.write('output.png', 'output'))
+        restored = os.path.join(self.tmp, 'restored.png')
+        self.assertTrue(linked.fetch('%040d' % 1, restored))
+        self.assertEqual(2, os.stat(restored).st_nlink)
+
+    def test_temporary_files(self):
+        output = os.path.join(self.tmp, 'icon.png')
+        temp_path = cache.temporary_file(output)
+        self.assertEqual(self.tmp, os.path.dirname(temp_path))
+        self.assertTrue(os.path.basename(temp_path).startswith('.icon.png'))
+        self.assertTrue(temp_path.endswith('.png'))
+        cache.temporary_file(output)
+        other = self.write('other.png', 'other')
+        self.assertEqual(2, cache.remove_temporary_files(output))
+        self.assertEqual(['other.png'], os.listdir(self.tmp))
+
+    def test_place_replaces_atomically(self):
+        destination = self.write('output.png', 'old')
+        cache.place(self.write('source.png', 'new'), destination)
+        self.assertEqual('new', self.read(destination))
+        self.assertRaises(IOError, cache.place,
+                          os.path.join(self.tmp, 'missing.png'), destination)
+        # a failed copy leaves the destination as it was
+        self.assertEqual('new', self.read(destination))
+        self.assertEqual(['output.png', 'source.png'], sorted(os.listdir(self.tmp)))
+
+if __name__ == '__main__':
+    unittest.main()
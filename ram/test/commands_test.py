@@ -15,8 +15,10 @@
 # under the License.
 
 import unittest
-from ram import commands
-import json
+from ram import commands, backends, index
+from ram.bench import synthetic
+import argparse, json, os, re, shutil, signal, StringIO, subprocess, sys
+import tempfile, threading, time
 
 class TestParsing(unittest.TestCase):
 
@@ -368,6 +370,759 @@ class TestParsing(unittest.TestCase):
         args = {'baseheight': 10, 'basewidth': '20'}
         self.assertEqual('10 * 2 * 20', commands.replace_args(val, args))
 
+    def test_populate_template(self):
+        template = commands.ConversionTemplate('android', [
+            commands.SlaveConversion('res/drawable-hdpi/{name}',
+                                     '{basewidth} * 1.5', 48)])
+        first = commands.populate_template(template,
+                {'name': 'a.png', 'basewidth': 10})
+        second = commands.populate_template(template,
+                {'name': 'b.png', 'basewidth': 20})
+        self.assertEqual(['res/drawable-hdpi/a.png', 15.0, 48],
+                         [first[0].path, first[0].width, first[0].height])
+        self.assertEqual(['res/drawable-hdpi/b.png', 30.0, 48],
+                         [second[0].path, second[0].width, second[0].height])
+        # the template itself is left untouched
+        self.assertEqual('res/drawable-hdpi/{name}',
+                         template.slave_conversions[0].path)
+
+    def test_output_options(self):
+        templates = commands.parse_templates({'web': {
+            'output': {'format': 'webp', 'quality': 80},
+            'slaves': [
+                {'path': 'a.webp', 'width': 1, 'height': 1},
+                {'path': 'b.png', 'width': 1, 'height': 1,
+                 'output': {'format': 'png', 'colors': 64}}]}})
+        slaves = commands.populate_template(templates['web'], {})
+        self.assertEqual({'format': 'webp', 'quality': 80}, slaves[0].output)
+        # a slave's options are added to the template's
+        self.assertEqual({'format': 'png', 'quality': 80, 'colors': 64},
+                         slaves[1].output)
+        self.assertEqual(None, commands.parse_slaves(
+                [{'path': 'a.png', 'width': 1, 'height': 1}])[0].output)
+        for output in [{'quality': 0}, {'colors': '16'}, {'level': 1},
+                       {'format': 'png:x'}, {'compression': True}, []]:
+            self.assertRaises(commands.InvalidConversionException,
+                              commands.parse_output, output)
+
+
+class TestLoadRamfile(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.paths = (commands.RAMFILE_PATH, commands.RAMFILE_CACHE_PATH)
+        commands.RAMFILE_PATH = os.path.join(self.tmp, 'ramfile.json')
+        commands.RAMFILE_CACHE_PATH = os.path.join(self.tmp, '.ramcache')
+        self.parse_conversions = commands.parse_conversions
+
+    def tearDown(self):
+        commands.RAMFILE_PATH, commands.RAMFILE_CACHE_PATH = self.paths
+        commands.parse_conversions = self.parse_conversions
+        shutil.rmtree(self.tmp)
+
+    def write_ramfile(self, width):
+        with open(commands.RAMFILE_PATH, 'w') as ramfile:
+            ramfile.write(json.dumps({
+                'backend': 'pillow',
+                'templates': {'icon': {'slaves': [
+                    {'path': 'res/{name}', 'width': width, 'height': 10}]}},
+                'conversions': [
+                    {'master': 'a.png', 'template': 'icon', 'name': 'a.png'}]}))
+
+    def test_cached(self):
+        self.write_ramfile('{size}')
+        settings, conversions = commands.load_ramfile()
+        self.assertEqual({'backend': 'pillow'}, settings)
+
+        def fail(json_data, templates):
+            self.fail('the ramfile was parsed again')
+        commands.parse_conversions = fail
+        settings, cached = commands.load_ramfile()
+        self.assertEqual({'backend': 'pillow'}, settings)
+        self.assertEqual(['a.png'], cached.keys())
+        # templates loaded from the cache are compiled again on first use
+        slaves = commands.populate_template(cached['a.png'].template,
+                                            {'name': 'a.png', 'size': 20})
+        self.assertEqual(20, slaves[0].width)
+
+    def test_invalidated(self):
+        self.write_ramfile(10)
+        commands.load_ramfile()
+        self.write_ramfile(30)
+        settings, conversions = commands.load_ramfile()
+        slaves = commands.resolve_slaves(conversions['a.png'])
+        self.assertEqual(30, slaves[0].width)
+
+    def test_output_options_cached(self):
+        with open(commands.RAMFILE_PATH, 'w') as ramfile:
+            ramfile.write(json.dumps({
+                'conversions': [{'master': 'a.png', 'slaves': [
+                    {'path': 'a.jpg', 'width': 1, 'height': 1,
+                     'output': {'quality': 70}}]}]}))
+        commands.load_ramfile()
+        settings, cached = commands.load_ramfile()
+        self.assertEqual({'quality': 70}, cached['a.png'].slaves[0].output)
+
+
+class TestWatchConvert(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.paths = (commands.RAMFILE_PATH, commands.RAMFILE_CACHE_PATH)
+        commands.RAMFILE_PATH = os.path.join(self.tmp, 'ramfile.json')
+        commands.RAMFILE_CACHE_PATH = os.path.join(self.tmp, '.ramcache')
+        self.convert_index = commands.convert_index
+        self.file_index = index.FileIndex(os.path.join(self.tmp, 'index'))
+        self.file_index.init()
+        self.args = argparse.Namespace(backend=None, shard=None, dry_run=False,
+                                       explain=False, workers=None)
+
+    def tearDown(self):
+        commands.RAMFILE_PATH, commands.RAMFILE_CACHE_PATH = self.paths
+        commands.convert_index = self.convert_index
+        self.file_index.close()
+        shutil.rmtree(self.tmp)
+
+    def write_ramfile(self, data):
+        with open(commands.RAMFILE_PATH, 'w') as ramfile:
+            ramfile.write(data)
+
+    def test_errors_reported(self):
+        # saved half written
+        self.write_ramfile('{"conversions": [{"master": "a.png", "slaves')
+        self.assertEqual(None, commands.watch_convert(self.args, self.file_index))
+
+        self.write_ramfile('{"conversions": []}')
+        ramfile = commands.watch_convert(self.args, self.file_index)
+        self.assertEqual(({}, {}), ramfile)
+
+        def unbound(args, file_index, ramfile, masters=None):
+            raise commands.UnboundArgException('no value for {masterwidth}')
+        commands.convert_index = unbound
+        self.assertEqual(ramfile, commands.watch_convert(
+                self.args, self.file_index, ramfile, ['a.png']))
+
+
+class TestStatus(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.paths = (commands.INDEX_PATH, commands.RAMFILE_PATH,
+                      commands.RAMFILE_CACHE_PATH)
+        commands.INDEX_PATH = os.path.join(self.tmp, 'index')
+        commands.RAMFILE_PATH = os.path.join(self.tmp, 'ramfile.json')
+        commands.RAMFILE_CACHE_PATH = os.path.join(self.tmp, '.ramcache')
+        self.file_index = index.FileIndex(commands.INDEX_PATH)
+        self.file_index.init()
+
+        conversions = []
+        for name in ['current', 'stale', 'modified', 'deleted']:
+            master = self.path(name + '.png')
+            with open(master, 'w') as f:
+                f.write(name)
+            conversions.append({'master': master, 'slaves': [
+                    {'path': self.path(name + '-1.png'), 'width': 1, 'height': 1}]})
+        with open(commands.RAMFILE_PATH, 'w') as f:
+            f.write(json.dumps({'conversions': conversions}))
+        settings, loaded = commands.load_ramfile()
+        backend = backends.get_backend()
+        for name in ['current', 'stale', 'modified', 'deleted']:
+            master = self.path(name + '.png')
+            stat = os.stat(master)
+            self.file_index.add([(master, 0)])
+            self.file_index.update_many([(master, stat.st_mtime, stat.st_size,
+                                          index.file_digest(master))])
+            slave = loaded[master].slaves[0]
+            with open(slave.path, 'w') as f:
+                f.write('output')
+            self.file_index.update_outputs([commands.output_row(
+                    slave, master, backends.rule_fingerprint(slave, backend))])
+        os.remove(self.path('stale-1.png'))
+        with open(self.path('modified.png'), 'a') as f:
+            f.write(' edited')
+        os.remove(self.path('deleted.png'))
+        self.file_index.commit()
+
+    def tearDown(self):
+        (commands.INDEX_PATH, commands.RAMFILE_PATH,
+         commands.RAMFILE_CACHE_PATH) = self.paths
+        self.file_index.close()
+        shutil.rmtree(self.tmp)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def test_scan_status(self):
+        outputs = self.file_index.outputs
+        def outputs_of(masters=None):
+            # the whole outputs table is never loaded
+            self.assertNotEqual(None, masters)
+            return outputs(masters)
+        self.file_index.outputs = outputs_of
+        self.assertEqual([
+                (index.CURRENT, self.path('current.png')),
+                (index.MISSING, self.path('deleted.png')),
+                (index.MODIFIED, self.path('modified.png')),
+                (index.CURRENT, self.path('stale.png')),
+                (index.STALE, self.path('stale-1.png'))],
+            list(commands.scan_status(self.file_index)))
+
+    def test_porcelain(self):
+        args = argparse.Namespace(porcelain=True, all=False)
+        stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        try:
+            commands.status(args)
+            printed = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(['D ' + self.path('deleted.png'),
+                          'M ' + self.path('modified.png'),
+                          'S ' + self.path('stale-1.png')],
+                         printed.splitlines())
+
+
+class TestMasterArgs(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.master = os.path.join(self.tmp, 'master.png')
+        synthetic.write_png(self.master, 40, 30)
+        self.file_index = index.FileIndex(os.path.join(self.tmp, 'index'))
+        self.file_index.init()
+        self.template = commands.ConversionTemplate('half', [
+                commands.SlaveConversion('half.png', '{masterwidth} / 2',
+                                         '{masterheight} / 2')])
+
+    def tearDown(self):
+        self.file_index.close()
+        shutil.rmtree(self.tmp)
+
+    def test_master_size(self):
+        conversion = commands.Conversion(master=self.master,
+                                         template=self.template, args={})
+        master_info = commands.MasterInfo(self.file_index, self.master, 'sha1:0')
+        slaves = commands.resolve_slaves(conversion, master_info)
+        self.assertEqual((20, 15), (slaves[0].width, slaves[0].height))
+        # the size is recorded by content hash, so the header is not read again
+        self.assertEqual(('png', 40, 30, 1, 8),
+                         self.file_index.image_info('sha1:0'))
+
+    def test_args_take_precedence(self):
+        conversion = commands.Conversion(master=self.master,
+                template=self.template, args={'masterwidth': 100})
+        master_info = commands.MasterInfo(self.file_index, self.master, None)
+        slaves = commands.resolve_slaves(conversion, master_info)
+        self.assertEqual((50, 15), (slaves[0].width, slaves[0].height))
+
+
+class TestParseSize(unittest.TestCase):
+
+    def test_parse_size(self):
+        self.assertEqual(512, commands.parse_size('512'))
+        self.assertEqual(8 * 1024 ** 3, commands.parse_size('8G'))
+        self.assertEqual(1536 * 1024, commands.parse_size('1.5mb'))
+        self.assertEqual(100, commands.parse_size(100))
+        self.assertRaises(ValueError, commands.parse_size, 'lots')
+
+
+class TestOutputState(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'out.png')
+        with open(self.path, 'wb') as f:
+            f.write(b'output')
+        stat = os.stat(self.path)
+        self.row = (self.path, 'master.png', 'rule', stat.st_mtime,
+                    stat.st_size, index.file_digest(self.path))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_current(self):
+        self.assertEqual(index.CURRENT,
+                         commands.output_state(self.row, 'master.png', 'rule'))
+
+    def test_untracked(self):
+        self.assertEqual(index.MODIFIED,
+                         commands.output_state(None, 'master.png', 'rule'))
+
+    def test_rule_changed(self):
+        self.assertEqual(index.MODIFIED,
+                         commands.output_state(self.row, 'master.png', 'other'))
+        self.assertEqual(index.MODIFIED,
+                         commands.output_state(self.row, 'other.png', 'rule'))
+
+    def test_output_deleted(self):
+        os.remove(self.path)
+        self.assertEqual(index.MODIFIED,
+                         commands.output_state(self.row, 'master.png', 'rule'))
+
+
+class FakeBackend(backends.Backend):
+
+    name = 'fake'
+
+    def __init__(self, converted):
+        self.converted = converted
+
+    def convert(self, master, slaves, dry_run, memory=None):
+        self.converted.append((master, [slave.path for slave in slaves]))
+        for slave in slaves:
+            if slave.path.startswith('fail'):
+                return 1
+        return 0
+
+
+class TestRunConversions(unittest.TestCase):
+
+    def setUp(self):
+        self.converted = []
+        self.backend = FakeBackend(self.converted)
+
+    def test_all_slaves_converted(self):
+        conversions = [
+            commands.Conversion(master='a.png', slaves=[
+                commands.SlaveConversion('a1.png', 1, 1),
+                commands.SlaveConversion('a2.png', 2, 2)]),
+            commands.Conversion(master='b.png', slaves=[
+                commands.SlaveConversion('b1.png', 1, 1)]),
+        ]
+        succeeded, failed = commands.run_conversions(conversions, 4, False, False,
+                backend=self.backend)
+        self.assertEqual(['a.png', 'b.png'], sorted(succeeded))
+        self.assertEqual([], failed)
+        # each master is decoded once for all of its slaves
+        self.assertEqual([('a.png', ['a1.png', 'a2.png']), ('b.png', ['b1.png'])],
+                         sorted(self.converted))
+
+    def test_failures_collected(self):
+        conversions = [
+            commands.Conversion(master='a.png', slaves=[
+                commands.SlaveConversion('fail-a1.png', 1, 1),
+                commands.SlaveConversion('a2.png', 2, 2)]),
+            commands.Conversion(master='b.png', slaves=[
+                commands.SlaveConversion('fail-b1.png', 1, 1)]),
+            commands.Conversion(master='c.png', slaves=[
+                commands.SlaveConversion('c1.png', 1, 1)]),
+        ]
+        succeeded, failed = commands.run_conversions(
+                conversions, 2, False, False, single_pass=False,
+                backend=self.backend)
+        self.assertEqual(['c.png'], succeeded)
+        self.assertEqual(['fail-a1.png', 'fail-b1.png'],
+                         sorted([job.slaves[0].path for job in failed]))
+        # a failure does not stop the remaining conversions
+        self.assertEqual(4, len(self.converted))
+
+    def test_memory_limit(self):
+        conversions = [
+            commands.Conversion(master='big.png', slaves=[
+                commands.SlaveConversion('big1.png', 1, 1)]),
+            commands.Conversion(master='medium.png', slaves=[
+                commands.SlaveConversion('medium1.png', 1, 1)]),
+            commands.Conversion(master='small.png', slaves=[
+                commands.SlaveConversion('small1.png', 1, 1)]),
+        ]
+        sizes = {'big.png': 100, 'medium.png': 60, 'small.png': 30}
+        memory = {}
+        def record(master, slaves, dry_run, limit=None):
+            memory[master] = limit
+            return 0
+        self.backend.convert = record
+        succeeded, failed = commands.run_conversions(
+                conversions, 4, False, False, backend=self.backend,
+                max_memory=90, memory=lambda master, slaves: sizes[master])
+        self.assertEqual(3, len(succeeded))
+        self.assertEqual(sizes, memory)
+
+    def test_interrupted(self):
+        conversions = [commands.Conversion(master=name, slaves=[
+                commands.SlaveConversion(name + '1.png', 1, 1)])
+                for name in ['a.png', 'b.png', 'c.png']]
+        cancelled = threading.Event()
+        def convert(master, slaves, dry_run, limit=None):
+            self.converted.append(master)
+            if master == 'b.png':
+                # as if Ctrl-C were pressed while b.png converts
+                os.kill(os.getpid(), signal.SIGINT)
+                cancelled.wait(5)
+                return 1
+            return 0
+        self.backend.convert = convert
+        self.backend.cancel = cancelled.set
+        try:
+            commands.run_conversions(conversions, 1, False, False,
+                                     backend=self.backend)
+            self.fail('not interrupted')
+        except commands.InterruptedConversionException as e:
+            self.assertEqual(['a.png'], e.succeeded)
+        self.assertTrue(cancelled.is_set())
+        # no job starts after the interrupt
+        self.assertEqual(['a.png', 'b.png'], self.converted)
+
+    def test_interrupted_twice(self):
+        conversions = [commands.Conversion(master='a.png', slaves=[
+                commands.SlaveConversion('a1.png', 1, 1)])]
+        released = threading.Event()
+        def convert(master, slaves, dry_run, limit=None):
+            # a job which ignores the cancel, like one running in Pillow
+            os.kill(os.getpid(), signal.SIGINT)
+            time.sleep(0.2)
+            os.kill(os.getpid(), signal.SIGINT)
+            released.wait(5)
+            return 0
+        self.backend.convert = convert
+        started = time.time()
+        try:
+            self.assertRaises(KeyboardInterrupt, commands.run_conversions,
+                              conversions, 1, False, False, backend=self.backend)
+            # the running job was not waited for
+            self.assertTrue(time.time() - started < 2)
+        finally:
+            released.set()
+
+    def test_next_job(self):
+        waiting = [commands.ConversionJob(master, [], memory)
+                   for master, memory in [('a', 100), ('b', 60), ('c', 30)]]
+        # a job larger than the limit runs on its own
+        self.assertEqual('a', commands.next_job(waiting, 0, 0, 90).master)
+        self.assertEqual(None, commands.next_job(waiting, 70, 1, 90))
+        # smaller jobs go ahead of ones which do not fit yet
+        self.assertEqual('c', commands.next_job(waiting, 40, 1, 90).master)
+        self.assertEqual(['b'], [job.master for job in waiting])
+
+class TestRemoveDuplicates(unittest.TestCase):
+
+    def test_identical_outputs_converted_once(self):
+        conversions = [
+            commands.Conversion(master='a.png', slaves=[
+                commands.SlaveConversion('a1.png', 1, 1),
+                commands.SlaveConversion('a2.png', 2, 2),
+                commands.SlaveConversion('a3.jpg', 1, 1)]),
+            commands.Conversion(master='b.png', slaves=[
+                commands.SlaveConversion('b1.png', 1, 1)]),
+            commands.Conversion(master='c.png', slaves=[
+                commands.SlaveConversion('c1.png', 1, 1)]),
+        ]
+        master_hashes = {'a.png': 'same', 'b.png': 'same', 'c.png': None}
+        duplicates = commands.remove_duplicates(conversions, master_hashes,
+                                                FakeBackend([]))
+        self.assertEqual(['a1.png', 'a2.png', 'a3.jpg'],
+                         [slave.path for slave in conversions[0].slaves])
+        self.assertEqual([], conversions[1].slaves)
+        # masters without a hash are never treated as duplicates
+        self.assertEqual(['c1.png'], [slave.path for slave in conversions[2].slaves])
+        self.assertEqual([('b.png', 'b1.png', 'a1.png')],
+                         [(master, slave.path, original)
+                          for master, slave, original in duplicates])
+
+class TestPlanConversions(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.file_index = index.FileIndex(os.path.join(self.tmp, 'index'))
+        self.file_index.init()
+        self.conversions = {}
+        for name, size in [('small', 10), ('large', 1000), ('gone', 10)]:
+            master = os.path.join(self.tmp, name + '.png')
+            self.conversions[master] = commands.Conversion(master=master,
+                    slaves=[commands.SlaveConversion(
+                            os.path.join(self.tmp, name + '-1.png'), 2, 2)])
+            with open(master, 'wb') as f:
+                f.write(b'x' * size)
+            self.file_index.add([(master, 0)])
+        os.remove(os.path.join(self.tmp, 'gone.png'))
+
+    def tearDown(self):
+        self.file_index.close()
+        shutil.rmtree(self.tmp)
+
+    def test_plan(self):
+        plan = commands.plan_conversions(self.file_index, self.file_index.all(),
+                self.conversions, FakeBackend([]))
+        self.assertEqual([os.path.join(self.tmp, 'gone.png')], plan.missing)
+        # the largest master is converted first
+        self.assertEqual(['large.png', 'small.png'],
+                         [os.path.basename(conversion.master)
+                          for conversion in plan.ordered()])
+        self.assertEqual(1000 + 16, plan.cost(plan.ordered()[0]))
+
+    def test_unreadable_master(self):
+        # small.png is not an image, so its width is unknown
+        small = os.path.join(self.tmp, 'small.png')
+        self.file_index.update_outputs([(os.path.join(self.tmp, 'half.png'),
+                                         small, 'rule', 0, 0, 'sha1:0')])
+        self.conversions[small] = commands.Conversion(master=small, args={},
+                template=commands.ConversionTemplate('half', [
+                        commands.SlaveConversion(os.path.join(self.tmp, 'half.png'),
+                                                 '{masterwidth} / 2', 10)]))
+        plan = commands.plan_conversions(self.file_index, self.file_index.all(),
+                self.conversions, FakeBackend([]))
+        self.assertEqual([small], [master for master, error in plan.unresolved])
+        # the other masters are still planned
+        self.assertEqual(['large.png'], [os.path.basename(conversion.master)
+                                         for conversion in plan.conversions])
+        self.assertFalse(small in plan.file_states)
+        self.assertEqual([], plan.orphans)
+
+    def test_resume(self):
+        conversion = self.conversions[os.path.join(self.tmp, 'small.png')]
+        leftover = os.path.join(self.tmp, '.small-1.png.ram-killed.png')
+        open(leftover, 'w').close()
+        # the journal of a convert which was killed before small.png finished
+        self.file_index.start_journal([conversion.master])
+        plan = commands.plan_conversions(self.file_index, self.file_index.all(),
+                self.conversions, FakeBackend([]))
+        recorded = []
+        class RecordingBackend(FakeBackend):
+            def convert(backend, master, slaves, dry_run, memory=None):
+                # earlier masters are committed while later ones convert
+                reader = index.FileIndex(self.file_index.db_path)
+                recorded.append([row[0] for row in reader.all()
+                                 if row[3] != None])
+                reader.close()
+                for slave in slaves:
+                    open(slave.path, 'w').close()
+                return FakeBackend.convert(backend, master, slaves, dry_run)
+        args = argparse.Namespace(jobs=1, verbose=False, per_slave=False,
+                                  max_memory=None)
+        interval = commands.JOURNAL_COMMIT_INTERVAL
+        commands.JOURNAL_COMMIT_INTERVAL = 0
+        try:
+            commands.execute_plan(args, self.file_index, plan,
+                                  RecordingBackend([]))
+        finally:
+            commands.JOURNAL_COMMIT_INTERVAL = interval
+        self.assertFalse(os.path.exists(leftover))
+        self.assertEqual([[], [os.path.join(self.tmp, 'large.png')]], recorded)
+        self.assertEqual([], self.file_index.journal())
+
+    def test_missing_outputs_not_recorded(self):
+        plan = commands.plan_conversions(self.file_index, self.file_index.all(),
+                self.conversions, FakeBackend([]))
+        args = argparse.Namespace(jobs=1, verbose=False, per_slave=False,
+                                  max_memory=None)
+        # succeeds without writing the outputs, like a worker writing them
+        # somewhere else
+        commands.execute_plan(args, self.file_index, plan, FakeBackend([]))
+        self.assertEqual(set([None]), set([row[3] for row in self.file_index.all()]))
+        self.assertEqual([], self.file_index.journal())
+
+    def test_estimate_cost(self):
+        slaves = [commands.SlaveConversion('a.png', 10, 20),
+                  commands.SlaveConversion('b.png', '{width}', 20)]
+        self.assertEqual(100 + 10 * 20 * 4, commands.estimate_cost(100, slaves))
+
+    def test_slave_pixels(self):
+        slaves = [commands.SlaveConversion('a.png', 10, 20),
+                  commands.SlaveConversion('b.png', '2.5', 4),
+                  commands.SlaveConversion('c.png', '{width}', 20)]
+        self.assertEqual(210, commands.slave_pixels(slaves))
+
+class TestShardPlan(unittest.TestCase):
+
+    def plan(self):
+        plan = commands.Plan()
+        for name in 'abcdefg':
+            slave = commands.SlaveConversion(name + '1.png', 10, 10)
+            plan.conversions.append(commands.Conversion(master=name + '.png',
+                                                        slaves=[slave]))
+            plan.sizes[name + '.png'] = ord(name) * 100
+            plan.rules[slave.path] = (name + '.png', 'rule')
+        plan.restores.append(('h.png', commands.SlaveConversion('h1.png', 1, 1),
+                              'key'))
+        plan.duplicates.append(('i.png', commands.SlaveConversion('i1.png', 10, 10),
+                                'a1.png'))
+        return plan
+
+    def test_every_master_in_one_shard(self):
+        shards = [commands.shard_plan(self.plan(), number, 3)
+                  for number in [1, 2, 3]]
+        self.assertEqual(9, sum([len(kept) for kept in shards]))
+        self.assertEqual(set('abcdefghi'), set([master[0] for kept in shards
+                                                for master in kept]))
+        # copies are made by the shard converting the output they copy
+        self.assertEqual(1, len([kept for kept in shards
+                                 if 'a.png' in kept and 'i.png' in kept]))
+        self.assertEqual(shards, [commands.shard_plan(self.plan(), number, 3)
+                                  for number in [1, 2, 3]])
+
+    def test_filters_plan(self):
+        plan = self.plan()
+        kept = commands.shard_plan(plan, 2, 2)
+        self.assertEqual(kept, set([conversion.master
+                                    for conversion in plan.conversions] +
+                                   [restore[0] for restore in plan.restores] +
+                                   [duplicate[0] for duplicate in plan.duplicates]))
+
+    def test_parse_shard(self):
+        self.assertEqual((2, 4), commands.parse_shard('2/4'))
+        for value in ['0/4', '5/4', '2', 'a/b']:
+            self.assertRaises(commands.argparse.ArgumentTypeError,
+                              commands.parse_shard, value)
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+@unittest.skipIf(Image == None, 'Pillow is not installed')
+class TestShardProcesses(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmp, 'masters'))
+        os.makedirs(os.path.join(self.tmp, 'res'))
+        for number in range(8):
+            synthetic.write_png(os.path.join(self.tmp, 'masters', '%d.png' % number),
+                                16 + number, 16, number)
+        with open(os.path.join(self.tmp, 'ramfile.json'), 'w') as f:
+            f.write(json.dumps({'backend': 'pillow', 'discover': True,
+                    'conversions': [{'master': 'masters/*.png', 'slaves': [
+                            {'path': 'res/{stem}.png', 'width': 8, 'height': 8}]}]}))
+        self.env = dict(os.environ)
+        self.env['PYTHONPATH'] = os.path.dirname(os.path.dirname(
+                os.path.abspath(commands.__file__)))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def ram(self, *args):
+        return subprocess.Popen(
+                [sys.executable, '-c', 'from ram import commands; commands.main()']
+                + list(args), cwd=self.tmp, env=self.env,
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    def run_ram(self, *args):
+        process = self.ram(*args)
+        output = process.communicate()[0]
+        self.assertEqual(0, process.returncode, output)
+        return output
+
+    def test_shards_merged(self):
+        self.run_ram('init')
+        # status adds the discovered masters to the index the shards copy
+        self.run_ram('status')
+        shards = ['shard%d.ramindex' % number for number in [1, 2, 3]]
+        for shard in shards:
+            shutil.copyfile(os.path.join(self.tmp, '.ramindex'),
+                            os.path.join(self.tmp, shard))
+        processes = [self.ram('convert', '--shard', '%d/3' % number,
+                              '--index', shard)
+                     for number, shard in zip([1, 2, 3], shards)]
+        converted = 0
+        for process in processes:
+            output = process.communicate()[0]
+            self.assertEqual(0, process.returncode, output)
+            converted += int(re.search('converted (\\d+) master', output).group(1))
+        self.assertEqual(8, converted)
+
+        self.run_ram('merge-index', *shards)
+        self.assertEqual(sorted(['%d.png' % number for number in range(8)]),
+                         sorted(os.listdir(os.path.join(self.tmp, 'res'))))
+        self.assertTrue('Nothing to convert.' in self.run_ram('convert'))
+
+
+class TestExpandPaths(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.tmp, 'masters', 'sub'))
+        for name in ['a.png', 'b.jpg', 'sub/c.png']:
+            with open(os.path.join(self.tmp, 'masters', name), 'wb') as f:
+                f.write(b'')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def relative(self, paths):
+        return sorted([os.path.relpath(path, self.tmp) for path in paths])
+
+    def test_files(self):
+        path = os.path.join(self.tmp, 'masters', 'a.png')
+        self.assertEqual([path], commands.expand_paths([path], jobs=2))
+        self.assertRaises(commands.PathspecException, commands.expand_paths,
+                          [os.path.join(self.tmp, 'missing.png')])
+
+    def test_recursive(self):
+        masters = os.path.join(self.tmp, 'masters')
+        self.assertRaises(commands.PathspecException, commands.expand_paths,
+                          [masters])
+        self.assertEqual(['masters/a.png', 'masters/b.jpg', 'masters/sub/c.png'],
+                         self.relative(commands.expand_paths([masters], True)))
+
+    def test_patterns(self):
+        masters = os.path.join(self.tmp, 'masters')
+        self.assertEqual(['masters/a.png'], self.relative(
+                commands.expand_paths([os.path.join(masters, '*.png')])))
+        self.assertEqual(['masters/a.png', 'masters/sub/c.png'], self.relative(
+                commands.expand_paths([os.path.join(masters, '**', '*.png')])))
+        self.assertRaises(commands.PathspecException, commands.expand_paths,
+                          [os.path.join(masters, '*.gif')])
+
+class TestDiscoverMasters(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cwd = os.getcwd()
+        os.chdir(self.tmp)
+        os.makedirs('icons')
+        for name in ['icons/a.svg', 'icons/b.svg', 'icons/c.png']:
+            with open(name, 'wb') as f:
+                f.write(b'')
+        template = commands.ConversionTemplate('icon',
+                [commands.SlaveConversion('res/{name}.png', 16, 16)])
+        self.conversions = {
+            'icons/*.svg': commands.Conversion(master='icons/*.svg',
+                    template=template, args={'master': 'icons/*.svg'}),
+            'icons/b.svg': commands.Conversion(master='icons/b.svg',
+                    slaves=[commands.SlaveConversion('res/b.png', 32, 32)]),
+        }
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_pattern_conversions(self):
+        conversions = commands.ConversionSet(self.conversions)
+        self.assertEqual(['icons/b.svg', 'icons/a.svg'], list(conversions))
+        self.assertTrue('icons/a.svg' in conversions)
+        self.assertFalse('icons/c.png' in conversions)
+        self.assertFalse('other/icons/a.svg' in conversions)
+        self.assertEqual(['res/a.svg.png'], [slave.path for slave in
+                commands.resolve_slaves(conversions['icons/a.svg'])])
+        args = conversions['icons/a.svg'].args
+        self.assertEqual(('a', 'svg', 'icons/a.svg'),
+                         (args['stem'], args['ext'], args['master']))
+        # the explicit conversion takes precedence over the pattern
+        self.assertTrue(conversions['icons/b.svg'] is self.conversions['icons/b.svg'])
+
+    def test_pattern_slaves(self):
+        conversions = commands.ConversionSet({
+            'icons/*.svg': commands.Conversion(master='icons/*.svg',
+                    slaves=[commands.SlaveConversion('res/{stem}.png',
+                                                     '{size} * 2', 16)],
+                    args={'master': 'icons/*.svg', 'size': 8})})
+        # every match gets outputs of its own
+        self.assertEqual([('res/a.png', 16), ('res/b.png', 16)],
+                         [(slave.path, slave.width)
+                          for master in ['icons/a.svg', 'icons/b.svg']
+                          for slave in commands.resolve_slaves(conversions[master])])
+
+    def test_sync_index(self):
+        file_index = index.FileIndex('.ramindex')
+        file_index.init()
+        file_index.add([('icons/b.svg', 5), ('icons/c.png', 0)])
+        conversions = commands.ConversionSet(self.conversions)
+        self.assertEqual((1, 1), commands.sync_index(file_index, conversions))
+        # rows already in the index are not rewritten
+        self.assertEqual([('icons/a.svg', 0, None, None),
+                          ('icons/b.svg', 5, None, None)],
+                         sorted(file_index.all()))
+        file_index.close()
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
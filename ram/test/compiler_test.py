@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest
+from ram import compiler
+
+class TestPathFormatter(unittest.TestCase):
+
+    def test_format(self):
+        formatter = compiler.PathFormatter('{root}/{name}@2x{extension}')
+        self.assertEqual('Images/ios@2x.png', formatter.format(
+                {'root': 'Images', 'name': 'ios', 'extension': '.png'}))
+
+    def test_literal(self):
+        formatter = compiler.PathFormatter('res/drawable/image.png')
+        self.assertEqual('res/drawable/image.png', formatter.format({}))
+
+    def test_unbound(self):
+        formatter = compiler.PathFormatter('res/{name}')
+        self.assertRaises(compiler.UnboundArgException, formatter.format, {})
+
+class TestExpression(unittest.TestCase):
+
+    def test_evaluate(self):
+        self.assertEqual(75.0, compiler.Expression('{basewidth} * 0.75')(
+                {'basewidth': 100}))
+        self.assertEqual(200, compiler.Expression('{basewidth} * 2')(
+                {'basewidth': '100'}))
+        self.assertEqual(-5, compiler.Expression('-({a} - {b}) // 2')(
+                {'a': 20, 'b': 10}))
+        self.assertEqual(96, compiler.Expression('{size}')({'size': '48 * 2'}))
+
+    def test_unbound(self):
+        expression = compiler.Expression('{basewidth} * 2')
+        self.assertRaises(compiler.UnboundArgException, expression, {})
+
+    def test_invalid(self):
+        self.assertRaises(compiler.InvalidExpressionException,
+                          compiler.Expression, '__import__("os").getcwd()')
+        self.assertRaises(compiler.InvalidExpressionException,
+                          compiler.Expression, '{basewidth} *')
+        self.assertRaises(compiler.InvalidExpressionException,
+                          compiler.Expression, '{basewidth}.real')
+
+if __name__ == '__main__':
+    unittest.main()
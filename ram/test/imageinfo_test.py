@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest, os, shutil, struct, tempfile
+from ram import imageinfo
+from ram.bench import synthetic
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+class TestReadInfo(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def path(self, name):
+        return os.path.join(self.tmp, name)
+
+    def test_png(self):
+        synthetic.write_png(self.path('a.png'), 30, 20)
+        info = imageinfo.read_info(self.path('a.png'))
+        self.assertEqual(('png', 30, 20), (info.format, info.width, info.height))
+        self.assertEqual(600, info.pixels())
+
+    def test_gif(self):
+        with open(self.path('a.gif'), 'wb') as f:
+            f.write(b'GIF89a' + struct.pack('<HH', 300, 200) + b'\x00' * 20)
+        info = imageinfo.read_info(self.path('a.gif'))
+        self.assertEqual(('gif', 300, 200), (info.format, info.width, info.height))
+
+    def test_jpeg_after_large_segment(self):
+        app1 = b'\xff\xe1' + struct.pack('>H', 40002) + b'x' * 40000
+        sof = b'\xff\xc0' + struct.pack('>HBHHB', 11, 8, 480, 640, 3)
+        with open(self.path('a.jpg'), 'wb') as f:
+            f.write(b'\xff\xd8' + app1 + sof + b'\xff\xd9')
+        info = imageinfo.read_info(self.path('a.jpg'))
+        self.assertEqual(('jpeg', 640, 480), (info.format, info.width, info.height))
+
+    @unittest.skipIf(Image == None, 'Pillow is not installed')
+    def test_jpeg(self):
+        Image.new('RGB', (123, 45)).save(self.path('b.jpg'))
+        info = imageinfo.read_info(self.path('b.jpg'))
+        self.assertEqual((123, 45), (info.width, info.height))
+
+    def test_psd_layers(self):
+        header = b'8BPS' + struct.pack('>H6xHIIHH', 1, 4, 200, 300, 16, 3)
+        # empty color mode data, 10 bytes of image resources, then the layer
+        # and mask section with a layer count of -3
+        sections = (struct.pack('>I', 0) + struct.pack('>I', 10) + b'r' * 10 +
+                    struct.pack('>II', 100, 90) + struct.pack('>h', -3))
+        with open(self.path('a.psd'), 'wb') as f:
+            f.write(header + sections + b'\x00' * 100)
+        info = imageinfo.read_info(self.path('a.psd'))
+        self.assertEqual(('psd', 300, 200, 3, 16), info.to_tuple())
+
+    def test_webp(self):
+        lossless = (b'RIFF' + struct.pack('<I', 30) + b'WEBPVP8L' +
+                    struct.pack('<I', 10) + b'\x2f' +
+                    struct.pack('<I', (99 << 14) | 149) + b'\x00' * 10)
+        with open(self.path('a.webp'), 'wb') as f:
+            f.write(lossless)
+        info = imageinfo.read_info(self.path('a.webp'))
+        self.assertEqual(('webp', 150, 100), (info.format, info.width, info.height))
+
+    @unittest.skipIf(Image == None, 'Pillow is not installed')
+    def test_webp_lossy(self):
+        try:
+            Image.new('RGB', (64, 48)).save(self.path('b.webp'))
+        except (IOError, KeyError):
+            self.skipTest('Pillow was built without WebP')
+        info = imageinfo.read_info(self.path('b.webp'))
+        self.assertEqual((64, 48), (info.width, info.height))
+
+    def test_unknown(self):
+        with open(self.path('a.txt'), 'wb') as f:
+            f.write(b'not an image')
+        self.assertEqual(None, imageinfo.read_info(self.path('a.txt')))
+        self.assertEqual(None, imageinfo.read_info(self.path('missing.png')))
+
+
+if __name__ == '__main__':
+    unittest.main()
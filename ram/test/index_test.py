@@ -14,12 +14,207 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
-import unittest
+import unittest, os, shutil, sqlite3, tempfile, time
+from ram import index
 
-class Test(unittest.TestCase):
+class TestFileIndex(unittest.TestCase):
 
-    def testName(self):
-        pass
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp, '.ramindex')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_not_initialized(self):
+        file_index = index.FileIndex(self.db_path)
+        self.assertRaises(index.NotInitializedException, file_index.all)
+
+    def test_add_update(self):
+        file_index = index.FileIndex(self.db_path)
+        file_index.init()
+        file_index.add([('a.png', 0), ('b.png', 0), ('a.png', 5)])
+        file_index.update('b.png', 10, 3, 'sha1:abc')
+        self.assertEqual([('a.png', 0, None, None), ('b.png', 10, 3, 'sha1:abc')],
+                         sorted(file_index.all()))
+
+    def test_outputs(self):
+        file_index = index.FileIndex(self.db_path)
+        file_index.init()
+        file_index.add([('a.png', 0)])
+        file_index.update_output('res/a.png', 'a.png', 'rule', 1, 2, 'sha1:abc')
+        file_index.update_output('res/a.png', 'a.png', 'rule2', 3, 4, 'sha1:def')
+        file_index.update_output('res/b.png', 'b.png', 'rule', 1, 2, 'sha1:abc')
+        self.assertEqual([('res/a.png', 'a.png', 'rule2', 3, 4, 'sha1:def'),
+                          ('res/b.png', 'b.png', 'rule', 1, 2, 'sha1:abc')],
+                         sorted(file_index.outputs()))
+
+        self.assertEqual(['res/b.png'],
+                         [row[0] for row in file_index.outputs(['b.png', 'c.png'])])
+
+        file_index.remove('a.png')
+        self.assertEqual(['res/b.png'], [row[0] for row in file_index.outputs()])
+        file_index.remove_outputs(['res/b.png'])
+        self.assertEqual([], file_index.outputs())
+
+    def test_batched_updates(self):
+        index.FileIndex(self.db_path).init()
+        index.FileIndex(self.db_path).add([('a.png', 0), ('b.png', 0)])
+        reader = index.FileIndex(self.db_path)
+        with index.FileIndex(self.db_path) as file_index:
+            file_index.update_many([('a.png', 1, 2, 'sha1:a'),
+                                    ('b.png', 3, 4, 'sha1:b')])
+            # nothing is committed until the block exits
+            self.assertEqual([0, 0], [row[1] for row in sorted(reader.all())])
+        self.assertEqual([1, 3], [row[1] for row in sorted(reader.all())])
+        reader.close()
+
+    def test_commit_every(self):
+        index.FileIndex(self.db_path).init()
+        index.FileIndex(self.db_path).add([('a.png', 0), ('b.png', 0)])
+        reader = index.FileIndex(self.db_path)
+        with index.FileIndex(self.db_path, commit_every=2) as file_index:
+            file_index.update('a.png', 1)
+            self.assertEqual([0, 0], [row[1] for row in sorted(reader.all())])
+            file_index.update('b.png', 3)
+            self.assertEqual([1, 3], [row[1] for row in sorted(reader.all())])
+        reader.close()
+
+    def test_migrate(self):
+        conn = sqlite3.connect(self.db_path)
+        conn.execute('CREATE TABLE files (path text PRIMARY KEY, modified integer)')
+        conn.execute("INSERT INTO files VALUES ('a.png', 7)")
+        conn.commit()
+        conn.close()
+        file_index = index.FileIndex(self.db_path)
+        self.assertEqual([('a.png', 7, None, None)], file_index.all())
+        self.assertEqual([], file_index.outputs())
+        self.assertEqual(None, file_index.image_info('sha1:0'))
+
+    def test_journal(self):
+        file_index = index.FileIndex(self.db_path)
+        file_index.init()
+        file_index.start_journal(['a.png', 'b.png', 'c.png'])
+        file_index.finish_journal(['b.png'])
+        self.assertEqual(['a.png', 'c.png'], sorted(file_index.journal()))
+        # a new convert replaces the journal of the last one
+        file_index.start_journal(['d.png'])
+        self.assertEqual(['d.png'], file_index.journal())
+        file_index.finish_journal()
+        self.assertEqual([], file_index.journal())
+
+    def test_image_info(self):
+        file_index = index.FileIndex(self.db_path)
+        file_index.init()
+        file_index.update_image_info('sha1:0', ('png', 30, 20, 1, 8))
+        self.assertEqual(('png', 30, 20, 1, 8), file_index.image_info('sha1:0'))
+        self.assertEqual(None, file_index.image_info('sha1:1'))
+
+    def test_check_touched_file_is_current(self):
+        path = self.write('master.png', b'master')
+        stat = os.stat(path)
+        row = (path, stat.st_mtime, stat.st_size, index.file_digest(path))
+        self.assertEqual(index.CURRENT, index.check(row)[0])
+
+        os.utime(path, (time.time() + 100, time.time() + 100))
+        state, current = index.check(row)
+        self.assertEqual(index.CURRENT, state)
+        self.assertEqual(os.stat(path).st_mtime, current[0])
+
+    def test_check_modified(self):
+        path = self.write('master.png', b'master')
+        stat = os.stat(path)
+        row = (path, stat.st_mtime - 100, stat.st_size, index.file_digest(path))
+        self.write('master.png', b'MASTER')
+        self.assertEqual(index.MODIFIED, index.check(row)[0])
+        self.assertEqual(index.MODIFIED, index.check((path, 0, None, None))[0])
+
+    def test_check_with_stat_cache(self):
+        path = self.write('master.png', b'master')
+        stat = os.stat(path)
+        row = (path, stat.st_mtime, stat.st_size, index.file_digest(path))
+        stat_cache = index.StatCache(max_directories=1)
+        self.assertEqual(index.CURRENT, index.check(row, stat_cache)[0])
+        gone = (os.path.join(self.tmp, 'gone.png'), 0, None, None)
+        self.assertEqual(index.MISSING, index.check(gone, stat_cache)[0])
+        nowhere = (os.path.join(self.tmp, 'nowhere', 'gone.png'), 0, None, None)
+        self.assertEqual(index.MISSING, index.check(nowhere, stat_cache)[0])
+
+    def test_get(self):
+        file_index = index.FileIndex(self.db_path)
+        file_index.init()
+        file_index.add([('master%d.png' % i, i) for i in range(1200)])
+        paths = ['master%d.png' % i for i in range(0, 1200, 2)] + ['missing.png']
+        rows = file_index.get(paths)
+        self.assertEqual(600, len(rows))
+        self.assertTrue(('master2.png', 2, None, None) in rows)
+
+    def test_iter_all(self):
+        file_index = index.FileIndex(self.db_path)
+        file_index.init()
+        file_index.add([('b.png', 0), ('a/c.png', 0), ('a.png', 0)])
+        with file_index:
+            paths = []
+            for row in file_index.iter_all():
+                paths.append(row[0])
+                file_index.update(row[0], 1)
+        self.assertEqual(['a.png', 'a/c.png', 'b.png'], paths)
+        self.assertEqual([1, 1, 1], [row[1] for row in file_index.all()])
+
+    def test_check_missing(self):
+        row = (os.path.join(self.tmp, 'gone.png'), 0, None, None)
+        self.assertEqual((index.MISSING, None), index.check(row))
+
+    def test_paths(self):
+        file_index = index.FileIndex(self.db_path)
+        file_index.init()
+        file_index.add([('b.png', 0), ('a/c.png', 0)])
+        self.assertEqual(set(['b.png', 'a/c.png']), file_index.paths())
+
+    def test_walk_files(self):
+        for directory in ['masters/sub', 'masters/.git']:
+            os.makedirs(os.path.join(self.tmp, directory))
+        for name in ['masters/a.png', 'masters/sub/b.png', 'masters/.hidden',
+                     'masters/.git/config']:
+            self.write(name, b'')
+        found = [os.path.relpath(path, self.tmp)
+                 for path in index.walk_files(os.path.join(self.tmp, 'masters'))]
+        self.assertEqual(['masters/a.png', 'masters/sub/b.png'], sorted(found))
+
+    def test_merge(self):
+        file_index = index.FileIndex(self.db_path)
+        file_index.init()
+        file_index.add([('a.png', 0), ('b.png', 0), ('c.png', 0)])
+        file_index.update_output('res/c.png', 'c.png', 'rule', 1, 2, 'sha1:c')
+        file_index.close()
+        shards = [os.path.join(self.tmp, 'shard1'),
+                  os.path.join(self.tmp, 'shard2')]
+        for shard in shards:
+            shutil.copy(self.db_path, shard)
+
+        shard = index.FileIndex(shards[0])
+        shard.update('a.png', 1, 2, 'sha1:a')
+        shard.update_output('res/a.png', 'a.png', 'rule', 1, 2, 'sha1:a')
+        shard.update_image_info('sha1:a', ('png', 1, 1, 1, 8))
+        shard.close()
+        shard = index.FileIndex(shards[1])
+        shard.update('b.png', 1, 2, 'sha1:b')
+        shard.remove_outputs(['res/c.png'])
+        shard.close()
+
+        self.assertEqual((3, 1), file_index.merge(shards))
+        # rows a shard left alone do not undo the other shard's changes
+        self.assertEqual([('a.png', 1, 2, 'sha1:a'), ('b.png', 1, 2, 'sha1:b'),
+                          ('c.png', 0, None, None)], sorted(file_index.all()))
+        self.assertEqual([('res/a.png', 'a.png', 'rule', 1, 2, 'sha1:a')],
+                         file_index.outputs())
+        self.assertEqual(('png', 1, 1, 1, 8), file_index.image_info('sha1:a'))
 
 if __name__ == "__main__":
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest, os, shutil, tempfile
+from ram import patterns
+
+class TestPattern(unittest.TestCase):
+
+    def test_match(self):
+        pattern = patterns.Pattern('icons/*.svg')
+        self.assertTrue(pattern.match('icons/home.svg'))
+        self.assertTrue(pattern.match('./icons/home.svg'))
+        self.assertFalse(pattern.match('icons/sub/home.svg'))
+        self.assertFalse(pattern.match('icons/home.svg.png'))
+
+    def test_match_any_depth(self):
+        pattern = patterns.Pattern('icons/**/*.svg')
+        self.assertTrue(pattern.match('icons/home.svg'))
+        self.assertTrue(pattern.match('icons/a/b/home.svg'))
+        self.assertFalse(pattern.match('other/home.svg'))
+
+    def test_character_classes(self):
+        pattern = patterns.Pattern('icon[0-9]?.png')
+        self.assertTrue(pattern.match('icon1a.png'))
+        self.assertFalse(pattern.match('iconx1.png'))
+        self.assertTrue(patterns.Pattern('icon[!0-9].png').match('iconx.png'))
+
+    def test_files(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmp, 'icons', 'sub'))
+            for name in ['icons/a.svg', 'icons/sub/b.svg', 'icons/c.png']:
+                open(os.path.join(tmp, name), 'w').close()
+            found = [os.path.relpath(path, tmp) for path in
+                     patterns.Pattern(os.path.join(tmp, 'icons/**/*.svg')).files()]
+            self.assertEqual(['icons/a.svg', 'icons/sub/b.svg'], sorted(found))
+            found = [os.path.relpath(path, tmp) for path in
+                     patterns.Pattern(os.path.join(tmp, 'icons/*')).files()]
+            self.assertEqual(['icons/a.svg', 'icons/c.png'], sorted(found))
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()
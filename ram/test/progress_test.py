@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest, StringIO
+from ram import progress
+
+class Terminal(StringIO.StringIO):
+
+    def isatty(self):
+        return True
+
+class TestProgress(unittest.TestCase):
+
+    def tearDown(self):
+        progress.stop()
+
+    def test_line(self):
+        line = progress.Progress(10, StringIO.StringIO())
+        self.assertEqual('0/10 jobs', line.line())
+        line.done = 4
+        self.assertEqual('4/10 jobs, 2.0 jobs/s, 3s left',
+                         line.line(line.started + 2))
+        line.done = 10
+        self.assertEqual('10/10 jobs, 1.0 jobs/s', line.line(line.started + 10))
+
+    def test_format_duration(self):
+        self.assertEqual('59s', progress.format_duration(59))
+        self.assertEqual('2m05s', progress.format_duration(125))
+        self.assertEqual('1h01m', progress.format_duration(3660))
+
+    def test_terminal(self):
+        stream = Terminal()
+        progress.start(2, stream)
+        progress.advance()
+        progress.write('a.png: warning')
+        progress.stop()
+        lines = stream.getvalue().split('\r')
+        self.assertTrue(lines[1].startswith('1/2 jobs'))
+        # messages are printed above the progress line, which is redrawn
+        self.assertEqual('\x1b[Ka.png: warning\n', lines[2])
+        self.assertTrue(lines[3].startswith('1/2 jobs'))
+        self.assertEqual('\x1b[K', lines[-1])
+
+    def test_log(self):
+        stream = StringIO.StringIO()
+        progress.start(2, stream)
+        progress.advance()
+        progress.write('a.png: warning')
+        self.assertEqual('a.png: warning\n', stream.getvalue())
+
+if __name__ == "__main__":
+    unittest.main()
@@ -19,6 +19,15 @@ import unittest
 TEST_MODULES = [
     'ram.test.index_test',
     'ram.test.commands_test',
+    'ram.test.backends_test',
+    'ram.test.compiler_test',
+    'ram.test.watch_test',
+    'ram.test.cache_test',
+    'ram.test.timing_test',
+    'ram.test.patterns_test',
+    'ram.test.imageinfo_test',
+    'ram.test.worker_test',
+    'ram.test.progress_test',
 ]
 
 runner = unittest.TextTestRunner()
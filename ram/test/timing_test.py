@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest, os, json, shutil, tempfile
+from ram import timing
+
+class TestTimer(unittest.TestCase):
+
+    def tearDown(self):
+        timing.stop()
+
+    def test_disabled(self):
+        self.assertFalse(timing.enabled())
+        with timing.span('convert', 'a.png'):
+            pass
+        with timing.total('stat'):
+            pass
+
+    def test_spans_and_totals(self):
+        timer = timing.start()
+        with timing.span('convert', 'a.png', pixels=10):
+            pass
+        with timing.span('convert', 'b.png', pixels=5) as span:
+            span.args['bytes_out'] = 3
+        for i in range(3):
+            with timing.total('stat'):
+                pass
+        self.assertEqual(2, timer.totals['convert'][1])
+        self.assertEqual(3, timer.totals['stat'][1])
+        self.assertEqual(15, timer.sum_arg('convert', 'pixels'))
+        self.assertEqual(3, timer.sum_arg('convert', 'bytes_out'))
+        # totals do not keep an event per call
+        self.assertEqual(2, len(timer.events))
+        self.assertEqual(1, len(timer.slowest('convert', 1)))
+
+    def test_write_trace(self):
+        timer = timing.start()
+        with timing.span('index', 'commit'):
+            pass
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'trace.json')
+            timer.write_trace(path)
+            with open(path) as trace_file:
+                events = json.load(trace_file)['traceEvents']
+        finally:
+            shutil.rmtree(tmp)
+        self.assertEqual(1, len(events))
+        self.assertEqual('commit', events[0]['name'])
+        self.assertEqual('X', events[0]['ph'])
+
+
+if __name__ == '__main__':
+    unittest.main()
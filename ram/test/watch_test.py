@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest, os, shutil, tempfile, threading, time
+from ram import watch
+
+class TestPollingWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.a = self.write('a.png', 'a')
+        self.b = self.write('b.png', 'b')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write(data)
+        return path
+
+    def test_poll(self):
+        watcher = watch.PollingWatcher([self.a, self.b], interval=0.01)
+        self.assertEqual(set(), watcher.poll(0))
+        self.write('a.png', 'changed')
+        os.remove(self.b)
+        self.assertEqual(set([self.a, self.b]), watcher.poll(0))
+        self.assertEqual(set(), watcher.poll(0))
+
+    def test_changes_debounced(self):
+        watcher = watch.PollingWatcher([self.a, self.b], interval=0.01)
+
+        def burst():
+            self.write('a.png', 'first save')
+            time.sleep(0.05)
+            self.write('b.png', 'second save')
+        thread = threading.Thread(target=burst)
+        thread.start()
+        changed = watcher.changes(0.2)
+        thread.join()
+        self.assertEqual(set([self.a, self.b]), changed)
+
+    def test_watch_new_paths(self):
+        watcher = watch.PollingWatcher([self.a], interval=0.01)
+        c = os.path.join(self.tmp, 'c.png')
+        watcher.watch([self.a, c])
+        self.write('c.png', 'c')
+        self.assertEqual(set([c]), watcher.poll(0))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import unittest, os, shutil, socket, tempfile, threading, time
+from ram import worker, backends, commands
+
+class FakeBackend(backends.Backend):
+
+    name = 'fake'
+
+    def __init__(self, failing=(), blocking=None):
+        self.converted = []
+        self.failing = failing
+        self.blocking = blocking
+
+    def write(self, master, slaves, dry_run, memory=None):
+        self.converted.append((master, len(slaves), memory))
+        if self.blocking != None:
+            self.blocking.wait()
+        if master in self.failing:
+            return 1
+        for slave in slaves:
+            with open(slave.path, 'wb') as f:
+                f.write('%s %dx%d' % (master, slave.width, slave.height))
+        return 0
+
+class TestWorkerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.servers = []
+        self.released = threading.Event()
+
+    def tearDown(self):
+        self.released.set()
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def serve(self, name, backend, jobs=2, token=None):
+        address = os.path.join(self.tmp, name)
+        server = worker.create_server(address, backend, jobs, token)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.servers.append(server)
+        return address
+
+    def slaves(self, *names):
+        return [worker.SlaveConversion(os.path.join(self.tmp, name), 1, 2)
+                for name in names]
+
+    def read(self, slave):
+        with open(slave.path, 'rb') as f:
+            return f.read()
+
+    def test_parse_address(self):
+        self.assertEqual(('build1', 7000), worker.parse_address('build1:7000'))
+        self.assertEqual(('localhost', 7000), worker.parse_address(':7000'))
+        self.assertEqual('/tmp/ram.sock', worker.parse_address('/tmp/ram.sock'))
+
+    def test_run_conversions(self):
+        backend = FakeBackend()
+        pool = worker.WorkerPool([self.serve('a', backend, 3)], FakeBackend())
+        self.assertEqual(3, pool.jobs())
+        conversions = [commands.Conversion(master=name, slaves=
+                self.slaves(name + '1.png'))
+                for name in ['a.png', 'b.png', 'c.png', 'd.png']]
+        succeeded, failed = commands.run_conversions(conversions, pool.jobs(),
+                False, False, backend=pool)
+        pool.close()
+        self.assertEqual(['a.png', 'b.png', 'c.png', 'd.png'], sorted(succeeded))
+        self.assertEqual([('a.png', 1, None)],
+                         [job for job in backend.converted if job[0] == 'a.png'])
+
+    def test_outputs_sent_back(self):
+        pool = worker.WorkerPool([self.serve('a', FakeBackend())], FakeBackend())
+        # slaves in different directories sharing a name
+        os.mkdir(os.path.join(self.tmp, 'b'))
+        slaves = self.slaves('icon.png', 'b/icon.png')
+        slaves[1].width = 3
+        self.assertEqual(0, pool.convert('a.png', slaves, False))
+        pool.close()
+        self.assertEqual(['a.png 1x2', 'a.png 3x2'],
+                         [self.read(slave) for slave in slaves])
+        self.assertEqual(['a', 'b', 'icon.png'], sorted(os.listdir(self.tmp)))
+
+    def test_rejected_jobs(self):
+        backend = FakeBackend()
+        pool = worker.WorkerPool([self.serve('a', backend)], FakeBackend())
+        slaves = self.slaves('a1.png')
+        for master in ['/etc/passwd', '../a.png', 'res/../../a.png']:
+            self.assertEqual(1, pool.convert(master, slaves, False))
+        slaves[0].output = {'format': 'TEXT:/tmp/x'}
+        self.assertEqual(1, pool.convert('a.png', slaves, False))
+        pool.close()
+        self.assertEqual([], backend.converted)
+        self.assertFalse(os.path.exists(slaves[0].path))
+
+    def test_checkout_path(self):
+        root = os.path.realpath(self.tmp)
+        os.symlink('/etc', os.path.join(root, 'etc'))
+        self.assertEqual('res/a.png', worker.checkout_path(root, 'res/a.png'))
+        for path in ['', '/etc/passwd', '..', 'res/../../a.png', 'etc/passwd']:
+            self.assertRaises(worker.WorkerException, worker.checkout_path,
+                              root, path)
+
+    def test_token(self):
+        address = self.serve('a', FakeBackend(), token='secret')
+        for token in [None, 'wrong']:
+            self.assertRaises(worker.WorkerException, worker.WorkerPool,
+                              [address], FakeBackend(), token)
+        pool = worker.WorkerPool([address], FakeBackend(), 'secret')
+        self.assertEqual(0, pool.convert('a.png', self.slaves('a1.png'), False))
+        pool.close()
+
+    def test_failed_jobs_retried_elsewhere(self):
+        failing = FakeBackend(['a.png'])
+        working = FakeBackend()
+        pool = worker.WorkerPool([self.serve('a', failing, 1),
+                                  self.serve('b', working, 1)], FakeBackend())
+        slaves = self.slaves('a1.png')
+        self.assertEqual(0, pool.convert('a.png', slaves, False))
+        self.assertEqual(['a.png'], [job[0] for job in working.converted])
+
+        every = worker.WorkerPool([self.serve('c', failing, 1)], FakeBackend())
+        self.assertEqual(1, every.convert('a.png', slaves, False))
+        pool.close()
+        every.close()
+
+    def test_lost_worker(self):
+        backend = FakeBackend()
+        pool = worker.WorkerPool([self.serve('a', backend, 1),
+                                  self.serve('b', backend, 1)], FakeBackend())
+        pool.idle[0].socket.shutdown(socket.SHUT_RDWR)
+        self.assertEqual(0, pool.convert('a.png', self.slaves('a1.png'), False))
+        self.assertEqual(1, pool.jobs())
+        pool.close()
+
+    def test_cancel(self):
+        backend = FakeBackend(blocking=self.released)
+        pool = worker.WorkerPool([self.serve('a', backend, 1)], FakeBackend())
+        results = []
+        thread = threading.Thread(target=lambda: results.append(
+                pool.convert('a.png', self.slaves('a1.png'), False)))
+        thread.start()
+        while not backend.converted:
+            time.sleep(0.01)
+        pool.cancel()
+        # the job still running on the worker is not waited for
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual([1], results)
+        self.assertEqual(1, pool.convert('b.png', self.slaves('b1.png'), False))
+        pool.close()
+
+    def test_backend_mismatch(self):
+        class OtherBackend(FakeBackend):
+            name = 'other'
+        self.assertRaises(worker.WorkerException, worker.WorkerPool,
+                          [self.serve('a', OtherBackend())], FakeBackend())
+        self.assertRaises(worker.WorkerException, worker.WorkerPool,
+                          [os.path.join(self.tmp, 'missing')], FakeBackend())
+
+if __name__ == "__main__":
+    unittest.main()
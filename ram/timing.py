@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os, time, json, threading
+
+class Timer:
+    '''
+    records where the time of a run goes
+
+    span records an event, such as a single conversion, which shows up in
+    the trace. total only adds to its category's time and count, for calls
+    too frequent to keep one event each, such as stat calls.
+    '''
+
+    def __init__(self):
+        self.started = time.time()
+        self.lock = threading.Lock()
+        # (category, name, start, duration, thread id, args)
+        self.events = []
+        # category -> [seconds, calls]
+        self.totals = {}
+
+    def _add(self, category, duration):
+        with self.lock:
+            total = self.totals.setdefault(category, [0.0, 0])
+            total[0] += duration
+            total[1] += 1
+
+    def span(self, category, name, **args):
+        return _Span(self, category, name, args)
+
+    def total(self, category):
+        return _Span(self, category, None, None)
+
+    def slowest(self, category, count=10):
+        events = [event for event in self.events if event[0] == category]
+        events.sort(key=lambda event: event[3], reverse=True)
+        return events[:count]
+
+    def sum_arg(self, category, arg):
+        return sum([event[5].get(arg, 0) for event in self.events
+                    if event[0] == category])
+
+    def write_trace(self, path):
+        '''
+        write the events in the Chrome trace event format, which
+        chrome://tracing and Perfetto open
+        '''
+        pid = os.getpid()
+        trace = []
+        for category, name, start, duration, thread, args in self.events:
+            trace.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': int((start - self.started) * 1000000),
+                'dur': int(duration * 1000000),
+                'pid': pid,
+                'tid': thread,
+                'args': args,
+            })
+        with open(path, 'w') as trace_file:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'},
+                      trace_file)
+
+class _Span:
+
+    def __init__(self, timer, category, name, args):
+        self.timer = timer
+        self.category = category
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.time() - self.start
+        self.timer._add(self.category, duration)
+        if self.name != None:
+            event = (self.category, self.name, self.start, duration,
+                     threading.current_thread().ident, self.args)
+            with self.timer.lock:
+                self.timer.events.append(event)
+        return False
+
+class _NullSpan:
+
+    args = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+class NullTimer:
+    '''
+    the timer used unless profiling is turned on, which costs next to
+    nothing
+    '''
+
+    def span(self, category, name, **args):
+        return _NULL_SPAN
+
+    def total(self, category):
+        return _NULL_SPAN
+
+_timer = NullTimer()
+
+def start():
+    '''
+    start recording and return the Timer the instrumented code reports to
+    '''
+    global _timer
+    _timer = Timer()
+    return _timer
+
+def stop():
+    global _timer
+    _timer = NullTimer()
+
+def enabled():
+    return not isinstance(_timer, NullTimer)
+
+def span(category, name, **args):
+    return _timer.span(category, name, **args)
+
+def total(category):
+    return _timer.total(category)
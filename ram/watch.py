@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import os, time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+def normalize(file_path):
+    return os.path.normpath(file_path)
+
+class Watcher:
+    '''
+    waits for a set of files to change
+
+    changes returns once at least one watched file changed and no further
+    change followed for delay seconds, so a burst of saves is reported as
+    one set of changed paths
+    '''
+
+    def __init__(self, paths):
+        self.paths = set()
+        self.watch(paths)
+
+    def watch(self, paths):
+        '''
+        replace the set of watched files
+        '''
+        self.paths = set([normalize(path) for path in paths])
+
+    def poll(self, timeout):
+        '''
+        wait up to timeout seconds and return the watched paths which changed
+        '''
+        raise NotImplementedError()
+
+    def changes(self, delay):
+        changed = set()
+        while not changed:
+            changed.update(self.poll(None))
+        while True:
+            more = self.poll(delay)
+            if not more:
+                return changed
+            changed.update(more)
+
+    def close(self):
+        pass
+
+class PollingWatcher(Watcher):
+    '''
+    notices changes by stat'ing every watched file each interval seconds
+    '''
+
+    def __init__(self, paths, interval=1.0):
+        self.interval = interval
+        self.states = {}
+        Watcher.__init__(self, paths)
+
+    def _state(self, path):
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime, stat.st_size)
+        except OSError:
+            return None
+
+    def watch(self, paths):
+        Watcher.watch(self, paths)
+        states = {}
+        for path in self.paths:
+            if path in self.states:
+                states[path] = self.states[path]
+            else:
+                states[path] = self._state(path)
+        self.states = states
+
+    def _scan(self):
+        changed = set()
+        for path in self.paths:
+            state = self._state(path)
+            if state != self.states[path]:
+                self.states[path] = state
+                changed.add(path)
+        return changed
+
+    def poll(self, timeout):
+        start = time.time()
+        while True:
+            changed = self._scan()
+            if changed:
+                return changed
+            if timeout != None and time.time() - start >= timeout:
+                return changed
+            time.sleep(self.interval if timeout == None
+                       else min(self.interval, timeout))
+
+class InotifyWatcher(Watcher):
+    '''
+    watches the directories containing the watched files with inotify
+    '''
+
+    def __init__(self, paths):
+        self.manager = pyinotify.WatchManager()
+        self.directories = {}
+        self.pending = set()
+        self.notifier = pyinotify.Notifier(self.manager, self._event)
+        Watcher.__init__(self, paths)
+
+    def _event(self, event):
+        path = normalize(event.pathname)
+        if path in self.paths:
+            self.pending.add(path)
+
+    def watch(self, paths):
+        Watcher.watch(self, paths)
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                pyinotify.IN_MOVED_FROM | pyinotify.IN_ATTRIB)
+        directories = set([os.path.dirname(path) or '.' for path in self.paths])
+        for directory in directories:
+            if directory not in self.directories and os.path.isdir(directory):
+                watches = self.manager.add_watch(directory, mask)
+                self.directories[directory] = watches[directory]
+        for directory in list(self.directories):
+            if directory not in directories:
+                self.manager.rm_watch(self.directories.pop(directory))
+
+    def poll(self, timeout):
+        if timeout != None:
+            timeout = int(timeout * 1000)
+        if self.notifier.check_events(timeout):
+            self.notifier.read_events()
+            self.notifier.process_events()
+        changed = self.pending
+        self.pending = set()
+        return changed
+
+    def close(self):
+        self.notifier.stop()
+
+def create_watcher(paths, interval=1.0):
+    '''
+    watch paths with inotify if pyinotify is installed, otherwise by polling
+    every interval seconds
+    '''
+    if pyinotify:
+        return InotifyWatcher(paths)
+    return PollingWatcher(paths, interval)
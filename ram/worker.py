@@ -0,0 +1,435 @@
+#!/usr/bin/env python
+#
+#Copyright 2012 Steve Pennington
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+'''
+long-lived conversion workers and the backend which hands jobs to them
+
+the protocol is one JSON object per line. On connecting the coordinator sends
+{"token": token}, and the worker answers with a hello naming its backend and
+the number of jobs it runs at once, or with {"error": message} if the token
+is not its own. The coordinator opens that many connections, and each of them
+then carries one job at a time:
+
+    {"master": path, "slaves": [[name, width, height, output], ...],
+     "memory": bytes}
+
+answered by {"result": 0, "outputs": [base64 data, ...]}, {"result": code}
+if the conversion failed, or {"error": message} if the job was invalid or the
+backend raised. The master is read from the directory the worker was started
+in, which has to hold the same checkout as the coordinator's, and the
+outputs are written by the coordinator. Only the file names of the slaves are
+sent, which the worker converts to in a directory of its own.
+'''
+
+import os, socket, json, threading, SocketServer, base64, hmac, shutil
+import tempfile
+
+from ram import backends, progress
+
+# how long to wait for a free worker, which is effectively forever
+WAIT_FOREVER = 365 * 24 * 60 * 60
+
+class WorkerException(Exception):
+    pass
+
+class SlaveConversion:
+    '''
+    a resolved slave as sent over the wire
+    '''
+
+    def __init__(self, path, width, height, output=None):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.output = output
+
+def parse_address(address):
+    '''
+    parse host:port into a (host, port) tuple. Anything else is the path of
+    a unix socket.
+    '''
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit() and '/' not in address:
+        return (host or 'localhost', int(port))
+    return address
+
+def describe(address):
+    if isinstance(address, tuple):
+        return '%s:%d' % address
+    return address
+
+def _send(stream, message):
+    stream.write(json.dumps(message) + '\n')
+    stream.flush()
+
+def _receive(stream):
+    line = stream.readline()
+    if not line:
+        raise EOFError('connection closed')
+    return json.loads(line)
+
+def checkout_path(root, path):
+    '''
+    path if it is relative and stays inside root once symbolic links are
+    followed, else raise a WorkerException
+    '''
+    if not isinstance(path, basestring) or not path or os.path.isabs(path):
+        raise WorkerException('not a relative path: %r' % (path,))
+    real = os.path.realpath(os.path.join(root, path))
+    if not real.startswith(root + os.sep):
+        raise WorkerException('outside the checkout: %s' % path)
+    return path
+
+def _file_name(name):
+    if (not isinstance(name, basestring) or name in ('', '.', '..') or
+        os.path.basename(name) != name or '/' in name):
+        raise WorkerException('not a file name: %r' % (name,))
+    return name
+
+def _number(value):
+    if not isinstance(value, (int, long, float)) or type(value) == bool:
+        raise WorkerException('not a number: %r' % (value,))
+    return value
+
+def _same_token(sent, expected):
+    if isinstance(sent, unicode):
+        sent = sent.encode('utf-8')
+    if not isinstance(sent, str):
+        sent = ''
+    return hmac.compare_digest(sent, expected or '')
+
+def _convert(server, job):
+    '''
+    run a job in a scratch directory and reply with the outputs it wrote
+    '''
+    # commands imports this module
+    from ram import commands
+    master = checkout_path(server.root, job.get('master'))
+    memory = job.get('memory')
+    if memory != None:
+        _number(memory)
+    scratch = tempfile.mkdtemp(prefix='ram-worker-')
+    try:
+        slaves = []
+        for number, slave in enumerate(job.get('slaves') or []):
+            name, width, height, output = slave
+            try:
+                output = commands.parse_output(output)
+            except commands.InvalidConversionException:
+                raise WorkerException('invalid output options: %r' % (output,))
+            # numbered, since slaves in different directories can share a name
+            path = os.path.join(scratch, '%d-%s' % (number, _file_name(name)))
+            slaves.append(SlaveConversion(path, _number(width), _number(height),
+                                          output))
+        with server.running:
+            result = server.backend.convert(master, slaves, False, memory)
+        if result != 0:
+            return {'result': result}
+        outputs = []
+        for slave in slaves:
+            with open(slave.path, 'rb') as f:
+                outputs.append(base64.b64encode(f.read()))
+        return {'result': 0, 'outputs': outputs}
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        try:
+            token = _receive(self.rfile).get('token')
+        except (EOFError, ValueError, AttributeError, socket.error):
+            return
+        if not _same_token(token, server.token):
+            try:
+                _send(self.wfile, {'error': 'wrong token'})
+            except socket.error:
+                pass
+            return
+        _send(self.wfile, {
+            'backend': server.backend.name,
+            'version': server.backend.version(),
+            'options': server.backend.options(),
+            'jobs': server.jobs,
+        })
+        while True:
+            try:
+                job = _receive(self.rfile)
+            except (EOFError, ValueError, socket.error):
+                return
+            try:
+                if not isinstance(job, dict):
+                    raise WorkerException('not a job: %r' % (job,))
+                reply = _convert(server, job)
+            except Exception as e:
+                reply = {'error': '%s: %s' % (type(e).__name__, e)}
+            try:
+                _send(self.wfile, reply)
+            except socket.error:
+                return
+
+    def finish(self):
+        # the coordinator may have gone away, e.g. having cancelled its jobs
+        try:
+            SocketServer.StreamRequestHandler.finish(self)
+        except socket.error:
+            pass
+
+class _Server(SocketServer.ThreadingMixIn):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def setup_worker(self, backend, jobs, token):
+        self.backend = backend
+        self.jobs = jobs
+        self.token = token
+        self.root = os.path.realpath(os.getcwd())
+        # shared by every connection, so several coordinators together never
+        # run more than jobs conversions at once
+        self.running = threading.Semaphore(jobs)
+
+class _TCPServer(_Server, SocketServer.TCPServer):
+    pass
+
+class _UnixServer(_Server, SocketServer.UnixStreamServer):
+    pass
+
+def create_server(address, backend, jobs, token=None):
+    '''
+    create a server running up to jobs conversions at once with backend,
+    listening on address, which is a (host, port) tuple or a unix socket path.
+    With a token only coordinators sending the same token are served.
+
+    masters are read from the current directory, and only from inside it
+    '''
+    if isinstance(address, tuple):
+        server = _TCPServer(address, _Handler)
+    else:
+        if os.path.exists(address):
+            os.remove(address)
+        server = _UnixServer(address, _Handler)
+    server.setup_worker(backend, max(1, jobs), token)
+    return server
+
+def _connect(address):
+    if isinstance(address, tuple):
+        return socket.create_connection(address)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(address)
+    return connection
+
+class _Connection:
+
+    def __init__(self, address, token):
+        self.address = address
+        self.socket = _connect(address)
+        self.stream = self.socket.makefile('rwb')
+        try:
+            _send(self.stream, {'token': token})
+            self.hello = _receive(self.stream)
+        except (EOFError, ValueError, socket.error):
+            self.close()
+            raise
+        if 'error' in self.hello:
+            self.close()
+            raise WorkerException('worker %s refused the connection: %s' % (
+                    describe(address), self.hello['error']))
+
+    def convert(self, master, slaves, memory):
+        _send(self.stream, {
+            'master': master,
+            'slaves': [[os.path.basename(str(slave.path)), slave.width,
+                        slave.height, backends.output_options(slave)]
+                       for slave in slaves],
+            'memory': memory,
+        })
+        return _receive(self.stream)
+
+    def interrupt(self):
+        '''
+        make a convert waiting for its reply fail
+        '''
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def close(self):
+        try:
+            self.stream.close()
+            self.socket.close()
+        except socket.error:
+            pass
+
+class WorkerPool(backends.Backend):
+    '''
+    a backend converting on remote workers instead of locally
+
+    backend is the backend the workers must be running, whose name, version
+    and options go into the rule and output fingerprints. jobs is the total
+    number of jobs the workers run at once, and convert blocks until one of
+    them is free. A job whose worker goes away or fails is retried on
+    another worker, and only fails once every worker has tried it. The
+    outputs a worker sends back are written here, so workers need no shared
+    file system. token is sent to workers started with one.
+
+    raises a WorkerException if no worker can be reached, a worker refuses
+    the token or a worker runs a different backend
+    '''
+
+    def __init__(self, addresses, backend, token=None):
+        self.backend = backend
+        self.name = backend.name
+        self.changed = threading.Condition()
+        # every open connection, and those not running a job
+        self.connections = []
+        self.idle = []
+        self.cancelled = False
+        for address in addresses:
+            try:
+                first = _Connection(address, token)
+            except (socket.error, EOFError, ValueError) as e:
+                progress.write('warning: cannot reach worker %s: %s' % (
+                        describe(address), e))
+                continue
+            self.check(first)
+            self.release(first, True)
+            for extra in range(first.hello['jobs'] - 1):
+                self.release(_Connection(address, token), True)
+        if not self.connections:
+            raise WorkerException('none of the workers could be reached')
+
+    def check(self, connection):
+        hello = connection.hello
+        expected = [self.backend.name, self.backend.version(),
+                    self.backend.options()]
+        found = [hello['backend'], hello['version'], hello['options']]
+        if found != expected:
+            raise WorkerException('worker %s converts with %s %s, not %s %s' % (
+                    describe(connection.address), found[0], found[1],
+                    expected[0], expected[1]))
+
+    def jobs(self):
+        '''
+        the number of jobs the workers run at once
+        '''
+        return len(self.connections)
+
+    def options(self):
+        return self.backend.options()
+
+    def version(self):
+        return self.backend.version()
+
+    def acquire(self, tried):
+        '''
+        wait for an idle connection to a worker not in tried, or return None
+        once every worker left has been tried or the pool was cancelled
+        '''
+        with self.changed:
+            while True:
+                if self.cancelled:
+                    return None
+                for connection in self.idle:
+                    if connection.address not in tried:
+                        self.idle.remove(connection)
+                        return connection
+                if not [connection for connection in self.connections
+                        if connection.address not in tried]:
+                    return None
+                # a timeout keeps the wait interruptible by Ctrl-C
+                self.changed.wait(WAIT_FOREVER)
+
+    def release(self, connection, new=False):
+        with self.changed:
+            if new:
+                self.connections.append(connection)
+            self.idle.append(connection)
+            self.changed.notify_all()
+
+    def remove(self, connection):
+        connection.close()
+        with self.changed:
+            if connection in self.connections:
+                self.connections.remove(connection)
+            self.changed.notify_all()
+
+    def write(self, master, slaves, dry_run, memory=None):
+        if dry_run:
+            return self.backend.convert(master, slaves, dry_run, memory)
+        tried = set()
+        result = 1
+        while True:
+            connection = self.acquire(tried)
+            if connection == None:
+                return result
+            try:
+                reply = connection.convert(master, slaves, memory)
+            except (socket.error, EOFError, ValueError) as e:
+                self.remove(connection)
+                if self.cancelled:
+                    return 1
+                progress.write('warning: lost worker %s: %s' % (
+                        describe(connection.address), e))
+                continue
+            self.release(connection)
+            tried.add(connection.address)
+            if 'error' in reply:
+                progress.write('warning: worker %s: %s' % (
+                        describe(connection.address), reply['error']))
+                continue
+            result = reply['result']
+            if result == 0:
+                return self.save(master, slaves, reply.get('outputs'))
+
+    def save(self, master, slaves, outputs):
+        '''
+        write the outputs a worker sent back to the slaves
+        '''
+        if not isinstance(outputs, list) or len(outputs) != len(slaves):
+            progress.write('%s: the worker sent back no outputs' % master)
+            return 1
+        try:
+            for slave, data in zip(slaves, outputs):
+                with open(str(slave.path), 'wb') as f:
+                    f.write(base64.b64decode(data))
+        except (IOError, TypeError) as e:
+            progress.write('%s: %s' % (master, e))
+            return 1
+        return 0
+
+    def cancel(self):
+        '''
+        stop waiting for the jobs running on the workers, which fail, along
+        with any started afterwards
+        '''
+        with self.changed:
+            self.cancelled = True
+            busy = [connection for connection in self.connections
+                    if connection not in self.idle]
+            self.changed.notify_all()
+        for connection in busy:
+            connection.interrupt()
+
+    def close(self):
+        with self.changed:
+            connections = self.connections
+            self.connections = []
+            self.idle = []
+        for connection in connections:
+            connection.close()